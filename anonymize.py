@@ -1,90 +1,436 @@
-import fileinput
+import argparse
+import hashlib
+import json
+import os
+import re
 import sys
+import time
+import zlib
+from collections import OrderedDict, deque
+from multiprocessing import Pool, cpu_count
 
+import instrumentation
 
-def anonymize(sql_filename):
-    """This function reads in the sql dump for the sidewalk project and replaces all the email addresses and usernames
-    with random strings.
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
-    References:
-    http://stackoverflow.com/questions/17140886/how-to-search-and-replace-text-in-a-file-using-python
+# Size of the pieces the dump is read in. Everything outside the COPY blocks being anonymized is written back out in
+# pieces of up to this size, and the rows of those blocks are anonymized in pieces of up to about this size.
+CHUNK_SIZE = 4 * 1024 * 1024
 
-    :param sql_filename:
-    :return:
+COPY_LINE = re.compile(r'^COPY\s+(\S+)\s*\((.*)\)\s+FROM\s+stdin;\s*$')
+COPY_TERMINATOR = "\\.\n"
+NULL = "\\N"
+
+DEFAULT_RULES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "anonymize_rules.json")
+
+
+class UserIndex(object):
+    """Assigns each email address the index used in its anonymized username and email address.
+
+    The first new address gets `next_index`, the next one `next_index + 1`, and so on. The mapping can be exported to a
+    JSON file and loaded back, so that several dumps can be anonymized consistently.
     """
 
+    def __init__(self, email_to_index=None, next_index=1):
+        self.email_to_index = email_to_index if email_to_index is not None else {}
+        self.next_index = next_index
 
-    terminate_line = "\."
-    copy_user_start_line = """COPY sidewalk_user (user_id, username, email) FROM stdin;"""
-    copy_login_info_start_line = """COPY login_info (login_info_id, provider_id, provider_key) FROM stdin;"""
+    def get(self, email_address):
+        index = self.email_to_index.get(email_address)
+        if index is None:
+            index = self.next_index
+            self.email_to_index[email_address] = index
+            self.next_index += 1
+        return index
 
+    def __len__(self):
+        return len(self.email_to_index)
 
-    read_user_table = False
-    read_login_info_table = False
+    def export(self, path):
+        with open(path, 'w') as f:
+            json.dump({'next_index': self.next_index, 'email_to_index': self.email_to_index}, f)
 
-    output_file = open(sql_filename.replace(".sql", ".anonymized.sql"), "w")
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            data = json.load(f)
+        return cls(dict((email.encode('utf-8'), index) for (email, index) in data['email_to_index'].items()),
+                   data['next_index'])
 
-    with open(sql_filename, 'r') as input_file:
-        for line in input_file:
-            if copy_user_start_line in line:
-                read_user_table = True
-                continue
-            elif copy_login_info_start_line in line:
-                read_login_info_table = True
-                continue
-            elif terminate_line in line:
-                read_user_table = False
-                read_login_info_table = False
+
+class CompressedFile(object):
+    """Minimal file object that reads or writes a gzip or zstd compressed file in a streaming fashion.
+
+    This is much faster than the gzip module, which reads in small pieces. When writing, `level` is the compression level
+    (by default 6 for gzip and 3 for zstd); lower levels are faster. When reading, a gzip file made of several members
+    (e.g. files concatenated with cat, or written by pigz) is read through to the end, like gunzip does.
+    """
+
+    def __init__(self, path, mode, compression, level=None):
+        self.writing = 'w' in mode
+        self.compression = compression
+        if compression == 'gzip':
+            if self.writing:
+                self.codec = zlib.compressobj(level or 6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            else:
+                self.codec = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        else:
+            if zstandard is None:
+                raise ImportError("Reading and writing .zst files needs the zstandard package (pip install zstandard).")
+            if self.writing:
+                self.codec = zstandard.ZstdCompressor(level=level or 3).compressobj()
+            else:
+                self.codec = zstandard.ZstdDecompressor().decompressobj()
+        self.raw = open(path, mode)
+
+    def read(self, size):
+        while True:
+            data = self.raw.read(size)
+            if not data:
+                return ''
+            data = self.codec.decompress(data)
+            # Whatever follows the end of a gzip member is the start of the next one.
+            while self.compression == 'gzip' and self.codec.unused_data:
+                rest = self.codec.unused_data
+                self.codec = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                data += self.codec.decompress(rest)
+            if data:
+                return data
+
+    def write(self, data):
+        self.raw.write(self.codec.compress(data))
+
+    def close(self):
+        if self.writing:
+            self.raw.write(self.codec.flush())
+        self.raw.close()
+
+
+def open_dump(path, mode, level=None):
+    """Opens a plain, gzip (.gz) or zstd (.zst) compressed dump for reading ('rb') or writing ('wb')."""
+    if path.endswith('.gz'):
+        return CompressedFile(path, mode, 'gzip', level)
+    elif path.endswith('.zst'):
+        return CompressedFile(path, mode, 'zstd', level)
+    else:
+        return open(path, mode)
+
+
+def find_line(buf, line):
+    """Returns the position of the first occurrence of `line` at the start of a line in buf, or -1 if there is none."""
+    if buf.startswith(line):
+        return 0
+    pos = buf.find("\n" + line)
+    return pos + 1 if pos >= 0 else -1
+
+
+def parse_copy_line(line):
+    """Returns the (table, columns) of a "COPY table (column, ...) FROM stdin;" line, or None for other lines."""
+    match = COPY_LINE.match(line)
+    if match is None:
+        return None
+    table = match.group(1).split(".")[-1].strip('"')
+    return (table, tuple(column.strip().strip('"') for column in match.group(2).split(",")))
+
+
+def split_dump(input_file, tables, chunk_size=CHUNK_SIZE):
+    """Splits a SQL dump into pieces, in order.
+
+    Yields (None, None, text) for text to be copied unchanged, and (table, columns, rows) for pieces of complete rows
+    (of up to about chunk_size) from the COPY blocks of the given tables. The COPY lines and terminators of those blocks
+    are yielded as text to copy. The other COPY blocks are copied without looking at their rows.
+
+    :param input_file: file object to read the dump from.
+    :param tables: names of the tables whose rows should be yielded.
+    :param chunk_size: number of bytes to read at a time.
+    """
+    (OUTSIDE, IN_TABLE, IN_OTHER_TABLE) = range(3)
+    state = OUTSIDE
+    buf = ''
+    eof = False
+    while not eof:
+        chunk = input_file.read(chunk_size)
+        eof = not chunk
+        buf += chunk
+
+        # buf always starts at the start of a line.
+        while True:
+            if state == OUTSIDE:
+                start = find_line(buf, "COPY ")
+                if start < 0:
+                    # Copy everything up to the last complete line, which could be the start of a COPY line.
+                    end = len(buf) if eof else buf.rfind("\n") + 1
+                    if end > 0:
+                        yield (None, None, buf[:end])
+                    buf = buf[end:]
+                    break
+                end = buf.find("\n", start) + 1
+                if end == 0:
+                    if not eof:
+                        # Wait for the rest of the COPY line.
+                        if start > 0:
+                            yield (None, None, buf[:start])
+                        buf = buf[start:]
+                        break
+                    end = len(buf)
+                block = parse_copy_line(buf[start:end])
+                yield (None, None, buf[:end])
+                buf = buf[end:]
+                if block is not None:
+                    state = IN_TABLE if block[0] in tables else IN_OTHER_TABLE
+            else:
+                # Take the rows up to the end of the block, or up to the last complete line if it doesn't end here.
+                end = find_line(buf, COPY_TERMINATOR)
+                stop = end if end >= 0 else (len(buf) if eof else buf.rfind("\n") + 1)
+                if stop > 0:
+                    yield block + (buf[:stop],) if state == IN_TABLE else (None, None, buf[:stop])
+                buf = buf[stop:]
+                if end < 0:
+                    break
+                yield (None, None, COPY_TERMINATOR)
+                buf = buf[len(COPY_TERMINATOR):]
+                state = OUTSIDE
+
+
+class TableRule(object):
+    """How to anonymize the rows of a table with the given columns, from its entry in the rules file.
+
+    Each column to anonymize has a strategy:
+      "index": replaced by `format` (default "{index}") with the index that the UserIndex gives the value of the `key`
+               column (default: the column itself). The same value gets the same index in every table.
+      "hash":  replaced by a salted SHA-256 hash of its value.
+      "null":  replaced by NULL.
+    Rows that match one of the "skip_rows" conditions (a column that "equals" or "contains" a string) are left as is.
+    NULL values are never replaced.
+    """
+
+    def __init__(self, table, rule, columns):
+        position = dict((column, i) for (i, column) in enumerate(columns))
+        def column_position(column):
+            if column not in position:
+                raise ValueError("Column %s in the rules is not in table %s %s." % (column, table, columns))
+            return position[column]
+
+        self.skips = [(column_position(skip["column"]), skip.get("equals"), skip.get("contains"))
+                      for skip in rule.get("skip_rows", [])]
+        self.replacements = [(column_position(column), spec["strategy"], column_position(spec.get("key", column)),
+                              spec.get("format", "{index}")) for (column, spec) in rule["columns"].items()]
+        for (_, strategy, _, _) in self.replacements:
+            if strategy not in ("index", "hash", "null"):
+                raise ValueError("Unknown strategy %s for table %s." % (strategy, table))
+        self.index_keys = [key for (_, strategy, key, _) in self.replacements if strategy == "index"]
+
+    def skip(self, fields):
+        for (i, equals, contains) in self.skips:
+            if (equals is not None and fields[i] == equals) or (contains is not None and contains in fields[i]):
+                return True
+        return False
+
+
+# State of a worker process: the rules (by table), the TableRules compiled for each COPY line seen, the mapping from
+# "index" keys to their indexes, and the salt used by the "hash" strategy.
+_worker = {}
+
+
+def init_worker(rules, email_to_index, salt):
+    _worker.clear()
+    _worker.update({"rules": rules, "compiled": {}, "email_to_index": email_to_index, "salt": salt})
+
+
+def get_table_rule(table, columns):
+    if (table, columns) not in _worker["compiled"]:
+        _worker["compiled"][(table, columns)] = TableRule(table, _worker["rules"][table], columns)
+    return _worker["compiled"][(table, columns)]
+
+
+def collect_index_keys(piece):
+    """Returns the values that the "index" strategy will need an index for in a piece of rows, in order of first use."""
+    (table, columns, rows) = piece
+    rule = get_table_rule(table, columns)
+    seen = set()
+    keys = []
+    if len(rule.index_keys) == 0:
+        return keys
+    for line in rows.split("\n")[:-1]:
+        fields = line.split("\t")
+        if rule.skip(fields):
+            continue
+        for i in rule.index_keys:
+            if fields[i] != NULL:
+                key = fields[i].strip()
+                if key not in seen:
+                    seen.add(key)
+                    keys.append(key)
+    return keys
+
+
+def anonymize_rows(piece):
+    """Anonymizes a piece of rows (each ending in a newline) from a COPY block, returning the new rows."""
+    (table, columns, rows) = piece
+    rule = get_table_rule(table, columns)
+    email_to_index = _worker["email_to_index"]
+    salt = _worker["salt"]
+    lines = rows.split("\n")
+    for n in xrange(len(lines) - 1):
+        fields = lines[n].split("\t")
+        if rule.skip(fields):
+            continue
+        original = list(fields)
+        for (i, strategy, key, format) in rule.replacements:
+            if original[i] == NULL:
                 continue
+            elif strategy == "index":
+                fields[i] = format.format(index=email_to_index[original[key].strip()])
+            elif strategy == "hash":
+                fields[i] = hashlib.sha256(salt + original[i]).hexdigest()
+            else:
+                fields[i] = NULL
+        lines[n] = "\t".join(fields)
+    return "\n".join(lines)
 
-            new_line = line
 
-            # Substitute lines in the sidewalk_user table
-            if read_user_table:
-                line_list = line.split("\t")
-                if line_list[1] != "anonymous":
-                    email_address = line_list[2].strip()
-                    current_user_index = get_user_index(email_address)
+def map_pieces(pool, func, pieces, window):
+    """Applies func to the table pieces in the pool, yielding the results in order, with text pieces passed through.
 
-                    line_list[1] = "anonymized_user_name." + str(current_user_index)
-                    line_list[2] = "anonymized." + str(current_user_index) + "@email.com\n"
-                new_line = "\t".join(line_list)
+    Up to `window` pieces are in flight at once, so the dump is never all in memory.
+    """
+    pending = deque()
+    for (table, columns, data) in pieces:
+        pending.append(data if table is None else pool.apply_async(func, ((table, columns, data),)))
+        while len(pending) >= window or (len(pending) > 0 and (isinstance(pending[0], str) or pending[0].ready())):
+            head = pending.popleft()
+            yield head if isinstance(head, str) else head.get()
+    while len(pending) > 0:
+        head = pending.popleft()
+        yield head if isinstance(head, str) else head.get()
 
-            # Substitute lines in the login_info table
-            if read_login_info_table:
-                line_list = line.split("\t")
-                email_address = line_list[2].strip()
-                if "anonymous@cs.umd.edu" not in line_list[2]:
-                    current_user_index = get_user_index(email_address)
-                    line_list[2] = "anonymized." + str(current_user_index) + "@email.com\n"
 
+def load_rules(path):
+    """Loads a rules file, which maps table -> {"columns": {column -> {"strategy": ...}}, "skip_rows": [...]}."""
+    with open(path) as f:
+        rules = json.load(f, object_pairs_hook=OrderedDict)
+    # Rows are byte strings, so the strings we compare them with should be too.
+    def to_str(value):
+        if isinstance(value, unicode):
+            return value.encode("utf-8")
+        elif isinstance(value, dict):
+            return OrderedDict((to_str(k), to_str(v)) for (k, v) in value.items())
+        elif isinstance(value, list):
+            return [to_str(v) for v in value]
+        return value
+    return to_str(rules)
 
-                new_line = "\t".join(line_list)
 
-            output_file.write(new_line)
+def uses_strategy(rules, strategy):
+    """Returns whether any column in the rules is anonymized with the given strategy."""
+    return any(spec["strategy"] == strategy for rule in rules.values() for spec in rule["columns"].values())
 
-    output_file.close()
-    return
 
+def anonymize(sql_filename, user_index=None, output_filename=None, compression_level=None, rules=None,
+              processes=None, salt=None):
+    """This function reads in the sql dump for the sidewalk project and anonymizes the columns given by the rules (by
+    default, all the email addresses and usernames). The dump may be gzip (.gz) or zstd (.zst) compressed, and the output
+    is compressed the same way.
 
-def get_user_index(email_address):
-    if email_address in get_user_index.email_to_index:
-        return get_user_index.email_to_index[email_address]
-    else:
-        current_user_index = get_user_index.user_index
-        get_user_index.email_to_index[email_address] = current_user_index
-        get_user_index.user_index += 1
-        return current_user_index
+    The rows of the tables in the rules are anonymized in pieces by a pool of processes, and put back in order. If any
+    column uses the "index" strategy, the dump is read twice: first to collect the values that need an index, which are
+    given indexes in the order they first appear in the dump (as if it were read by a single process), then to anonymize.
+
+    References:
+    http://stackoverflow.com/questions/17140886/how-to-search-and-replace-text-in-a-file-using-python
+
+    :param sql_filename:
+    :param user_index: UserIndex to assign anonymized names with (a new one if None).
+    :param output_filename: defaults to sql_filename with .sql replaced by .anonymized.sql.
+    :param compression_level: compression level of the output, if it is compressed.
+    :param rules: dict of rules, as loaded by load_rules (defaults to the ones in anonymize_rules.json).
+    :param processes: number of worker processes (defaults to the number of CPUs).
+    :param salt: salt for the "hash" strategy, which is required if any column uses it. Without a secret salt, the
+        hashes of guessable values (like usernames) can be reversed by hashing the guesses.
+    :return: the UserIndex.
+    """
+    if user_index is None:
+        user_index = UserIndex()
+    if output_filename is None:
+        output_filename = sql_filename.replace(".sql", ".anonymized.sql")
+    if rules is None:
+        rules = load_rules(DEFAULT_RULES_FILE)
+    if processes is None:
+        processes = cpu_count()
+    window = 4 * processes
+    uses_index = uses_strategy(rules, "index")
+    if uses_strategy(rules, "hash") and not salt:
+        raise ValueError("The rules use the hash strategy, which needs a salt.")
+
+    start = time.time()
+    if uses_index:
+        with instrumentation.phase("collect_index_keys") as record:
+            pool = Pool(processes, init_worker, (rules, None, salt))
+            input_file = open_dump(sql_filename, 'rb')
+            try:
+                table_pieces = (piece for piece in split_dump(input_file, rules) if piece[0] is not None)
+                for keys in map_pieces(pool, collect_index_keys, table_pieces, window):
+                    for key in keys:
+                        user_index.get(key)
+            finally:
+                input_file.close()
+                pool.terminate()
+            record["n_items"] = len(user_index)
+
+    with instrumentation.phase("anonymize_rows") as record:
+        pool = Pool(processes, init_worker, (rules, user_index.email_to_index, salt))
+        input_file = open_dump(sql_filename, 'rb')
+        output_file = open_dump(output_filename, 'wb', compression_level)
+        n_bytes = 0
+        try:
+            for data in map_pieces(pool, anonymize_rows, split_dump(input_file, rules), window):
+                output_file.write(data)
+                n_bytes += len(data)
+        finally:
+            input_file.close()
+            output_file.close()
+            pool.terminate()
+            record["n_items"] = n_bytes
+    elapsed = max(time.time() - start, 1e-9)
+    print "Wrote %.1f MB of anonymized dump in %.1fs (%.1f MB/s), %d users." % \
+          (n_bytes / 1e6, elapsed, n_bytes / 1e6 / elapsed, len(user_index))
+    return user_index
 
-get_user_index.user_index = 1
-get_user_index.email_to_index = {}
 
 if __name__ == '__main__':
-    if len(sys.argv) > 1:
-        sql_filename = sys.argv[1]
-        anonymize(sql_filename)
-    else:
+    parser = argparse.ArgumentParser(description='Anonymizes the usernames, email addresses, and other columns given by '
+                                                 'a rules file in a SQL dump.')
+    parser.add_argument('sql_filename', nargs='?', default="resources/sidewalk_20160629.sql",
+                        help='SQL dump to anonymize (.sql, .sql.gz or .sql.zst).')
+    parser.add_argument('--output', default=None,
+                        help='Where to write the anonymized dump (defaults to <name>.anonymized.sql[.gz|.zst]).')
+    parser.add_argument('--compression_level', type=int, default=None,
+                        help='Compression level of a compressed output (default 6 for gzip, 3 for zstd).')
+    parser.add_argument('--rules', default=DEFAULT_RULES_FILE,
+                        help='JSON file saying which columns of which tables to anonymize, and how.')
+    parser.add_argument('--processes', type=int, default=cpu_count(),
+                        help='Number of processes that anonymize rows (defaults to the number of CPUs).')
+    parser.add_argument('--salt', default=None,
+                        help='Secret salt for columns anonymized with the "hash" strategy (required if the rules use '
+                             'it).')
+    parser.add_argument('--load_user_index', default=None,
+                        help='JSON file with the email to index mapping from an earlier run, to stay consistent with it.')
+    parser.add_argument('--save_user_index', default=None,
+                        help='Save the email to index mapping to this JSON file.')
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+    rules = load_rules(args.rules)
+    if uses_strategy(rules, "hash") and not args.salt:
+        parser.error('the rules use the "hash" strategy, so --salt is required')
+    instrumentation.configure(args, "anonymize")
 
-        # print "Filename not specified. Usage: python anonymize.py <filename of the sql file>"
-        sql_filename = "resources/sidewalk_20160629.sql"
-        anonymize(sql_filename)
+    user_index = UserIndex.load(args.load_user_index) if args.load_user_index is not None else UserIndex()
+    anonymize(args.sql_filename, user_index, args.output, args.compression_level, rules,
+              args.processes, args.salt)
+    if args.save_user_index is not None:
+        user_index.export(args.save_user_index)
+    instrumentation.close()
+    sys.exit()
@@ -68,7 +68,8 @@ class AttributeController @Inject() (implicit val env: Environment[User, Session
   }
 
   /**
-    * Returns the set of all labels associated with the given user, in the format needed for clustering.
+    * Returns the set of all labels associated with the given user, in the format needed for clustering, followed by the
+    * fingerprints of the labels that the user's attributes of each label type were made from.
     *
     * @param key A key used for authentication.
     * @param userId The user_id of the user who's labels should be retrieved.
@@ -76,7 +77,10 @@ class AttributeController @Inject() (implicit val env: Environment[User, Session
   def getUserLabelsToCluster(key: String, userId: String) = UserAwareAction.async { implicit request =>
 
     val json = if (authenticate(key)) {
-      Json.arr(UserClusteringSessionTable.getUserLabelsToCluster(userId).map(_.toJSON))
+      Json.arr(
+        UserClusteringSessionTable.getUserLabelsToCluster(userId).map(_.toJSON),
+        Json.toJson(UserAttributeTable.getLabelsFingerprints(userId))
+      )
     } else {
       Json.obj("error_msg" -> "Could not authenticate.")
     }
@@ -126,32 +130,41 @@ class AttributeController @Inject() (implicit val env: Environment[User, Session
           val groupedLabels: Map[Int, List[AttributeFormats.ClusteredLabelSubmission]] = labels.groupBy(_.clusterNum)
           val timestamp: Timestamp = new Timestamp(Instant.now.toEpochMilli)
 
-          // Add corresponding entry to the user_clustering_session table
-          val userSessionId: Int = UserClusteringSessionTable.save(UserClusteringSession(0, userId, timestamp))
-          // Add the clusters to user_attribute table, and the associated user_attribute_labels after each cluster.
-          for (cluster <- clusters) yield {
-            val attributeId: Int =
-              UserAttributeTable.save(
-                UserAttribute(0,
-                  userSessionId,
-                  thresholds(cluster.labelType),
-                  LabelTypeTable.labelTypeToId(cluster.labelType),
-                  RegionTable.selectRegionIdOfClosestNeighborhood(cluster.lng, cluster.lat),
-                  cluster.lat,
-                  cluster.lng,
-                  cluster.severity,
-                  cluster.temporary
+          // Replace the user's results in one transaction, so the run is saved in full or not at all.
+          val userSessionId: Int = UserClusteringSessionTable.db.withTransaction { implicit session =>
+            // If only some label types were reclustered (incremental clustering), remove the old attributes of those
+            // types, and the user's earlier sessions that are left without attributes.
+            submission.replaceLabelTypes.foreach(labelTypes => UserAttributeTable.deleteUserAttributesOfTypes(userId, labelTypes))
+
+            // Add corresponding entry to the user_clustering_session table
+            val userSessionId: Int = UserClusteringSessionTable.insert(UserClusteringSession(0, userId, timestamp))
+            // Add the clusters to user_attribute table, and the associated user_attribute_labels after each cluster.
+            for (cluster <- clusters) yield {
+              val attributeId: Int =
+                UserAttributeTable.insert(
+                  UserAttribute(0,
+                    userSessionId,
+                    thresholds(cluster.labelType),
+                    LabelTypeTable.labelTypeToId(cluster.labelType),
+                    RegionTable.selectRegionIdOfClosestNeighborhood(cluster.lng, cluster.lat),
+                    cluster.lat,
+                    cluster.lng,
+                    cluster.severity,
+                    cluster.temporary,
+                    submission.fingerprints.flatMap(_.get(cluster.labelType))
+                  )
                 )
-              )
-            // Add all the labels associated with that user_attribute to the user_attribute_label table.
-            groupedLabels get cluster.clusterNum match {
-              case Some(group) =>
-                for (label <- group) yield {
-                  UserAttributeLabelTable.save(UserAttributeLabel(0, attributeId, label.labelId))
-                }
-              case None =>
-                Logger.warn("Cluster sent with no accompanying labels. Seems wrong!")
+              // Add all the labels associated with that user_attribute to the user_attribute_label table.
+              groupedLabels get cluster.clusterNum match {
+                case Some(group) =>
+                  for (label <- group) yield {
+                    UserAttributeLabelTable.insert(UserAttributeLabel(0, attributeId, label.labelId))
+                  }
+                case None =>
+                  Logger.warn("Cluster sent with no accompanying labels. Seems wrong!")
+              }
             }
+            userSessionId
           }
           Future.successful(Ok(Json.obj("session" -> userSessionId)))
         }
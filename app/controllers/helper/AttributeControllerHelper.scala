@@ -4,6 +4,7 @@ import models.attribute.{GlobalAttributeTable, GlobalClusteringSessionTable, Use
 import models.region.RegionTable
 import models.user.UserStatTable
 import play.api.libs.json.Json
+import java.io.ByteArrayInputStream
 import scala.collection.immutable.Seq
 import scala.io.Source
 import scala.sys.process._
@@ -13,10 +14,11 @@ object AttributeControllerHelper {
     * Calls the appropriate clustering function(s); either single-user clustering, multi-user clustering, or both.
     *
     * @param clusteringType One of "singleUser", "multiUser", or "both".
+    * @param incremental If true, single-user clustering only reclusters the labels that changed since the last run.
     */
-  def runClustering(clusteringType: String) = {
+  def runClustering(clusteringType: String, incremental: Boolean = false) = {
     if (clusteringType == "singleUser" || clusteringType == "both") {
-      runSingleUserClusteringAllUsers()
+      runSingleUserClusteringAllUsers(incremental)
     }
     if (clusteringType == "multiUser" || clusteringType == "both") {
       runMultiUserClusteringAllRegions()
@@ -45,11 +47,18 @@ object AttributeControllerHelper {
 
   /**
     * Runs single user clustering for each high quality user.
+    *
+    * @param incremental If true, the existing clusters are kept, and label_clustering.py only reclusters (and replaces)
+    *                    the label types of each user whose labels changed since the last run.
     */
-  def runSingleUserClusteringAllUsers() = {
+  def runSingleUserClusteringAllUsers(incremental: Boolean = false) = {
 
-    // First truncate the user_clustering_session, user_attribute, and user_attribute_label tables.
-    UserClusteringSessionTable.truncateTables()
+    // Unless running incrementally, first truncate the user_clustering_session, user_attribute, and
+    // user_attribute_label tables.
+    if (!incremental) {
+      UserClusteringSessionTable.truncateTables()
+    }
+    val clusteringArgs: List[String] = if (incremental) List("--incremental") else List()
 
     // Read key from keyfile. If we aren't able to read it, we can't do anything. :(
     val maybeKey: Option[String] = readKeyFile()
@@ -60,13 +69,13 @@ object AttributeControllerHelper {
       val nUsers = goodUsers.length
       println("N users = " + nUsers)
 
-      // Runs clustering for each good user.
-      for ((userId, i) <- goodUsers.view.zipWithIndex) {
-        println(s"Finished ${f"${100.0 * i / nUsers}%1.2f"}% of users, next: $userId.")
-        val clusteringOutput =
-          Seq("python", "label_clustering.py", "--key", key, "--user_id", userId).!!
-        //      println(clusteringOutput)
+      // When running incrementally, remove the attributes of users that are no longer clustered.
+      if (incremental) {
+        UserAttributeTable.deleteUserAttributesOfOtherUsers(goodUsers)
       }
+
+      // Runs clustering for all good users in a single Python process, which reads the jobs from stdin.
+      runClusteringJobs(key, goodUsers.map(userId => s"user_id $userId"), clusteringArgs)
       println("\nFinshed 100% of users!!\n")
     } else {
       println("Could not read keyfile, so nothing happened :(")
@@ -89,18 +98,32 @@ object AttributeControllerHelper {
       val regionIds: List[Int] = RegionTable.selectAllNeighborhoods.map(_.regionId).sortBy(x => x)
       //    val regionIds = List(199, 200, 203, 211, 261) // Small test set.
       val nRegions: Int = regionIds.length
+      println("N regions = " + nRegions)
 
-      // Runs multi-user clustering within each region.
-      for ((regionId, i) <- regionIds.view.zipWithIndex) {
-        println(s"Finished ${f"${100.0 * i / nRegions}%1.2f"}% of regions, next: $regionId.")
-        val clusteringOutput = Seq("python", "label_clustering.py", "--key", key, "--region_id", regionId.toString).!!
-      }
+      // Runs multi-user clustering for all regions in a single Python process, which reads the jobs from stdin and
+      // clusters the whole city at once, so clusters that cross region boundaries aren't split.
+      runClusteringJobs(key, regionIds.map(regionId => s"region_id $regionId"), List("--city"))
       println("\nFinshed 100% of regions!!\n\n")
     } else {
       println("Could not read keyfile, so nothing happened :(")
     }
   }
 
+  /**
+    * Runs label_clustering.py once for the whole batch of jobs, passing them on stdin (one per line) so that it only
+    * starts up and creates its pool of worker processes once. Prints the script's output, which includes the progress
+    * and timing of each job.
+    *
+    * @param key Key used by the script to authenticate with the API.
+    * @param jobs Lines of the form "user_id <user_id>" or "region_id <region_id>".
+    * @param extraArgs Additional command line arguments for the script.
+    */
+  def runClusteringJobs(key: String, jobs: List[String], extraArgs: List[String] = List()): Int = {
+    val jobInput = new ByteArrayInputStream(jobs.mkString("", "\n", "\n").getBytes("UTF-8"))
+    val command: Seq[String] = Seq("python", "label_clustering.py", "--key", key, "--stdin") ++ extraArgs
+    (command #< jobInput).!(ProcessLogger(line => println(line)))
+  }
+
   /**
     * Reads a key from a file and returns it.
     *
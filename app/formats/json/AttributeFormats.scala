@@ -10,7 +10,9 @@ object AttributeFormats {
   case class ClusterSubmission(labelType: String, clusterNum: Int, lat: Float, lng: Float, severity: Option[Int], temporary: Boolean)
   case class ClusteringSubmission(thresholds: List[ClusteringThresholdSubmission],
                                   labels: List[ClusteredLabelSubmission],
-                                  clusters: List[ClusterSubmission])
+                                  clusters: List[ClusterSubmission],
+                                  replaceLabelTypes: Option[List[String]],
+                                  fingerprints: Option[Map[String, String]])
 
 
   implicit val clusteringThresholdSubmissionReads: Reads[ClusteringThresholdSubmission] = (
@@ -36,6 +38,8 @@ object AttributeFormats {
   implicit val clusteringSubmissionReads: Reads[ClusteringSubmission] = (
     (JsPath \ "thresholds").read[List[ClusteringThresholdSubmission]] and
       (JsPath \ "labels").read[List[ClusteredLabelSubmission]] and
-      (JsPath \ "clusters").read[List[ClusterSubmission]]
+      (JsPath \ "clusters").read[List[ClusterSubmission]] and
+      (JsPath \ "replace_label_types").readNullable[List[String]] and
+      (JsPath \ "fingerprints").readNullable[Map[String, String]]
     )(ClusteringSubmission.apply _)
 }
@@ -36,6 +36,13 @@ object UserAttributeLabelTable {
   }
 
   def save(newSess: UserAttributeLabel): Int = db.withTransaction { implicit session =>
+    insert(newSess)
+  }
+
+  /**
+    * Saves a user attribute label in the given session, so that it can be part of a larger transaction.
+    */
+  def insert(newSess: UserAttributeLabel)(implicit session: Session): Int = {
     val newId: Int = (userAttributeLabels returning userAttributeLabels.map(_.userAttributeLabelId)) += newSess
     newId
   }
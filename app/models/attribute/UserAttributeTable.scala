@@ -16,7 +16,8 @@ case class UserAttribute(userAttributeId: Int,
                          lat: Float,
                          lng: Float,
                          severity: Option[Int],
-                         temporary: Boolean)
+                         temporary: Boolean,
+                         labelsFingerprint: Option[String])
 
 class UserAttributeTable(tag: Tag) extends Table[UserAttribute](tag, Some("sidewalk"), "user_attribute") {
   def userAttributeId: Column[Int] = column[Int]("user_attribute_id", O.NotNull, O.PrimaryKey, O.AutoInc)
@@ -28,6 +29,7 @@ class UserAttributeTable(tag: Tag) extends Table[UserAttribute](tag, Some("sidew
   def lng: Column[Float] = column[Float]("lng", O.NotNull)
   def severity: Column[Option[Int]] = column[Option[Int]]("severity")
   def temporary: Column[Boolean] = column[Boolean]("temporary", O.NotNull)
+  def labelsFingerprint: Column[Option[String]] = column[Option[String]]("labels_fingerprint")
 
   def * : ProvenShape[UserAttribute] = (userAttributeId,
                                         userClusteringSessionId,
@@ -36,7 +38,8 @@ class UserAttributeTable(tag: Tag) extends Table[UserAttribute](tag, Some("sidew
                                         regionId,
                                         lat, lng,
                                         severity,
-                                        temporary) <>
+                                        temporary,
+                                        labelsFingerprint) <>
     ((UserAttribute.apply _).tupled, UserAttribute.unapply)
 
   def labelType: ForeignKeyQuery[LabelTypeTable, LabelType] =
@@ -61,7 +64,73 @@ object UserAttributeTable {
   }
 
   def save(newSess: UserAttribute): Int = db.withTransaction { implicit session =>
+    insert(newSess)
+  }
+
+  /**
+    * Saves a user attribute in the given session, so that it can be part of a larger transaction.
+    */
+  def insert(newSess: UserAttribute)(implicit session: Session): Int = {
     val newId: Int = (userAttributes returning userAttributes.map(_.userAttributeId)) += newSess
     newId
   }
+
+  /**
+    * Gets the fingerprint of the labels that the user's attributes of each label type were made from.
+    *
+    * Label types are left out if any of their attributes have no fingerprint or a different one than the rest.
+    * Incremental single-user clustering reclusters the label types whose labels don't match these fingerprints.
+    */
+  def getLabelsFingerprints(userId: String): Map[String, String] = db.withSession { implicit session =>
+    val fingerprints = for {
+      _sess <- UserClusteringSessionTable.userClusteringSessions if _sess.userId === userId
+      _att <- userAttributes if _sess.userClusteringSessionId === _att.userClusteringSessionId
+      _type <- LabelTypeTable.labelTypes if _att.labelTypeId === _type.labelTypeId
+    } yield (_type.labelType, _att.labelsFingerprint)
+
+    fingerprints.list.groupBy(_._1).mapValues(_.map(_._2).distinct).collect {
+      case (labelType, List(Some(fingerprint))) => (labelType, fingerprint)
+    }
+  }
+
+  /**
+    * Deletes the user's attributes of the given label types, along with the rows that reference them, and then the
+    * user's clustering sessions that have no attributes left.
+    *
+    * Used by incremental single-user clustering, which only resubmits the label types whose labels have changed. Runs in
+    * the given session, so that the new attributes can be saved in the same transaction.
+    */
+  def deleteUserAttributesOfTypes(userId: String, labelTypes: List[String])(implicit session: Session): Int = {
+    val attributeIds: List[Int] = (for {
+      _sess <- UserClusteringSessionTable.userClusteringSessions if _sess.userId === userId
+      _att <- userAttributes if _sess.userClusteringSessionId === _att.userClusteringSessionId
+      _type <- LabelTypeTable.labelTypes if _att.labelTypeId === _type.labelTypeId
+      if _type.labelType inSet labelTypes
+    } yield _att.userAttributeId).list
+
+    GlobalAttributeUserAttributeTable.globalAttributeUserAttributes.filter(_.userAttributeId inSet attributeIds).delete
+    UserAttributeLabelTable.userAttributeLabels.filter(_.userAttributeId inSet attributeIds).delete
+    val nDeleted: Int = userAttributes.filter(_.userAttributeId inSet attributeIds).delete
+    UserClusteringSessionTable.deleteEmptySessions(userId)
+    nDeleted
+  }
+
+  /**
+    * Deletes the attributes (and clustering sessions) of all users other than the given ones.
+    *
+    * Used by incremental single-user clustering, which doesn't truncate the tables, to remove the attributes of users
+    * that are no longer clustered.
+    */
+  def deleteUserAttributesOfOtherUsers(userIds: List[String]): Int = db.withTransaction { implicit session =>
+    val sessionIds: List[Int] =
+      UserClusteringSessionTable.userClusteringSessions.filterNot(_.userId inSet userIds).map(_.userClusteringSessionId).list
+    val attributeIds: List[Int] =
+      userAttributes.filter(_.userClusteringSessionId inSet sessionIds).map(_.userAttributeId).list
+
+    GlobalAttributeUserAttributeTable.globalAttributeUserAttributes.filter(_.userAttributeId inSet attributeIds).delete
+    UserAttributeLabelTable.userAttributeLabels.filter(_.userAttributeId inSet attributeIds).delete
+    val nDeleted: Int = userAttributes.filter(_.userAttributeId inSet attributeIds).delete
+    UserClusteringSessionTable.userClusteringSessions.filter(_.userClusteringSessionId inSet sessionIds).delete
+    nDeleted
+  }
 }
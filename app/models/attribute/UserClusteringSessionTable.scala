@@ -117,7 +117,25 @@ object UserClusteringSessionTable {
   }
 
   def save(newSess: UserClusteringSession): Int = db.withTransaction { implicit session =>
+    insert(newSess)
+  }
+
+  /**
+    * Saves a user clustering session in the given session, so that it can be part of a larger transaction.
+    */
+  def insert(newSess: UserClusteringSession)(implicit session: Session): Int = {
     val newId: Int = (userClusteringSessions returning userClusteringSessions.map(_.userClusteringSessionId)) += newSess
     newId
   }
+
+  /**
+    * Deletes the user's clustering sessions that have no attributes, in the given session.
+    */
+  def deleteEmptySessions(userId: String)(implicit session: Session): Int = {
+    val sessionIdsWithAttributes = UserAttributeTable.userAttributes.map(_.userClusteringSessionId)
+    userClusteringSessions
+      .filter(_.userId === userId)
+      .filterNot(_.userClusteringSessionId in sessionIdsWithAttributes)
+      .delete
+  }
 }
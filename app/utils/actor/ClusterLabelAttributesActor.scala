@@ -59,7 +59,8 @@ class ClusterLabelAttributesActor extends Actor {
 
       val currentTimeStart: String = dateFormatter.format(Calendar.getInstance(TIMEZONE).getTime)
       Logger.info(s"Auto-scheduled clustering of label attributes starting at: $currentTimeStart")
-      AttributeControllerHelper.runClustering("both")
+      // Single-user clustering is incremental, so only the users who added or changed labels get reclustered.
+      AttributeControllerHelper.runClustering("both", incremental = true)
       val currentEndTime: String = dateFormatter.format(Calendar.getInstance(TIMEZONE).getTime)
       Logger.info(s"Label attribute clustering completed at: $currentEndTime")
   }
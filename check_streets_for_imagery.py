@@ -1,25 +1,321 @@
 import requests
+import numpy as np
 import pandas as pd
-from pandas.io.json import json_normalize
 import sys
 import os.path
+import argparse
+import threading
+import time
+import sqlite3
+import fcntl
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import instrumentation
 
 # Create CSV from street_edge table with street_edge_id, x1, y1, x2, y2
 # Name it street_edge_endpoints.csv and put it in the root directory, then run this script.
 # It will output a CSV called streets_with_no_imagery.csv. Use this to mark those edges as "deleted" in the database.
+#
+# Streets share endpoints at intersections, so the unique endpoints are collected first (optionally snapped to a grid of
+# --snap_meters, which should be well under the 25m search radius) and each is checked once. Their statuses are kept in
+# an SQLite cache (--cache_file) for --cache_ttl_days, so re-runs only query endpoints that are new or stale. Endpoints
+# are checked concurrently (--concurrency requests in flight), while staying under --rate metadata requests per second.
+# Requests that fail with a connection error, a timeout, a 5xx response or a transient status from the API are retried
+# with exponential backoff, and any other status that doesn't say whether there is imagery (like REQUEST_DENIED) stops
+# the run. To test against a local fake metadata endpoint, run clustering_stand_in_server.py and pass
+# --metadata_url http://localhost:9000/maps/api/streetview/metadata.
+#
+# The verdict for every street is appended to a progress log (--progress_log) as it is checked, so a run that crashes or
+# is killed resumes exactly where it stopped. Several processes can check the streets together by each being given a
+# different --shard (out of --num_shards). Shards are made of whole regions, so few endpoints are checked by more than
+# one process. The output is written by whichever process finds every street in the log.
+
+DEFAULT_METADATA_URL = 'https://maps.googleapis.com/maps/api/streetview/metadata'
+
+# Statuses from the metadata API that say whether there is imagery at a location. Of the others, TRANSIENT_STATUSES
+# mean "try again later", and the rest (like REQUEST_DENIED or INVALID_REQUEST) mean the requests themselves are wrong.
+VERDICT_STATUSES = ['OK', 'ZERO_RESULTS', 'NOT_FOUND']
+TRANSIENT_STATUSES = ['OVER_QUERY_LIMIT', 'UNKNOWN_ERROR']
+
+METERS_PER_DEGREE_LAT = 111320.0
+
+# Number of streets whose verdicts (and endpoint statuses) are written to the progress log (and cache) at a time.
+BATCH_SIZE = 500
+
+PROGRESS_LOG_COLS = ['street_edge_id', 'region_id', 'no_imagery']
+
+# Token bucket rate limiter: lets through `rate` calls per second on average, with bursts of up to `capacity` calls.
+# Safe to share between threads.
+class TokenBucket(object):
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(1, rate))
+        self.tokens = self.capacity
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    # Blocks until a call is allowed.
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+# Checks whether there is Street View imagery near points using the metadata API, sharing one pool of keep-alive
+# connections and one rate limit between threads.
+class ImageryChecker(object):
+    def __init__(self, api_key, metadata_url=DEFAULT_METADATA_URL, rate=50, retries=5, backoff=1.0, timeout=30,
+                 pool_size=10):
+        self.url = metadata_url + '?source=outdoor&radius=25&key=' + api_key
+        self.limiter = TokenBucket(rate)
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.n_requests = 0
+        self.lock = threading.Lock()
+
+    # Returns the metadata API's status for a "<lat>,<lng>" location: 'OK' if there is imagery, 'ZERO_RESULTS' if not
+    # (or 'NOT_FOUND'). Raises an error if the API answers with any other status that isn't transient, since retrying
+    # won't help, and the status says nothing about the imagery.
+    def location_status(self, location):
+        for attempt in range(self.retries + 1):
+            self.limiter.acquire()
+            with self.lock:
+                self.n_requests += 1
+            try:
+                response = self.session.get(self.url + '&location=' + location, timeout=self.timeout)
+                if response.status_code < 500:
+                    response.raise_for_status()
+                    metadata = response.json()
+                    status = metadata['status']
+                    if status in VERDICT_STATUSES:
+                        return status
+                    if status not in TRANSIENT_STATUSES:
+                        raise requests.exceptions.RequestException('Metadata request failed with status %s: %s' %
+                                                                   (status, metadata.get('error_message', '')))
+                    error = status
+                else:
+                    error = '%d response from server' % response.status_code
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                error = e
+            if attempt < self.retries:
+                time.sleep(self.backoff * 2 ** attempt)
+        raise requests.exceptions.RequestException('Metadata request failed after %d attempts: %s' %
+                                                   (self.retries + 1, error))
+
+# Statuses of "<lat>,<lng>" locations from the metadata API, kept in an SQLite file. Only VERDICT_STATUSES are kept.
+# Statuses older than ttl_days (or that aren't verdicts, from older versions of this script) are treated as missing, so
+# they get checked again.
+class ImageryCache(object):
+    def __init__(self, path, ttl_days):
+        self.conn = sqlite3.connect(path)
+        self.ttl = ttl_days * 24 * 60 * 60
+        self.conn.execute('CREATE TABLE IF NOT EXISTS endpoint_status ('
+                          'location TEXT PRIMARY KEY, status TEXT NOT NULL, checked_at REAL NOT NULL)')
+        self.conn.commit()
+
+    # Returns a dict from location to status, for all the locations with a status that hasn't expired.
+    def get_statuses(self):
+        rows = self.conn.execute('SELECT location, status FROM endpoint_status WHERE checked_at >= ? AND status IN (' +
+                                 ', '.join('?' * len(VERDICT_STATUSES)) + ')',
+                                 [time.time() - self.ttl] + VERDICT_STATUSES)
+        return dict(rows)
+
+    # Saves a list of (location, status) tuples, skipping any status that isn't a verdict.
+    def put(self, statuses):
+        now = time.time()
+        self.conn.executemany('INSERT OR REPLACE INTO endpoint_status (location, status, checked_at) VALUES (?, ?, ?)',
+                              [(location, status, now) for (location, status) in statuses
+                               if status in VERDICT_STATUSES])
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+# Moves points to the centers of the cells of a grid with cells of about snap_meters on a side, so endpoints that are
+# within a few meters of each other (like the ends of streets that meet at an intersection) become the same point. The
+# width of the cells in degrees of longitude is the one at ref_lat.
+def snap_to_grid(lat, lng, snap_meters, ref_lat):
+    lat_step = snap_meters / METERS_PER_DEGREE_LAT
+    lng_step = snap_meters / (METERS_PER_DEGREE_LAT * np.cos(np.radians(ref_lat)))
+    return (np.round((np.floor(lat / lat_step) + 0.5) * lat_step, 7),
+            np.round((np.floor(lng / lng_step) + 0.5) * lng_step, 7))
+
+# Returns arrays with the "<lat>,<lng>" locations to check for the first and second endpoint of each street.
+def endpoint_locations(street_data, snap_meters=0):
+    endpoints = []
+    ref_lat = np.nanmean(np.concatenate([street_data.y1.values, street_data.y2.values]))
+    for (lat, lng) in [(street_data.y1.values, street_data.x1.values), (street_data.y2.values, street_data.x2.values)]:
+        if snap_meters > 0:
+            (lat, lng) = snap_to_grid(lat, lng, snap_meters, ref_lat)
+        endpoints.append(np.array([str(y) + ',' + str(x) for (y, x) in zip(lat, lng)], dtype=object))
+    return endpoints
+
+# Checks the locations using up to `concurrency` threads, yielding (location, status) for each location in order. Up to
+# `window` locations are queued or in flight at once, which lets the other threads keep going while one location is
+# waiting to be retried. If the caller stops early (or a check fails), the locations that haven't started are dropped,
+# and (location, status) tuples for the ones that were already checked but not yielded are added to `leftovers`.
+def check_locations(locations, checker, concurrency, window=1000, leftovers=None):
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        pending = deque()
+        try:
+            for location in locations:
+                pending.append((location, executor.submit(checker.location_status, location)))
+                while len(pending) >= window or (len(pending) > 0 and pending[0][1].done()):
+                    (l, future) = pending.popleft()
+                    yield (l, future.result())
+            while len(pending) > 0:
+                (l, future) = pending.popleft()
+                yield (l, future.result())
+        finally:
+            for (l, future) in pending:
+                if not future.cancel() and leftovers is not None:
+                    try:
+                        leftovers.append((l, future.result()))
+                    except Exception:
+                        pass
+
+# Append-only log of the verdict for every street that has been checked, one "street_edge_id,region_id,no_imagery" line
+# per street. Lines are written in batches while holding an exclusive lock on the file, so several processes (e.g.
+# checking different shards) can share one log.
+class ProgressLog(object):
+    def __init__(self, path):
+        self.path = path
+        self.n_appended = 0
+
+    # Returns the verdicts logged so far as a DataFrame. A line cut short by a crash is ignored.
+    def read(self):
+        if not os.path.isfile(self.path):
+            return pd.DataFrame(columns=PROGRESS_LOG_COLS)
+        with open(self.path) as f:
+            fcntl.flock(f, fcntl.LOCK_SH)
+            log = pd.read_csv(f, names=PROGRESS_LOG_COLS, error_bad_lines=False, warn_bad_lines=False)
+            fcntl.flock(f, fcntl.LOCK_UN)
+        log = log.apply(pd.to_numeric, errors='coerce').dropna().astype('int64')
+        return log.drop_duplicates('street_edge_id', keep='last')
+
+    # Appends (street_edge_id, region_id, no_imagery) tuples to the log, and makes sure they are on disk.
+    def append(self, rows):
+        if len(rows) == 0:
+            return
+        lines = ''.join('%d,%d,%d\n' % (edge, region, no_imagery) for (edge, region, no_imagery) in rows)
+        with open(self.path, 'a+b') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            # If the last write was cut short, start on a new line so that only that line is lost.
+            f.seek(0, os.SEEK_END)
+            if f.tell() > 0:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != '\n':
+                    lines = '\n' + lines
+            f.write(lines)
+            f.flush()
+            os.fsync(f.fileno())
+            fcntl.flock(f, fcntl.LOCK_UN)
+        self.n_appended += len(rows)
+
+# Checks the streets, writing the verdict for each to the progress log (and the status of each endpoint to the cache)
+# in batches. Endpoints are checked in the order the streets need them, and each street is logged as soon as both its
+# endpoints are known. Endpoint statuses come from the cache or location_status, so they are always verdicts.
+def check_streets(street_data, checker, cache, progress_log, concurrency, snap_meters):
+    (first_endpoints, second_endpoints) = endpoint_locations(street_data, snap_meters)
+    statuses = cache.get_statuses()
+    locations = pd.unique(np.column_stack([first_endpoints, second_endpoints]).ravel())
+    to_check = [location for location in locations if location not in statuses]
+    print '%d streets have %d unique endpoints, %d of which need to be checked.' % \
+          (len(street_data), len(locations), len(to_check))
+
+    # A street is ready once the last of its endpoints that needs checking has been checked (-1 if none of them do).
+    position = pd.Series(np.arange(len(to_check)), index=to_check)
+    ready_after = np.maximum(position.reindex(first_endpoints).fillna(-1).values,
+                             position.reindex(second_endpoints).fillna(-1).values)
+    order = np.argsort(ready_after, kind='mergesort')
+    sorted_ready_after = ready_after[order]
+    edge_ids = street_data.street_edge_id.values
+    region_ids = street_data.region_id.values
+    state = {'next': 0, 'n_checked': 0, 'statuses': [], 'verdicts': []}
+
+    # Logs the verdicts for the streets that became ready once the first n_checked endpoints were checked.
+    def log_ready_streets(n_checked, flush=False):
+        stop = np.searchsorted(sorted_ready_after, n_checked - 1, side='right')
+        for i in order[state['next']:stop]:
+            no_imagery = statuses[first_endpoints[i]] == 'ZERO_RESULTS' or \
+                         statuses[second_endpoints[i]] == 'ZERO_RESULTS'
+            state['verdicts'].append((edge_ids[i], region_ids[i], no_imagery))
+        state['next'] = stop
+        if flush or len(state['verdicts']) >= BATCH_SIZE:
+            # The cache is written first, so any logged street's endpoints are always cached.
+            cache.put(state['statuses'])
+            progress_log.append(state['verdicts'])
+            state['statuses'] = []
+            state['verdicts'] = []
+
+    leftovers = []
+    try:
+        log_ready_streets(0)
+        for (index, (location, status)) in enumerate(check_locations(to_check, checker, concurrency,
+                                                                     leftovers=leftovers)):
+            # Print a progress percentage.
+            percent_complete = 100 * round(float(index + 1) / len(to_check), 4)
+            sys.stdout.write("\r%.2f%% complete" % percent_complete)
+            sys.stdout.flush()
+
+            statuses[location] = status
+            state['statuses'].append((location, status))
+            state['n_checked'] = index + 1
+            log_ready_streets(state['n_checked'])
+    finally:
+        state['statuses'] += leftovers
+        log_ready_streets(state['n_checked'], flush=True)
+
+def write_output(streets_with_no_imagery):
+    streets_with_no_imagery = streets_with_no_imagery.filter(items=['street_edge_id', 'region_id'])
 
-def write_output():
-    print # Adds newline after the progress percentage.
     # Convert street_edge_id column from float to int.
     streets_with_no_imagery.street_edge_id = streets_with_no_imagery.street_edge_id.astype('int32')
     streets_with_no_imagery.region_id = streets_with_no_imagery.region_id.astype('int32')
 
     # Output both_endpoints_data and one_endpoint_data as CSVs.
-    streets_with_no_imagery.to_csv('streets_with_no_imagery.csv', mode='a', header=incl_headers, index=False)
+    streets_with_no_imagery.to_csv('streets_with_no_imagery.csv', index=False)
 
 
 if __name__ == '__main__':
 
+    parser = argparse.ArgumentParser(description='Finds streets that have no Street View imagery at an endpoint.')
+    parser.add_argument('--concurrency', type=int, default=16,
+                        help='Max number of metadata requests in flight at once.')
+    parser.add_argument('--rate', type=float, default=50,
+                        help='Max number of metadata requests per second (keep under the API quota).')
+    parser.add_argument('--retries', type=int, default=5,
+                        help='Number of times to retry a metadata request that failed in a transient way.')
+    parser.add_argument('--metadata_url', type=str, default=DEFAULT_METADATA_URL,
+                        help='URL of the Street View metadata API (or a fake one, for testing).')
+    parser.add_argument('--snap_meters', type=float, default=0,
+                        help='Snap endpoints to a grid with cells of this many meters, so endpoints that are this '
+                             'close are only checked once (0 to only merge identical endpoints).')
+    parser.add_argument('--cache_file', type=str, default='imagery_metadata_cache.db',
+                        help='SQLite file where the status of each checked endpoint is kept.')
+    parser.add_argument('--cache_ttl_days', type=float, default=30,
+                        help='Number of days after which a cached endpoint status is checked again.')
+    parser.add_argument('--progress_log', type=str, default='imagery_progress.log',
+                        help='Append-only log of the verdict for each street checked, used to resume.')
+    parser.add_argument('--shard', type=int, default=0,
+                        help='Only check streets whose region_id %% num_shards is this (to run several processes).')
+    parser.add_argument('--num_shards', type=int, default=1,
+                        help='Number of shards the streets are split into.')
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+    instrumentation.configure(args, 'check_streets_for_imagery')
+
     # Read google maps API key from file.
     try:
         with open("google_maps_api_key.txt", "r") as api_key_file:
@@ -29,45 +325,45 @@ if __name__ == '__main__':
         exit(1)
 
     # Read street edge data from CSV.
-    street_data = pd.read_csv('street_edge_endpoints.csv')
-    street_data = street_data.sort_values(by=['region_id', 'street_edge_id'])
-    n_streets = len(street_data)
-    street_data['id'] = range(1, n_streets + 1)
-
-    # Create dataframe that will hold output data.
-    streets_with_no_imagery = pd.DataFrame(columns=['street_edge_id', 'region_id'])
-
-    # Get current progress and remove data we've already checked.
-    incl_headers = True
-    if os.path.isfile('streets_with_no_imagery.csv'):
-        no_imagery_progress_data = pd.read_csv('streets_with_no_imagery.csv')
-        progress = no_imagery_progress_data.iloc[-1]['street_edge_id']
-        progress_index = int(street_data[street_data.street_edge_id == progress]['id'])
-        street_data = street_data[street_data.id > progress_index]
-        incl_headers = False
-
-    street_data = street_data.set_index('id')
-    for index, street in street_data.iterrows():
-        # Print a progress percentage.
-        percent_complete = 100 * round(float(index) / n_streets, 4)
-        sys.stdout.write("\r%.2f%% complete" % percent_complete)
-        sys.stdout.flush()
-
-        # Check if there is imagery at each endpoint.
-        gsv_url = 'https://maps.googleapis.com/maps/api/streetview/metadata?source=outdoor&radius=25&key=' + api_key
-        try:
-            first_endpoint = requests.get(gsv_url + '&location=' + str(street.y1) + ',' + str(street.x1))
-            second_endpoint = requests.get(gsv_url + '&location=' + str(street.y2) + ',' + str(street.x2))
-        except (requests.exceptions.RequestException, KeyboardInterrupt) as e:
-            write_output()
-            print e
-            exit(1)
+    with instrumentation.phase('read_streets') as record:
+        street_data = pd.read_csv('street_edge_endpoints.csv')
+        street_data = street_data.sort_values(by=['region_id', 'street_edge_id'])
 
-        first_endpoint_status = json_normalize(first_endpoint.json()).status[0]
-        second_endpoint_status = json_normalize(second_endpoint.json()).status[0]
+        # Skip the streets that are already in the progress log, and the ones in other shards.
+        progress_log = ProgressLog(args.progress_log)
+        done = progress_log.read()
+        to_check = street_data[~street_data.street_edge_id.isin(done.street_edge_id) &
+                               (street_data.region_id % args.num_shards == args.shard)]
+        record.update(n_items=len(street_data), n_to_check=len(to_check))
 
-        # If there is no GSV data at either endpoint, add to streets_with_no_imagery.
-        if first_endpoint_status == 'ZERO_RESULTS' or second_endpoint_status == 'ZERO_RESULTS':
-            streets_with_no_imagery = streets_with_no_imagery.append({'street_edge_id': street.street_edge_id, 'region_id': street.region_id}, ignore_index=True)
+    cache = ImageryCache(args.cache_file, args.cache_ttl_days)
+    checker = ImageryChecker(api_key, args.metadata_url, args.rate, args.retries, pool_size=args.concurrency)
+    start = time.time()
+    try:
+        with instrumentation.phase('check_streets') as record:
+            try:
+                check_streets(to_check, checker, cache, progress_log, args.concurrency, args.snap_meters)
+            finally:
+                record.update(n_items=progress_log.n_appended, n_requests=checker.n_requests)
+    except (requests.exceptions.RequestException, KeyboardInterrupt) as e:
+        # Everything checked so far is in the progress log, so the next run picks up from here.
+        print
+        print e
+        exit(1)
+    finally:
+        cache.close()
+        elapsed = max(time.time() - start, 1e-9)
+        print
+        print 'Checked %d streets in %.1fs (%.1f streets/s) with %d API calls (%.1f calls/s).' % \
+              (progress_log.n_appended, elapsed, progress_log.n_appended / elapsed, checker.n_requests,
+               checker.n_requests / elapsed)
 
-    write_output()
+    # Once every street has been checked (by this run, earlier runs, or other shards), write the output.
+    done = progress_log.read()
+    n_unchecked = (~street_data.street_edge_id.isin(done.street_edge_id)).sum()
+    if n_unchecked > 0:
+        print '%d streets in other shards have not been checked yet.' % n_unchecked
+    else:
+        no_imagery = done[done.no_imagery == 1].street_edge_id
+        with instrumentation.phase('write_output', n_items=len(no_imagery)):
+            write_output(street_data[street_data.street_edge_id.isin(no_imagery)])
@@ -0,0 +1,245 @@
+import BaseHTTPServer
+import SocketServer
+import argparse
+import gzip
+import json
+import os
+import random
+import threading
+import time
+import urlparse
+import zlib
+import hashlib
+from StringIO import StringIO
+
+# Stand-in for the clustering API of the Play server, so label_clustering.py can be run end-to-end offline. Serves
+#   GET  /userLabelsToCluster?key=&userId=
+#   GET  /clusteredLabelsInRegion?key=&regionId=
+#   POST /singleUserClusteringResults?key=&userId=
+#   POST /multiUserClusteringResults?key=&regionId=
+# from a fixtures file, or from a synthetic city made with label_clustering_benchmark.generate_city. Responses are
+# gzipped if the client accepts it, and posted bodies may be chunked and/or gzipped. Posted results are checked and
+# counted, and saved to --output_dir if given. The number of requests and bytes is printed when the server stops.
+#
+# It also fakes the Street View metadata API used by check_streets_for_imagery.py, at
+#   GET  /maps/api/streetview/metadata?location=<lat>,<lng>&...
+# Whether a location has imagery is decided by a hash of the location, so it is the same on every run. A fraction
+# (--metadata_error_rate) of the requests get an OVER_QUERY_LIMIT status, to exercise retries.
+#
+# The fixtures file is JSON of the form {"users": {"<user_id>": [<label>, ...]}, "regions": {"<region_id>": [...]}},
+# where each label is an object like the ones returned by the real endpoints: user_id, label_id, label_type, lat, lng,
+# severity, temporary.
+#
+# Usage: python clustering_stand_in_server.py [--port 9000] [--fixtures fixtures.json | --generate 20000]
+#                                             [--n_users 50] [--n_regions 10] [--save_fixtures fixtures.json]
+#                                             [--output_dir posts/] [--key KEY]
+#        python label_clustering.py --key KEY --base_url http://localhost:9000 --region_id 1 ...
+#        python check_streets_for_imagery.py --metadata_url http://localhost:9000/maps/api/streetview/metadata
+
+# Makes fixtures from a synthetic city of n labels placed by n_users users. The region endpoints get the same labels,
+# split into n_regions strips of longitude, with the problem label types merged into 'Problem' as they are after
+# single-user clustering.
+def generate_fixtures(n, n_users, n_regions, seed=0):
+    from label_clustering_benchmark import generate_city
+    from label_clustering import SINGLE_USER_PROBLEM_TYPES
+    city = generate_city(n, n_users=n_users, single_user=True, seed=seed)
+    city['severity'] = city.severity.where(city.severity.notnull(), None)
+    city['temporary'] = city.temporary.fillna(False)
+    records = json.loads(city.to_json(orient='records'))
+
+    lngs = sorted(r['lng'] for r in records)
+    edges = [lngs[len(lngs) * i // n_regions] for i in range(1, n_regions)]
+    fixtures = {'users': {}, 'regions': dict((str(i + 1), []) for i in range(n_regions))}
+    for r in records:
+        fixtures['users'].setdefault(r['user_id'], []).append(r)
+        region_id = 1 + sum(r['lng'] >= edge for edge in edges)
+        problem = r['label_type'] in SINGLE_USER_PROBLEM_TYPES
+        fixtures['regions'][str(region_id)].append(dict(r, label_type='Problem' if problem else r['label_type']))
+    return fixtures
+
+class StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # Keep connections alive, like the Play server.
+    disable_nagle_algorithm = True # Otherwise each response on a kept-alive connection is delayed by ~40ms.
+
+    def do_GET(self):
+        (path, params) = self.parse_path()
+        if path == '/maps/api/streetview/metadata':
+            return self.respond(200, self.server.metadata(params.get('location', '')))
+        if not self.authenticate(params):
+            return
+        if path == '/userLabelsToCluster':
+            labels = self.server.fixtures['users'].get(params.get('userId', ''), [])
+        elif path == '/clusteredLabelsInRegion':
+            labels = self.server.fixtures['regions'].get(params.get('regionId', ''), [])
+        else:
+            return self.respond(404, {'error_msg': 'Not found.'})
+        self.respond(200, [labels])
+
+    def do_POST(self):
+        (path, params) = self.parse_path()
+        body = self.read_body()
+        if not self.authenticate(params):
+            return
+        if path == '/singleUserClusteringResults':
+            name = 'user_' + params.get('userId', '')
+        elif path == '/multiUserClusteringResults':
+            name = 'region_' + params.get('regionId', '')
+        else:
+            return self.respond(404, {'error_msg': 'Not found.'})
+
+        try:
+            submission = json.loads(body)
+            n_labels = len(submission['labels'])
+            n_clusters = len(submission['clusters'])
+            submission['thresholds']
+        except (ValueError, KeyError, TypeError):
+            return self.respond(400, {'status': 'Error', 'message': 'Could not parse clustering results.'})
+
+        self.server.record_post(n_labels, n_clusters)
+        if self.server.output_dir is not None:
+            with open(os.path.join(self.server.output_dir, name + '.json'), 'w') as f:
+                f.write(body)
+        self.respond(200, {})
+
+    def parse_path(self):
+        url = urlparse.urlparse(self.path)
+        return (url.path, dict((k, v[0]) for (k, v) in urlparse.parse_qs(url.query).items()))
+
+    def authenticate(self, params):
+        if self.server.key is not None and params.get('key') != self.server.key:
+            self.respond(200, {'error_msg': 'Could not authenticate.'})
+            return False
+        return True
+
+    # Reads the body of the request, which may be sent with chunked transfer encoding and may be gzipped.
+    def read_body(self):
+        if self.headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(';')[0].strip(), 16)
+                if size == 0:
+                    while self.rfile.readline().strip():
+                        pass
+                    break
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+            body = ''.join(chunks)
+        else:
+            body = self.rfile.read(int(self.headers.get('content-length', 0)))
+        self.server.record_bytes_in(len(body))
+        if self.headers.get('content-encoding', '').lower() == 'gzip':
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        return body
+
+    def respond(self, status, data):
+        body = json.dumps(data)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        if 'gzip' in self.headers.get('accept-encoding', ''):
+            buf = StringIO()
+            with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=6) as f:
+                f.write(body)
+            body = buf.getvalue()
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.record_bytes_out(len(body))
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+class StandInServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port, fixtures, key=None, output_dir=None, verbose=False, no_imagery_fraction=0.05,
+                 metadata_error_rate=0.0):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port), StandInHandler)
+        self.fixtures = fixtures
+        self.no_imagery_fraction = no_imagery_fraction
+        self.metadata_error_rate = metadata_error_rate
+        self.key = key
+        self.output_dir = output_dir
+        self.verbose = verbose
+        self.lock = threading.Lock()
+        self.stats = {'bytes_in': 0, 'bytes_out': 0, 'posts': 0, 'labels': 0, 'clusters': 0, 'metadata': 0}
+
+    # Fake Street View metadata for a "<lat>,<lng>" location.
+    def metadata(self, location):
+        with self.lock:
+            self.stats['metadata'] += 1
+        if random.random() < self.metadata_error_rate:
+            return {'status': 'OVER_QUERY_LIMIT'}
+        if int(hashlib.md5(location).hexdigest()[:8], 16) / float(0xffffffff) < self.no_imagery_fraction:
+            return {'status': 'ZERO_RESULTS'}
+        (lat, lng) = location.split(',')
+        return {'status': 'OK', 'location': {'lat': float(lat), 'lng': float(lng)}, 'pano_id': hashlib.md5(location).hexdigest()}
+
+    def record_bytes_in(self, n):
+        with self.lock:
+            self.stats['bytes_in'] += n
+
+    def record_bytes_out(self, n):
+        with self.lock:
+            self.stats['bytes_out'] += n
+
+    def record_post(self, n_labels, n_clusters):
+        with self.lock:
+            self.stats['posts'] += 1
+            self.stats['labels'] += n_labels
+            self.stats['clusters'] += n_clusters
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serves the clustering API of the Play server from fixtures.')
+    parser.add_argument('--port', type=int, default=9000,
+                        help='Port to listen on (on localhost).')
+    parser.add_argument('--fixtures', type=str, default=None,
+                        help='JSON file with the labels of each user and region.')
+    parser.add_argument('--generate', type=int, default=20000,
+                        help='Without --fixtures, the number of labels in the synthetic city to serve.')
+    parser.add_argument('--n_users', type=int, default=50,
+                        help='Number of users in the synthetic city.')
+    parser.add_argument('--n_regions', type=int, default=10,
+                        help='Number of regions in the synthetic city.')
+    parser.add_argument('--save_fixtures', type=str, default=None,
+                        help='Save the synthetic city to this file, to be used with --fixtures.')
+    parser.add_argument('--output_dir', type=str, default=None,
+                        help='Save the body of each POST request to a file in this directory.')
+    parser.add_argument('--key', type=str, default=None,
+                        help='Only accept requests with this key.')
+    parser.add_argument('--no_imagery_fraction', type=float, default=0.05,
+                        help='Fraction of locations that the fake metadata API says have no imagery.')
+    parser.add_argument('--metadata_error_rate', type=float, default=0.0,
+                        help='Fraction of fake metadata requests that get an OVER_QUERY_LIMIT status.')
+    parser.add_argument('--verbose', action='store_true',
+                        help='Log each request.')
+    args = parser.parse_args()
+
+    if args.fixtures is not None:
+        with open(args.fixtures) as f:
+            fixtures = json.load(f)
+    else:
+        fixtures = generate_fixtures(args.generate, args.n_users, args.n_regions)
+        if args.save_fixtures is not None:
+            with open(args.save_fixtures, 'w') as f:
+                json.dump(fixtures, f)
+    if args.output_dir is not None and not os.path.isdir(args.output_dir):
+        os.makedirs(args.output_dir)
+
+    server = StandInServer(args.port, fixtures, args.key, args.output_dir, args.verbose, args.no_imagery_fraction,
+                           args.metadata_error_rate)
+    print 'Serving %d users and %d regions on localhost:%d' % \
+          (len(fixtures['users']), len(fixtures['regions']), args.port)
+    start = time.time()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    elapsed = time.time() - start
+    print 'Received %d posts (%d labels, %d clusters) and %d metadata requests: %.1f MB in, %.1f MB out in %.1fs.' % \
+          (server.stats['posts'], server.stats['labels'], server.stats['clusters'], server.stats['metadata'],
+           server.stats['bytes_in'] / 1e6, server.stats['bytes_out'] / 1e6, elapsed)
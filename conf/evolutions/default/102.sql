@@ -0,0 +1,5 @@
+# --- !Ups
+ALTER TABLE user_attribute ADD COLUMN labels_fingerprint TEXT;
+
+# --- !Downs
+ALTER TABLE user_attribute DROP COLUMN labels_fingerprint;
@@ -1,88 +1,180 @@
 from connect import *
 
 import psycopg2.extras
+import botocore.exceptions
 from datetime import datetime
 from datetime import timedelta
 
 import os
+import argparse
+import csv
 import time
 import pandas as pd
 from pprint import pprint
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import instrumentation
 
-try:
-    # Connect to PostgreSQL database
-    conn, engine = connect_to_db()
-
-    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-
-    # Get the list of all MTurk assignments and confirmation codes from the amt_assignment table here
-    cur.execute("""SELECT hit_id, assignment_id, turker_id, confirmation_code from sidewalk.amt_assignment""")
-    amt_assignment_rows = cur.fetchall()
-    existing_hits = map(lambda x: x["hit_id"], amt_assignment_rows)
-
-    existing_assignments_dict = { x["assignment_id"]:x for x in amt_assignment_rows}
-
-    mturk = connect_to_mturk()
-
-    # all newly approved assignments will be added to this dataframe, then
-    # written out to a csv
-    csv_cols = ['HITId','AssignmentId', 'WorkerId',
-                'AssignmentStatus', 'Answer', 'AcceptTime', 'SubmitTime']
-    new_approvals = pd.DataFrame(columns=csv_cols)
-    i = 0
-    
-    '''
-    list_reviewable_hits() gets all HITs that are ready to be reviewed from Amazon, stored in a dict.
-    We call list_assignments_for_hit() to get those assignments using the HIT ID. 
-    We can then approve/reject each assignment depending on whether it is present in the amt_assignment table 
-    and if the user has submitted the correct confirmation code. When we
-    call approve_assignment(AsmtID), the turker is automatically paid and MTurk fees are debited.
-    
-    See the following for API reference and python bindings, respectively.
-    http://docs.aws.amazon.com/AWSMechTurk/latest/AWSMturkAPI/ApiReference_OperationsArticle.html
-    https://boto3.readthedocs.io/en/latest/reference/services/mturk.html
-    '''
-
-    hits_to_review = mturk.list_reviewable_hits()
-    relevant_hits_to_review = [hit for hit in hits_to_review['HITs'] if hit['HITId'] in existing_hits]
-
-    if len(relevant_hits_to_review) == 0:
+'''
+list_reviewable_hits() gets all HITs that are ready to be reviewed from Amazon, a page at a time.
+We call list_assignments_for_hit() to get those assignments using the HIT ID.
+We can then approve/reject each assignment depending on whether it is present in the amt_assignment table
+and if the user has submitted the correct confirmation code. When we
+call approve_assignment(AsmtID), the turker is automatically paid and MTurk fees are debited.
+
+Assignments are listed and approved by a pool of --concurrency threads. Calls that MTurk throttles are retried with
+exponential backoff by the client (see connect.py). An assignment that turns out to be approved already (say, by an
+attempt whose response was lost) counts as approved. Each approved assignment is written to the CSV as soon as it is
+approved, so the CSV is complete even if the run stops partway.
+
+See the following for API reference and python bindings, respectively.
+http://docs.aws.amazon.com/AWSMechTurk/latest/AWSMturkAPI/ApiReference_OperationsArticle.html
+https://boto3.readthedocs.io/en/latest/reference/services/mturk.html
+'''
+
+# Max page size allowed by the MTurk list operations.
+PAGE_SIZE = 100
+
+CSV_COLS = ['HITId', 'AssignmentId', 'WorkerId', 'AssignmentStatus', 'Answer', 'AcceptTime', 'SubmitTime']
+
+# Yields the items under `key` in every page of results of `list_operation` (a list method of the MTurk client, e.g.
+# mturk.list_reviewable_hits), following NextToken.
+def paginate(list_operation, key, **kwargs):
+    kwargs['MaxResults'] = PAGE_SIZE
+    while True:
+        page = list_operation(**kwargs)
+        for item in page[key]:
+            yield item
+        if not page.get('NextToken') or len(page[key]) == 0:
+            return
+        kwargs['NextToken'] = page['NextToken']
+
+# Returns the set of HIT ids in the amt_assignment table and a dict from assignment id to its row.
+def index_assignments(amt_assignment_rows):
+    existing_hits = set(row['hit_id'] for row in amt_assignment_rows)
+    existing_assignments = dict((row['assignment_id'], row) for row in amt_assignment_rows)
+    return existing_hits, existing_assignments
+
+# Returns whether MTurk has the assignment as approved.
+def is_approved(mturk, assignment_id):
+    return mturk.get_assignment(AssignmentId=assignment_id)['Assignment']['AssignmentStatus'] == 'Approved'
+
+# An assignment is approved if we gave it out, and the turker submitted the confirmation code we generated for it.
+def should_approve(asmt, existing_assignments):
+    if asmt['AssignmentId'] not in existing_assignments:
+        return False
+    generated_confirmation_code = existing_assignments[asmt['AssignmentId']]['confirmation_code']
+    code_submitted_matches = "<FreeText>" + generated_confirmation_code + "</FreeText>" in asmt['Answer']
+    worker_id_matches = existing_assignments[asmt['AssignmentId']]['turker_id'] == asmt['WorkerId'] # This isnt actually required
+    return code_submitted_matches and worker_id_matches
+
+# Reviews the submitted assignments of all reviewable HITs that are in existing_hits, approving the ones that should be
+# approved and writing a CSV row for each to output_file as soon as it is approved. Returns the number of assignments
+# that were approved, not approved, and that could not be listed or approved. `mturk` is the MTurk client (or anything
+# with the same methods), which is shared between the threads.
+def review_hits(mturk, existing_hits, existing_assignments, output_file, concurrency=8):
+    with instrumentation.phase('list_reviewable_hits') as record:
+        hits_to_review = [hit for hit in paginate(mturk.list_reviewable_hits, 'HITs')
+                          if hit['HITId'] in existing_hits]
+        record['n_items'] = len(hits_to_review)
+    counts = {'approved': 0, 'not_approved': 0, 'failed': 0}
+    writer = csv.writer(output_file)
+    writer.writerow(CSV_COLS)
+    output_file.flush()
+    if len(hits_to_review) == 0:
         print "No relevant HITs to review"
-    else:
-        print "HITs to review: "
-        print relevant_hits_to_review
-    
-    for hit in relevant_hits_to_review:
-        asmts_to_review = mturk.list_assignments_for_hit(
-            HITId=hit['HITId'], AssignmentStatuses=['Submitted'])
-
-        for asmt in asmts_to_review['Assignments']:
-            generated_confirmation_code = existing_assignments_dict[asmt['AssignmentId']]['confirmation_code']
-            code_submitted_matches = "<FreeText>"+generated_confirmation_code+"</FreeText>" in asmt['Answer']
-            worker_id_matches = existing_assignments_dict[asmt['AssignmentId']]['turker_id'] == asmt['WorkerId'] # This isnt actually required
-
-            if(code_submitted_matches and worker_id_matches):
-                print 'Approving the following assignment:'
-                pprint(asmt)
-                print
-                mturk.approve_assignment(AssignmentId=asmt['AssignmentId'])
-
-                # add approved assignment info to a CSV
-                new_row = [asmt['HITId'], asmt['AssignmentId'], asmt['WorkerId'],
-                        asmt['AssignmentStatus'], asmt['Answer'], str(asmt['AcceptTime']),
-                        str(asmt['SubmitTime'])]
-                new_approvals.loc[i] = new_row
-                i += 1
-            else:
-                print 'Not approving the following assignment:'
-                pprint(asmt)
-
-    directory = 'mturk_results/'
-    if not os.path.exists(directory):
-        os.makedirs(directory)
-    
-    # write to a csv
-    new_approvals.to_csv(directory + time.strftime("results_%d-%m-%Y_%H-%M-%S") + '.csv', index=False)
-except Exception as e:
-    print "Error: ", e
+        return counts
+    print "%d HITs to review" % len(hits_to_review)
+
+    @instrumentation.profiled
+    def list_assignments(hit_id):
+        return list(paginate(mturk.list_assignments_for_hit, 'Assignments',
+                             HITId=hit_id, AssignmentStatuses=['Submitted']))
+
+    @instrumentation.profiled
+    def approve(asmt):
+        try:
+            mturk.approve_assignment(AssignmentId=asmt['AssignmentId'])
+        except botocore.exceptions.ClientError as e:
+            # MTurk refuses to approve an assignment that isn't Submitted, which is the case if it was approved already.
+            if e.response.get('Error', {}).get('Code') != 'RequestError' or \
+                    not is_approved(mturk, asmt['AssignmentId']):
+                raise
+        return asmt
+
+    # Listings and approvals share the pool; whichever finishes first is handled first. Only this thread prints and
+    # writes to the CSV.
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        pending = {}
+        for hit in hits_to_review:
+            pending[executor.submit(list_assignments, hit['HITId'])] = ('list', hit['HITId'])
+        while len(pending) > 0:
+            (done, _) = wait(pending.keys(), return_when=FIRST_COMPLETED)
+            for future in done:
+                (kind, item) = pending.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    print 'Error: could not %s %s: %s' % ('list the assignments of HIT' if kind == 'list' else
+                                                         'approve assignment', item, e)
+                    counts['failed'] += 1
+                    continue
+
+                if kind == 'list':
+                    for asmt in result:
+                        if should_approve(asmt, existing_assignments):
+                            pending[executor.submit(approve, asmt)] = ('approve', asmt['AssignmentId'])
+                        else:
+                            print 'Not approving the following assignment:'
+                            pprint(asmt)
+                            counts['not_approved'] += 1
+                else:
+                    print 'Approved the following assignment:'
+                    pprint(result)
+                    print
+                    # add approved assignment info to a CSV
+                    writer.writerow([result['HITId'], result['AssignmentId'], result['WorkerId'],
+                                     result['AssignmentStatus'], result['Answer'], str(result['AcceptTime']),
+                                     str(result['SubmitTime'])])
+                    output_file.flush()
+                    counts['approved'] += 1
+    return counts
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Approves the MTurk assignments that submitted the right code.')
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help='Max number of MTurk calls in flight at once.')
+    parser.add_argument('--output_dir', type=str, default='mturk_results/',
+                        help='Directory to write the CSV of approved assignments to.')
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+    instrumentation.configure(args, 'hit_approve_assignment')
+
+    try:
+        # Connect to PostgreSQL database
+        conn, engine = connect_to_db()
+
+        cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+
+        # Get the list of all MTurk assignments and confirmation codes from the amt_assignment table here
+        with instrumentation.phase('load_assignments') as record:
+            cur.execute("""SELECT hit_id, assignment_id, turker_id, confirmation_code from sidewalk.amt_assignment""")
+            (existing_hits, existing_assignments) = index_assignments(cur.fetchall())
+            cur.close()
+            record['n_items'] = len(existing_assignments)
+
+        mturk = connect_to_mturk(check_balance=True)
+
+        directory = args.output_dir
+        if not os.path.exists(directory):
+            os.makedirs(directory)
 
+        # all newly approved assignments are written to a csv as they are approved
+        with open(os.path.join(directory, time.strftime("results_%d-%m-%Y_%H-%M-%S") + '.csv'), 'wb') as f, \
+                instrumentation.phase('review_hits') as record:
+            counts = review_hits(mturk, existing_hits, existing_assignments, f, args.concurrency)
+            record.update(counts, n_items=sum(counts.values()))
+        print "Approved %d assignments, did not approve %d, failed on %d." % \
+              (counts['approved'], counts['not_approved'], counts['failed'])
+    except Exception as e:
+        print "Error: ", e
@@ -5,83 +5,258 @@ from datetime import datetime
 from datetime import timedelta
 
 import os
+import sys
+import argparse
 import time
 import pandas as pd
 from pprint import pprint
+import instrumentation
 
-try:
-    # Connect to PostgreSQL database
-    conn, engine = connect_to_db()
-
-    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+# Get the list of all missions completed by turkers excluding onboarding and their first 500ft mission
+# Filter out the missions that were already rewarded with a bonus in a previous run of this program.
+# (These can be stored as an additional column in the mission_user_table)
+# Calculate the distance associated with the completed unpaid missions
+# Calculate bonus amount based on distance audited
+# Use the boto function award a bonus to that user.
+#(Find the same user in the amt_assignment table and get the hit id and assignment id for this)
+#
+# Without --send_bonuses, this is a dry run: it prints what would be paid, and changes nothing.
+#
+# The scan is incremental: only unpaid missions with a mission_user_id above a watermark (kept in --watermark_file) are
+# read, along with the mission before each of them in the same region, which its distance is diffed against.
+# After a run, the watermark moves up to the last mission below which every mission has been dealt with. Missions of
+# users that have no role or MTurk assignment yet hold it back until they can be paid. Use --full_scan to ignore the
+# watermark and look at every unpaid mission.
 
-    # Get the list of all missions completed by turkers excluding onboarding and their first 500ft mission
-    # Filter out the missions that were already rewarded with a bonus in a previous run of this program. 
-    # (These can be stored as an additional column in the mission_user_table)
-    # Calculate the distance associated with the completed unpaid missions
-    # Calculate bonus amount based on distance audited
-    # Use the boto function award a bonus to that user. 
-    #(Find the same user in the amt_assignment table and get the hit id and assignment id for this)
-
-    cur.execute("""SELECT username,mission.mission_id,mission_user.mission_user_id,mission.label,
-        region_id,distance,distance_ft,distance_mi, hit_id, assignment_id, paid
+# Unpaid missions above the watermark (one row per mission, with the user's first assignment), each with the id of the
+# user's first mission ever (which is never paid), followed by the mission just before each of them in the same region,
+# marked is_prior (those can be new missions too, or missions that were paid out of order after a failed run).
+MISSIONS_QUERY = """WITH new_mission AS (
+        SELECT DISTINCT ON (mission_user.mission_user_id)
+            username, mission.mission_id, mission_user.mission_user_id, mission_user.user_id, mission.label,
+            region_id, distance, distance_ft, distance_mi, hit_id, assignment_id, paid
         from mission_user
         join mission on(mission.mission_id = mission_user.mission_id)
         join user_role on(user_role.user_id=mission_user.user_id and user_role.role_id=2)
         join sidewalk_user on(sidewalk_user.user_id = mission_user.user_id)
         join amt_assignment on(username = amt_assignment.turker_id)
-        where mission.deleted = false and mission.label !='onboarding';""")
-
-    mission_rows = cur.fetchall()
-    mission_df = pd.DataFrame(mission_rows)
-
-    user_grouped = mission_df.sort_values('mission_user_id').groupby('username')
-
-    mturk = connect_to_mturk()
-
-    pay_per_mile = 1 #Need to set this
-    send_bonuses = False # Change to True to allow bonuses to be sent
-
-    for username,user_group in user_grouped:
-        print "username: ",username
-        first_mission_user_id = user_group.reset_index(drop=True)[0:1]['mission_user_id'][0]
-        region_grouped = pd.DataFrame(user_group).reset_index(drop=True).groupby('region_id')
-        for region_id, region_group in region_grouped:
-            print "region_id: ",region_id
-            region_df = pd.DataFrame(region_group).reset_index(drop=True)
-            region_df['mission_distance'] = region_df['distance_mi'].diff()
-            region_df_to_be_paid = region_df[(region_df['mission_distance']>0) & (region_df['paid']==False)]
-            region_df_ignored = pd.DataFrame(region_df[(region_df['mission_distance']<=0) & (region_df['paid']==False)])
-
-            # The first mission in the region will have a mission_distance of Nan because of the diff() function. 
-            # We need to check if this was the user's first mission ever and also if it was already paid for
-            # Else we need to include it in our list of missions to be paid for.
-            if(region_df[0:1]['mission_user_id'][0] != first_mission_user_id and region_df[0:1]['paid'][0]==False):
-                region_df[0:1]['mission_distance'][0] = region_df['distance_mi'][0]
-                region_df_to_be_paid=region_df_to_be_paid.append(region_df[0:1])
-
-            for idx,row in region_df_to_be_paid.iterrows():
-                bonus = pay_per_mile * row['mission_distance']
+        where mission.deleted = false and mission.label !='onboarding'
+            and mission_user.paid = false and mission_user.mission_user_id > %(watermark)s
+        order by mission_user.mission_user_id, assignment_id
+    ), first_mission AS (
+        SELECT mission_user.user_id, MIN(mission_user.mission_user_id) AS first_mission_user_id
+        from mission_user
+        join mission on(mission.mission_id = mission_user.mission_id)
+        where mission.deleted = false and mission.label !='onboarding'
+            and mission_user.user_id IN (SELECT user_id FROM new_mission)
+        GROUP BY mission_user.user_id
+    )
+    SELECT new_mission.*, first_mission_user_id, false AS is_prior
+    FROM new_mission
+    JOIN first_mission USING (user_id)
+    UNION ALL
+    SELECT new_mission.username, prior.mission_id, prior.mission_user_id, new_mission.user_id, prior.label,
+        new_mission.region_id, prior.distance, prior.distance_ft, prior.distance_mi, NULL, NULL, prior.paid, NULL, true
+    FROM new_mission
+    CROSS JOIN LATERAL (
+        SELECT mission.mission_id, mission_user.mission_user_id, mission.label, distance, distance_ft, distance_mi, paid
+        from mission_user
+        join mission on(mission.mission_id = mission_user.mission_id)
+        where mission.deleted = false and mission.label !='onboarding'
+            and mission_user.user_id = new_mission.user_id and mission.region_id = new_mission.region_id
+            and mission_user.mission_user_id < new_mission.mission_user_id
+        order by mission_user.mission_user_id desc
+        limit 1
+    ) AS prior;"""
+
+# The lowest unpaid mission above the watermark that MISSIONS_QUERY can't pay yet, because its user has no role or is a
+# turker with no MTurk assignment yet (those rows can be written after the mission is). The watermark is held below it,
+# so the mission is read again once it can be paid.
+UNJOINABLE_MISSION_QUERY = """SELECT MIN(mission_user.mission_user_id)
+    from mission_user
+    join mission on(mission.mission_id = mission_user.mission_id)
+    left join sidewalk_user on(sidewalk_user.user_id = mission_user.user_id)
+    where mission.deleted = false and mission.label !='onboarding'
+        and mission_user.paid = false and mission_user.mission_user_id > %(watermark)s
+        and (NOT EXISTS (SELECT 1 FROM user_role WHERE user_role.user_id = mission_user.user_id)
+             or (EXISTS (SELECT 1 FROM user_role WHERE user_role.user_id = mission_user.user_id and role_id = 2)
+                 and NOT EXISTS (SELECT 1 FROM amt_assignment WHERE turker_id = sidewalk_user.username)));"""
+
+# Number of rows read from the server-side cursor at a time.
+MISSIONS_FETCH_ROWS = 10000
+
+MARK_PAID_QUERY = """UPDATE sidewalk.mission_user SET paid = true
+    FROM (VALUES %s) AS to_mark (mission_user_id)
+    WHERE sidewalk.mission_user.mission_user_id = to_mark.mission_user_id;"""
+
+# Works out which missions should get a bonus, for all users and regions at once. Each mission is paid for the distance
+# it added to the user's total in the region (the difference with their previous mission in the region). The first
+# mission in a region is paid its full distance, unless it is the user's first mission ever or it has already been paid.
+# Returns a DataFrame with one row per unpaid mission, in mission_user_id order, with its mission_distance, its bonus,
+# and whether to send the bonus (send_bonus is False for missions that added no distance, which are just marked paid).
+# If mission_df comes from MISSIONS_QUERY, rows marked is_prior are only used for the distance of the mission after them,
+# and the user's first mission is the one in first_mission_user_id; otherwise mission_df has to hold every mission.
+def compute_bonuses(mission_df, pay_per_mile):
+    # The join with amt_assignment gives a row per assignment of the user; a mission is only paid once. A mission that
+    # is both new and before another new one keeps its new row (is_prior rows have no assignment, so they sort last).
+    missions = mission_df.sort_values(['mission_user_id', 'assignment_id']).drop_duplicates('mission_user_id')
+    missions = missions.reset_index(drop=True)
+
+    by_region = missions.groupby(['username', 'region_id'], sort=False)
+    missions['mission_distance'] = by_region['distance_mi'].diff()
+    first_in_region = by_region.cumcount() == 0
+    if 'first_mission_user_id' in missions:
+        first_ever = missions['mission_user_id'] == missions['first_mission_user_id']
+    else:
+        first_ever = missions['mission_user_id'] == missions.groupby('username')['mission_user_id'].transform('min')
+    unpaid = missions['paid'] == False
+    if 'is_prior' in missions:
+        unpaid &= missions['is_prior'] == False
+    pay_first = first_in_region & ~first_ever & unpaid
+    missions.loc[pay_first, 'mission_distance'] = missions.loc[pay_first, 'distance_mi']
+
+    bonuses = missions[unpaid & (pay_first | ~first_in_region)].copy()
+    bonuses['send_bonus'] = bonuses['mission_distance'] > 0
+    bonuses['bonus'] = (pay_per_mile * bonuses['mission_distance']).where(bonuses['send_bonus'], 0)
+    return bonuses.reset_index(drop=True)
+
+# Reads the rows of MISSIONS_QUERY for the missions above the watermark with a server-side cursor, a chunk at a time.
+# Returns them as a DataFrame, along with the result of UNJOINABLE_MISSION_QUERY (None if there is no such mission),
+# both read from the same snapshot of the database.
+def read_missions(conn, watermark, chunk_rows=MISSIONS_FETCH_ROWS):
+    cur = conn.cursor()
+    cur.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+    cur.execute(UNJOINABLE_MISSION_QUERY, {'watermark': watermark})
+    first_unjoinable = cur.fetchone()[0]
+    cur.close()
+
+    cur = conn.cursor('missions_to_pay', cursor_factory=psycopg2.extras.RealDictCursor)
+    cur.itersize = chunk_rows
+    cur.execute(MISSIONS_QUERY, {'watermark': watermark})
+    chunks = []
+    while True:
+        rows = cur.fetchmany(chunk_rows)
+        if len(rows) == 0:
+            break
+        chunks.append(pd.DataFrame(rows))
+    cur.close()
+    conn.commit()
+    return (pd.concat(chunks, ignore_index=True) if len(chunks) > 0 else pd.DataFrame(), first_unjoinable)
+
+# Returns the new watermark after a run: the highest mission_user_id such that every unpaid mission up to it was read
+# and marked paid (or doesn't get a bonus). Missions that should have been paid but weren't, and missions that couldn't
+# be paid yet (first_unjoinable and above), are read again next time.
+def next_watermark(watermark, mission_df, bonuses, paid_ids, first_unjoinable=None):
+    new_ids = mission_df.loc[mission_df['is_prior'] == False, 'mission_user_id']
+    if len(new_ids) == 0:
+        return watermark
+    unpaid_ids = set(bonuses['mission_user_id']) - set(paid_ids)
+    if first_unjoinable is not None:
+        unpaid_ids.add(first_unjoinable)
+    return max(watermark, int(min(unpaid_ids)) - 1 if len(unpaid_ids) > 0 else int(new_ids.max()))
+
+# Returns the watermark saved in the file, or 0 (so every unpaid mission is read) if there isn't one.
+def read_watermark(path):
+    if not os.path.isfile(path):
+        return 0
+    with open(path) as f:
+        return int(f.read().strip() or 0)
+
+# Saves the watermark, replacing the file in one step so a crash can't leave it half written.
+def write_watermark(path, watermark):
+    with open(path + '.tmp', 'w') as f:
+        f.write('%d\n' % watermark)
+    os.rename(path + '.tmp', path)
+
+# Marks the missions as paid with a single UPDATE, in the current transaction.
+def mark_paid(cur, mission_user_ids):
+    if len(mission_user_ids) > 0:
+        psycopg2.extras.execute_values(cur, MARK_PAID_QUERY, [(int(i),) for i in mission_user_ids], page_size=1000)
+
+# Prints the totals of what will be (or, in a dry run, would be) paid.
+def print_report(bonuses):
+    to_send = bonuses[bonuses['send_bonus']]
+    print "%d missions to pay: %.2f miles, $%.2f in bonuses to %d users." % \
+          (len(to_send), to_send['mission_distance'].sum(), to_send['bonus'].sum(), to_send['username'].nunique())
+    print "%d missions added no distance and will just be marked as paid." % (len(bonuses) - len(to_send))
+    if len(to_send) > 0:
+        by_user = to_send.groupby('username')
+        per_user = pd.DataFrame({'missions': by_user.size(), 'miles': by_user['mission_distance'].sum(),
+                                 'bonus': by_user['bonus'].sum()}, columns=['missions', 'miles', 'bonus'])
+        print per_user.sort_values('bonus', ascending=False).to_string()
+
+def bonus_reason(row):
+    return "Bonus of $" + str(row['bonus']) + " paid for completing a " + str(row['mission_distance']) + \
+           " mile long mission on project sidewalk"
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Pays turkers a bonus for the distance of their completed missions.')
+    parser.add_argument('--pay_per_mile', type=float, default=1,
+                        help='Bonus in dollars per mile audited.')
+    parser.add_argument('--send_bonuses', action='store_true',
+                        help='Actually send the bonuses and mark the missions as paid (otherwise only print a report).')
+    parser.add_argument('--watermark_file', type=str, default='bonus_watermark.txt',
+                        help='File with the mission_user_id below which every mission has been dealt with.')
+    parser.add_argument('--full_scan', action='store_true',
+                        help='Ignore the watermark and look at every unpaid mission (it is still updated afterwards).')
+    instrumentation.add_arguments(parser)
+    return parser.parse_args(argv)
+
+# Reads the unpaid missions above the watermark, works out their bonuses, and prints a report. Unless this is a dry run,
+# then sends the bonuses with the MTurk client returned by connect_mturk(), marks the missions that were paid (or didn't
+# need to be) as paid, and moves the watermark up. Returns the bonuses and the ids of the missions marked paid.
+def run(args, conn, connect_mturk=connect_to_mturk):
+    watermark = 0 if args.full_scan else read_watermark(args.watermark_file)
+
+    with instrumentation.phase('load_missions', watermark=watermark) as record:
+        (mission_df, first_unjoinable) = read_missions(conn, watermark)
+        record.update(n_items=len(mission_df), first_unjoinable=first_unjoinable)
+    if len(mission_df) == 0:
+        print "No missions to pay for above mission_user_id %d." % watermark
+        return (None, [])
+
+    with instrumentation.phase('compute_bonuses', n_items=len(mission_df)):
+        bonuses = compute_bonuses(mission_df, args.pay_per_mile)
+    print_report(bonuses)
+    if not args.send_bonuses:
+        print "Dry run: no bonuses were sent. Use --send_bonuses to send them."
+        return (bonuses, [])
+
+    mturk = connect_mturk(check_balance=True)
+    cur = conn.cursor()
+    paid_ids = list(bonuses.loc[~bonuses['send_bonus'], 'mission_user_id'])
+    try:
+        with instrumentation.phase('send_bonuses') as record:
+            for row in bonuses[bonuses['send_bonus']].to_dict('records'):
                 # Call mturk boto3 function to assign a bonus to the worker using the assignment id
-                reason = "Bonus of $" + str(bonus) + " paid for completing a "+str(row['mission_distance'])+" mile long mission on project sidewalk"
-                
-                if(send_bonuses):
-                    response = mturk.send_bonus(WorkerId=row['username'],BonusAmount=str(bonus),
-                        AssignmentId=row['assignment_id'],Reason=reason,
-                        UniqueRequestToken=row['username']+row['assignment_id']+row['mission_user_id'])
-                
+                reason = bonus_reason(row)
+                response = mturk.send_bonus(WorkerId=row['username'], BonusAmount='%.2f' % row['bonus'],
+                                            AssignmentId=row['assignment_id'], Reason=reason,
+                                            UniqueRequestToken=row['username'] + row['assignment_id'] +
+                                                               str(row['mission_user_id']))
                 print reason
-                print response
-                # Update the paid column for the mission_user_id row on the mission_user table to True
-                cur.execute("UPDATE sidewalk.mission_user SET paid=true WHERE sidewalk.mission_user.mission_user_id="+str(row['mission_user_id'])+";")
-                conn.commit()
+                paid_ids.append(row['mission_user_id'])
+                record['n_items'] = record.get('n_items', 0) + 1
+    except Exception as e:
+        print "Error: ", e
+    finally:
+        # Update the paid column for all the missions that were paid (or didn't need to be) in one transaction.
+        with instrumentation.phase('mark_paid', n_items=len(paid_ids)):
+            mark_paid(cur, paid_ids)
+            conn.commit()
+        cur.close()
+        print "Marked %d missions as paid." % len(paid_ids)
+        new_watermark = next_watermark(watermark, mission_df, bonuses, paid_ids, first_unjoinable)
+        write_watermark(args.watermark_file, new_watermark)
+        print "Next run starts after mission_user_id %d." % new_watermark
+    return (bonuses, paid_ids)
 
-            for idx, row in region_df_ignored.iterrows():
-                cur.execute("UPDATE sidewalk.mission_user SET paid=true WHERE sidewalk.mission_user.mission_user_id="+str(row['mission_user_id'])+";")
-                conn.commit()
 
-    cur.close()
-    
-except Exception as e:
-    print "Error: ", e
+if __name__ == '__main__':
+    args = parse_args()
+    instrumentation.configure(args, 'hit_approve_bonus')
 
+    # Connect to PostgreSQL database
+    conn, engine = connect_to_db()
+    run(args, conn)
@@ -0,0 +1,186 @@
+import atexit
+import cProfile
+import json
+import os
+import pstats
+import resource
+import sys
+import threading
+import time
+
+# Shared timing and profiling for the batch scripts (label_clustering.py, check_streets_for_imagery.py, anonymize.py and
+# the hit_approve_* scripts). A script adds the flags with add_arguments(parser), calls configure(args, name) once the
+# arguments are parsed, and wraps each phase of its work in `with phase('name') as record:`, setting record['n_items']
+# to the number of things the phase handled.
+#
+# --phase_log appends one JSON line per phase to a file: its wall time, the peak RSS of the process so far, the item
+# count and throughput, and any other fields the script adds. Each run has its own run_id, so runs can be compared over
+# time. It is cheap enough to leave on in production.
+#
+# --profile also runs the script under cProfile and writes the pstats output to a file (and prints the top functions).
+# Work that runs in a thread pool is only profiled if it goes through profiled(). Work done in worker processes isn't
+# profiled, but the time it takes shows up in the phase that waits for it.
+#
+# With neither flag, phase() returns a context manager that does nothing, so the calls can stay in the code.
+
+# Number of functions printed at the end of a --profile run.
+PROFILE_TOP_FUNCTIONS = 25
+
+
+# Returns the peak resident set size of the process (and, separately, of its finished child processes) in megabytes.
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux, but in bytes on macOS.
+    scale = 1024.0 * 1024.0 if sys.platform == 'darwin' else 1024.0
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale)
+
+
+class NullPhase(object):
+    def __enter__(self):
+        return {}
+
+    def __exit__(self, exc_type, exc_value, tb):
+        return False
+
+NULL_PHASE = NullPhase()
+
+
+# Times one phase of a script, and writes a record of it to the phase log when it ends.
+class Phase(object):
+    def __init__(self, instrumentation, name, fields):
+        self.instrumentation = instrumentation
+        self.record = dict(fields)
+        self.record['phase'] = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self.record
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.finish(exc_type is None)
+        return False
+
+    def finish(self, ok):
+        seconds = time.time() - self.start
+        self.record['start'] = round(self.start, 3)
+        self.record['seconds'] = round(seconds, 6)
+        self.record['ok'] = ok
+        if 'n_items' in self.record:
+            self.record['items_per_s'] = round(self.record['n_items'] / max(seconds, 1e-9), 3)
+        self.instrumentation.write(self.record)
+
+
+# The phase log and profiler of a run of a script. Safe to share between threads.
+class Instrumentation(object):
+    def __init__(self, script, phase_log=None, profile=None):
+        self.script = script
+        self.run_id = '%s-%d' % (time.strftime('%Y%m%dT%H%M%S'), os.getpid())
+        self.profile_path = profile
+        self.profiles = []
+        self.lock = threading.Lock()
+        self.log = open(phase_log, 'a') if phase_log is not None else None
+        self.enabled = self.log is not None or self.profile_path is not None
+        self.start = time.time()
+        if self.profile_path is not None:
+            self.profiler = cProfile.Profile()
+            self.profiles.append(self.profiler)
+            self.profiler.enable()
+
+    def phase(self, name, **fields):
+        return Phase(self, name, fields) if self.enabled else NULL_PHASE
+
+    # Returns func, wrapped so that each call is profiled when profiling (cProfile only sees the thread it was enabled
+    # in, so this is needed for functions that run in a thread pool).
+    def profiled(self, func):
+        if self.profile_path is None:
+            return func
+        def profiled_func(*args, **kwargs):
+            profiler = cProfile.Profile()
+            with self.lock:
+                self.profiles.append(profiler)
+            return profiler.runcall(func, *args, **kwargs)
+        return profiled_func
+
+    def write(self, record):
+        (record['peak_rss_mb'], record['children_peak_rss_mb']) = [round(mb, 1) for mb in peak_rss_mb()]
+        if self.log is None:
+            return
+        record.update(script=self.script, run_id=self.run_id, pid=os.getpid(), thread=threading.current_thread().name)
+        line = json.dumps(record, sort_keys=True, default=str) + '\n'
+        with self.lock:
+            self.log.write(line)
+            self.log.flush()
+
+    # Logs a 'total' phase for the whole run (timed from when the instrumentation was set up), and writes out the
+    # profile. Only does anything the first time it is called.
+    def close(self):
+        if not self.enabled:
+            return
+        self.enabled = False
+        total = Phase(self, 'total', {})
+        total.start = self.start
+        total.finish(True)
+        if self.profile_path is not None:
+            self.profiler.disable()
+            with self.lock:
+                stats = pstats.Stats(*self.profiles, stream=sys.stderr)
+            stats.dump_stats(self.profile_path)
+            stats.sort_stats('cumulative').print_stats(PROFILE_TOP_FUNCTIONS)
+            sys.stderr.write('Wrote profile to %s (view it with python -m pstats %s).\n' %
+                             (self.profile_path, self.profile_path))
+        if self.log is not None:
+            self.log.close()
+            self.log = None
+
+
+_current = Instrumentation(None)
+
+
+# Adds the --phase_log and --profile flags to an argparse parser.
+def add_arguments(parser):
+    parser.add_argument('--phase_log', type=str, default=None,
+                        help='Append a JSON line with the wall time, peak memory and throughput of each phase of the '
+                             'run to this file.')
+    parser.add_argument('--profile', type=str, default=None, metavar='PSTATS_FILE',
+                        help='Run under cProfile and write the stats to this file (and print the top functions).')
+
+# Sets up the instrumentation of this run from the parsed arguments. The profile and the 'total' record are written when
+# close() is called, or when the process exits.
+def configure(args, script):
+    global _current
+    _current = Instrumentation(script, args.phase_log, args.profile)
+    atexit.register(_current.close)
+    return _current
+
+# Returns a context manager that times a phase of the current run (see Instrumentation.phase).
+def phase(name, **fields):
+    return _current.phase(name, **fields)
+
+# Returns func wrapped to be profiled in whatever thread it runs in, when profiling (see Instrumentation.profiled).
+def profiled(func):
+    return _current.profiled(func)
+
+def close():
+    _current.close()
+
+# Yields the chunks of a generator, adding the time spent producing them to record[name + '_seconds'] and their total
+# size to record[name + '_bytes'] (for bodies that are generated while they are sent).
+def timed_chunks(chunks, record, name):
+    if not _current.enabled:
+        for chunk in chunks:
+            yield chunk
+        return
+    (seconds, n_bytes) = (name + '_seconds', name + '_bytes')
+    record.setdefault(seconds, 0.0)
+    record.setdefault(n_bytes, 0)
+    chunks = iter(chunks)
+    while True:
+        start = time.time()
+        try:
+            chunk = next(chunks)
+        except StopIteration:
+            record[seconds] += time.time() - start
+            return
+        record[seconds] += time.time() - start
+        record[n_bytes] += len(chunk)
+        yield chunk
@@ -1,14 +1,33 @@
 import numpy as np
 import pandas as pd
-from haversine import haversine
+from haversine import haversine, AVG_EARTH_RADIUS
 import sys
 from scipy.cluster.hierarchy import linkage, fcluster
-from scipy.spatial.distance import pdist
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import cKDTree
 import argparse
 import requests
 import json
+import time
+import hashlib
+import sqlite3
+import zlib
+import os
+import tempfile
+from StringIO import StringIO
+from collections import OrderedDict
+from multiprocessing import cpu_count
+import threading
+import SocketServer
+import instrumentation
 from pandas.io.json import json_normalize
-from concurrent.futures import ProcessPoolExecutor
+from pandas.api.types import is_categorical_dtype
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+try:
+    import psycopg2
+except ImportError:
+    psycopg2 = None
 
 # Custom distance function that returns max float if from the same user id, haversine distance otherwise.
 def custom_dist(u, v):
@@ -17,185 +36,551 @@ def custom_dist(u, v):
     else:
         return haversine([u[0], u[1]], [v[0], v[1]])
 
-# For each label type, cluster based on haversine distance.
-def cluster(labels, curr_type, thresholds, single_user):
+# Max number of pairwise distances that haversine_pdist computes at once, which bounds its temporary arrays (~32 MB each).
+PDIST_BLOCK_SIZE = 2 ** 22
 
-    # Makes a normal dist matrix for a single user, but uses special dist function for multi-user clustering that
-    # prevents the same user's attributes from being clustered together.
-    if single_user:
-        dist_matrix = pdist(np.array(labels[['lat', 'lng']].values), lambda x, y: haversine(x, y))
-    else:
-        dist_matrix = pdist(np.array(labels[['lat', 'lng', 'user_id']].values), custom_dist)
+# Vectorized replacement for pdist(coords, haversine) that returns the same condensed distance matrix (in kilometers).
+# If user_ids is given, pairs of labels from the same user get a distance of max float (just like custom_dist). The
+# matrix is filled in blocks of consecutive rows so that the intermediate arrays don't grow with n^2.
+def haversine_pdist(lat, lng, user_ids=None):
+    lat = np.radians(np.asarray(lat, dtype=np.float64))
+    lng = np.radians(np.asarray(lng, dtype=np.float64))
+    cos_lat = np.cos(lat)
+    user_codes = pd.factorize(np.asarray(user_ids))[0] if user_ids is not None else None
+
+    n = len(lat)
+    dist_matrix = np.empty(n * (n - 1) // 2, dtype=np.float64)
+    row_start = 0
+    out_start = 0
+    while row_start < n - 1:
+        # Take as many rows as fit in a block (at least one). Row i holds the distances from label i to labels i+1..n-1.
+        row_lengths = np.arange(n - 1 - row_start, 0, -1)
+        n_rows = max(1, np.searchsorted(np.cumsum(row_lengths), PDIST_BLOCK_SIZE, side='right'))
+        row_lengths = row_lengths[:n_rows]
+        out_end = out_start + row_lengths.sum()
+
+        # Row and column indices of every pair in the block, in condensed matrix order.
+        i = np.repeat(np.arange(row_start, row_start + n_rows), row_lengths)
+        j = np.arange(out_end - out_start) - np.repeat(np.cumsum(row_lengths) - row_lengths, row_lengths) + i + 1
+
+        # Same formula and order of operations as haversine.haversine.
+        d = np.sin((lat[j] - lat[i]) * 0.5) ** 2 + cos_lat[i] * cos_lat[j] * np.sin((lng[j] - lng[i]) * 0.5) ** 2
+        block = 2 * AVG_EARTH_RADIUS * np.arcsin(np.sqrt(d))
+        if user_codes is not None:
+            block[user_codes[i] == user_codes[j]] = sys.float_info.max
+        dist_matrix[out_start:out_end] = block
+
+        row_start += n_rows
+        out_start = out_end
+
+    return dist_matrix
+
+# Splits labels into groups that can be clustered independently, returned as a list of arrays of row positions. Labels
+# are in the same group if they are linked through a chain of labels that are at most `threshold` kilometers apart.
+# Complete linkage never merges labels that are farther apart than the threshold, so clustering each group on its own
+# gives the same clusters as clustering all of them at once, while only needing a distance matrix per group.
+def split_into_components(lat, lng, threshold):
+    n = len(lat)
+    if n < 2:
+        return [np.arange(n)]
+
+    # Project onto a sphere with the earth's radius. Straight line distance is never more than the haversine distance,
+    # so the KD-tree finds every pair within the threshold (plus maybe a few more, which can only make groups bigger).
+    # The tiny bit of slack covers floating point error.
+    lat = np.radians(np.asarray(lat, dtype=np.float64))
+    lng = np.radians(np.asarray(lng, dtype=np.float64))
+    xyz = AVG_EARTH_RADIUS * np.column_stack([np.cos(lat) * np.cos(lng), np.cos(lat) * np.sin(lng), np.sin(lat)])
+    pairs = cKDTree(xyz).query_pairs(threshold * (1 + 1e-9) + 1e-12, output_type='ndarray')
+
+    graph = coo_matrix((np.ones(len(pairs), dtype=np.int8), (pairs[:, 0], pairs[:, 1])), shape=(n, n))
+    n_components, component_ids = connected_components(graph, directed=False)
+
+    # Group row positions by component; components are numbered in order of their first label.
+    order = np.argsort(component_ids, kind='mergesort')
+    boundaries = np.flatnonzero(np.diff(component_ids[order])) + 1
+    return np.split(order, boundaries)
+
+# Runs complete-linkage clustering on one group of labels, returning a cluster number (starting at 1) for each label.
+# Takes a single (lat, lng, user_ids, threshold) tuple so it can be mapped over a list of groups by a process pool;
+# user_ids should be None for single-user clustering.
+def cluster_component(args):
+    (lat, lng, user_ids, threshold) = args
+    if len(lat) == 1:
+        return np.ones(1, dtype=np.int32)
+    dist_matrix = haversine_pdist(lat, lng, user_ids)
     link = linkage(dist_matrix, method='complete')
+    return fcluster(link, t=threshold, criterion='distance')
 
-    # Copies the labels dataframe and adds a column to it for the cluster id each label is in.
-    labelsCopy = labels.copy()
-    labelsCopy.loc[:,'cluster'] = fcluster(link, t=thresholds[curr_type], criterion='distance')
+# Groups of labels bigger than this are clustered by the fast engine's approximation instead of exact linkage.
+FAST_ENGINE_MIN_SIZE = 2000
 
-    # Cuts tree so that only labels less than clust_threth kilometers apart are clustered.
-    clusters = labelsCopy.groupby('cluster')
+# Returns the haversine distances (in kilometers) from label i to each of the labels in `others`, given lat/lng in
+# radians and the cosines of the latitudes.
+def haversine_from(i, others, lat, lng, cos_lat):
+    d = np.sin((lat[others] - lat[i]) * 0.5) ** 2 + cos_lat[i] * cos_lat[others] * np.sin((lng[others] - lng[i]) * 0.5) ** 2
+    return 2 * AVG_EARTH_RADIUS * np.arcsin(np.sqrt(d))
 
-    # Computes the center of each cluster and assigns temporariness and severity.
-    cluster_list = [] # list of tuples (label_type, cluster_num, lat, lng, severity, temporary).
-    for clust_num, clust in clusters:
-        ave_pos = np.mean(clust['coords'].tolist(), axis=0) # use ave pos of clusters.
-        ave_sev = None if pd.isnull(clust['severity']).all() else int(round(np.median(clust['severity'][~np.isnan(clust['severity'])])))
-        ave_temp = None if pd.isnull(clust['temporary']).all() else bool(round(np.mean(clust['temporary'])))
+# Fast approximation of cluster_component, for groups of labels that are too big for exact linkage. Like complete
+# linkage cut at the threshold, it only puts labels in the same cluster if they are all within the threshold of each
+# other (and from different users, for multi-user clustering). But it builds clusters greedily: it repeatedly takes the
+# unclustered label with the most neighbors (found with a KD-tree) and adds its unclustered neighbors to its cluster,
+# closest first, if they are within the threshold of every label already in the cluster. Small groups are clustered
+# exactly, since that is cheap anyway.
+def fast_cluster_component(args):
+    (lat, lng, user_ids, threshold) = args
+    n = len(lat)
+    if n <= FAST_ENGINE_MIN_SIZE:
+        return cluster_component(args)
 
-        cluster_list.append((curr_type, clust_num, ave_pos[0], ave_pos[1], ave_sev, ave_temp))
+    lat = np.radians(np.asarray(lat, dtype=np.float64))
+    lng = np.radians(np.asarray(lng, dtype=np.float64))
+    cos_lat = np.cos(lat)
+    xyz = AVG_EARTH_RADIUS * np.column_stack([cos_lat * np.cos(lng), cos_lat * np.sin(lng), np.sin(lat)])
+    neighbors = cKDTree(xyz).query_ball_point(xyz, threshold * (1 + 1e-9) + 1e-12)
+    degree = np.array([len(x) for x in neighbors])
 
-    cluster_df = pd.DataFrame(cluster_list, columns=['label_type', 'cluster', 'lat', 'lng', 'severity', 'temporary'])
+    clusters = np.zeros(n, dtype=np.int32)
+    n_clusters = 0
+    for seed in np.argsort(-degree, kind='mergesort'):
+        if clusters[seed] > 0:
+            continue
+        n_clusters += 1
+        clusters[seed] = n_clusters
 
-    return (cluster_df, labelsCopy)
+        candidates = np.asarray(neighbors[seed], dtype=np.int64)
+        candidates = candidates[clusters[candidates] == 0]
+        if len(candidates) == 0:
+            continue
+        candidates = candidates[np.argsort(haversine_from(seed, candidates, lat, lng, cos_lat), kind='mergesort')]
 
+        members = [seed]
+        for j in candidates:
+            if user_ids is not None and np.any(user_ids[members] == user_ids[j]):
+                continue
+            if np.all(haversine_from(j, np.array(members), lat, lng, cos_lat) <= threshold):
+                members.append(j)
+                clusters[j] = n_clusters
 
+    return clusters
 
-if __name__ == '__main__':
+# The ways a group of labels can be clustered: exact complete linkage, or the fast approximation for very large groups.
+ENGINES = {'exact': cluster_component, 'fast': fast_cluster_component}
 
-    POST_HEADER = {'content-type': 'application/json; charset=utf-8'}
+# Linkage cost (in pairs of labels) below which groups are bundled together into a single task for the process pool, so
+# that the many tiny groups don't each pay for a round trip to a worker process.
+MIN_TASK_COST = 250000
 
-    # Read in arguments from command line.
-    parser = argparse.ArgumentParser(description='Gets a set of labels, posts the labels grouped into clusters.')
-    parser.add_argument('--key', type=str,
-                        help='Key string that is used to authenticate when using API.')
-    parser.add_argument('--user_id', type=str,
-                        help='User id of a single user who\'s labels should be clustered.')
-    parser.add_argument('--region_id', type=int,
-                        help='Region id of a region who\'s user-clustered should be clustered.')
-    parser.add_argument('--debug', action='store_true',
-                        help='Debug mode adds print statements')
-    args = parser.parse_args()
-    KEY = args.key
-    DEBUG = args.debug
-    USER_ID = args.user_id.strip('\'\"') if args.user_id else None
-    REGION_ID = args.region_id
-
-    N_PROCESSORS = 3
-
-    # Determine what type of clustering should be done from command line args, and set variable accordingly.
-    getURL = None
-    postURL = None
-    SINGLE_USER = None
-
-    if USER_ID:
-        SINGLE_USER = True
-        getURL = 'http://localhost:9000/userLabelsToCluster?key=' + KEY + '&userId=' + str(USER_ID)
-        postURL = 'http://localhost:9000/singleUserClusteringResults?key=' + KEY + '&userId=' + str(USER_ID)
-    elif REGION_ID:
-        SINGLE_USER = False
-        getURL = 'http://localhost:9000/clusteredLabelsInRegion?key=' + KEY + '&regionId=' + str(REGION_ID)
-        postURL = 'http://localhost:9000/multiUserClusteringResults?key=' + KEY + '&regionId=' + str(REGION_ID)
-
-    # Send GET request to get the labels to be clustered.
-    try:
-        print getURL
-        print postURL
-        response = requests.get(getURL)
-        data = response.json()
-        label_data = json_normalize(data[0])
-        # print label_data
-    except:
-        print "Failed to get labels needed to cluster."
-        sys.exit()
-
-    # Define thresholds for single and multi user clustering (numbers are in kilometers).
-    if SINGLE_USER:
-        thresholds = {'CurbRamp': 0.002,
-                      'NoCurbRamp': 0.002,
-                      'SurfaceProblem': 0.0075,
-                      'Obstacle': 0.0075,
-                      'NoSidewalk': 0.0075,
-                      'Occlusion': 0.0075,
-                      'Other': 0.0075,
-                      'Problem': 0.0075}
+# Shared memory holding the lat, lng, and user codes of the labels to be clustered by worker processes, so that only a
+# small handle and offsets need to be pickled for each task. It is a file in /dev/shm (when available) that the parent
+# and the workers all memory-map.
+class SharedLabelArrays(object):
+    def __init__(self, lat, lng, user_codes):
+        shm_dir = '/dev/shm' if os.path.isdir('/dev/shm') else None
+        (fd, self.path) = tempfile.mkstemp(prefix='label_clustering_', suffix='.dat', dir=shm_dir)
+        os.close(fd)
+        self.n = len(lat)
+        arrays = np.memmap(self.path, dtype=np.float64, mode='w+', shape=(3, max(self.n, 1)))
+        arrays[0, :self.n] = lat
+        arrays[1, :self.n] = lng
+        arrays[2, :self.n] = user_codes
+        arrays.flush()
+        del arrays
+
+    def close(self):
+        os.remove(self.path)
+
+# Shared label arrays that have been memory-mapped by this (worker) process, by path. Only the few most recent are kept.
+_open_shared_arrays = OrderedDict()
+
+def open_shared_arrays(path, n):
+    if path not in _open_shared_arrays:
+        _open_shared_arrays[path] = np.memmap(path, dtype=np.float64, mode='r', shape=(3, max(n, 1)))
+        while len(_open_shared_arrays) > 8:
+            _open_shared_arrays.popitem(last=False)
+    return _open_shared_arrays[path]
+
+# Clusters a bundle of groups of labels whose lat, lng, and user codes are rows of `arrays`. Each group is given as a
+# (start, stop, threshold, multi_user, engine) tuple of its position in the arrays and how to cluster it. Returns a
+# (cluster numbers, seconds) tuple for each group.
+def cluster_bundle(arrays, groups):
+    results = []
+    for (start, stop, threshold, multi_user, engine) in groups:
+        task_start = time.time()
+        user_codes = arrays[2, start:stop] if multi_user else None
+        clusters = ENGINES[engine]((arrays[0, start:stop], arrays[1, start:stop], user_codes, threshold))
+        results.append((clusters, time.time() - task_start))
+    return results
+
+# Runs cluster_bundle in a worker process, on arrays that are in shared memory. Takes a (path, n, groups) tuple.
+def cluster_shared_bundle(args):
+    (path, n, groups) = args
+    return cluster_bundle(open_shared_arrays(path, n), groups)
+
+# Clusters a list of groups of labels, each a (lat, lng, user_codes, threshold) tuple where user_codes is None for
+# single-user clustering, using the given engine. The work is spread across the executor's worker processes, or done in
+# this process if the executor is None. Linkage takes time proportional to n^2, so the groups are sent out largest first (with small groups
+# bundled together) so that one huge group doesn't start last, after a worker spent its time on lots of small ones.
+# Returns a (cluster numbers, seconds) tuple for each group.
+def schedule_cluster_tasks(groups, executor=None, engine='exact'):
+    if len(groups) == 0:
+        return []
+
+    # Lays out the groups' arrays one after the other, in the order they will be scheduled.
+    sizes = np.array([len(lat) for (lat, _, _, _) in groups], dtype=np.int64)
+    order = np.argsort(-sizes, kind='mergesort')
+    starts = np.concatenate([[0], np.cumsum(sizes[order])])
+    arrays = np.empty((3, starts[-1]), dtype=np.float64)
+    for (k, i) in enumerate(order):
+        (lat, lng, user_codes, threshold) = groups[i]
+        arrays[0, starts[k]:starts[k + 1]] = lat
+        arrays[1, starts[k]:starts[k + 1]] = lng
+        arrays[2, starts[k]:starts[k + 1]] = user_codes if user_codes is not None else 0
+
+    # Groups into bundles of roughly MIN_TASK_COST or more; since groups are in decreasing size, big ones are alone.
+    bundles = []
+    bundle = []
+    bundle_cost = 0
+    for (k, i) in enumerate(order):
+        bundle.append((starts[k], starts[k + 1], groups[i][3], groups[i][2] is not None, engine))
+        bundle_cost += sizes[i] * (sizes[i] - 1) // 2
+        if bundle_cost >= MIN_TASK_COST:
+            bundles.append(bundle)
+            bundle = []
+            bundle_cost = 0
+    if len(bundle) > 0:
+        bundles.append(bundle)
+
+    if executor is None:
+        bundle_results = [cluster_bundle(arrays, bundle) for bundle in bundles]
     else:
-        thresholds = {'CurbRamp': 0.0075,
-                      'NoCurbRamp': 0.0075,
-                      'SurfaceProblem': 0.01,
-                      'Obstacle': 0.01,
-                      'NoSidewalk': 0.01,
-                      'Occlusion': 0.01,
-                      'Other': 0.01,
-                      'Problem': 0.01}
-
-    # Pick which label types should be included in clustering, and which should be included in the "Problem" type.
-    label_types = ['CurbRamp', 'NoSidewalk', 'Problem', 'Occlusion', 'SurfaceProblem', 'Obstacle', 'Other', 'NoCurbRamp']
-    problem_types = ['SurfaceProblem', 'Obstacle', 'NoCurbRamp'] if SINGLE_USER else ['Problem']
-
-    # These are the columns required in the POST requests for the labels and clusters, respectively.
-    label_cols = ['label_id', 'label_type', 'cluster']
-    cluster_cols = ['label_type', 'cluster', 'lat', 'lng', 'severity', 'temporary']
-
-    # Check if there are 0 labels. If so, just send the post request and exit.
+        shared = SharedLabelArrays(arrays[0], arrays[1], arrays[2])
+        try:
+            futures = [executor.submit(cluster_shared_bundle, (shared.path, shared.n, bundle)) for bundle in bundles]
+            bundle_results = [future.result() for future in futures]
+        finally:
+            shared.close()
+
+    # Puts the results back in the original order of the groups.
+    results = [None] * len(groups)
+    for (k, result) in enumerate(result for bundle_result in bundle_results for result in bundle_result):
+        results[order[k]] = result
+    return results
+
+# Combines the per-group cluster numbers into one array of cluster numbers, offsetting each group so that the cluster
+# numbers are unique across groups (and still start at 1).
+def combine_component_clusters(n_labels, components, component_clusters):
+    cluster_ids = np.empty(n_labels, dtype=np.int32)
+    offset = 0
+    for (members, clusters) in zip(components, component_clusters):
+        cluster_ids[members] = clusters + offset
+        offset += np.max(clusters)
+    return cluster_ids
+
+# Computes the center of each cluster and assigns temporariness and severity, using columnar groupby reductions. The
+# center is the mean position of the cluster's labels, severity is the median of the labels' severities (rounded half
+# up, ignoring nulls), and temporary is whether most of the labels are temporary (ignoring nulls). Severity/temporary
+# are null if all of the cluster's labels have nulls. The cluster of each label is taken from `cluster_ids` if given, or
+# else from the labels' cluster column.
+def summarize_clusters(labelsCopy, curr_type, cluster_ids=None):
+    values = pd.DataFrame({'cluster': labelsCopy.cluster.values if cluster_ids is None else cluster_ids,
+                           'lat': labelsCopy.lat.values,
+                           'lng': labelsCopy.lng.values,
+                           'severity': pd.to_numeric(labelsCopy.severity, errors='coerce').values.astype(np.float64),
+                           'temporary': pd.to_numeric(labelsCopy.temporary, errors='coerce').values.astype(np.float64)})
+    grouped = values.groupby('cluster', sort=True)
+    means = grouped[['lat', 'lng', 'temporary']].mean()
+    median_sev = grouped['severity'].median()
+
+    ave_temp = means.temporary.values
+    with np.errstate(invalid='ignore'):
+        temporary = ave_temp >= 0.5
+    if np.isnan(ave_temp).any():
+        temporary = np.where(np.isnan(ave_temp), None, temporary)
+
+    return pd.DataFrame({'label_type': curr_type,
+                         'cluster': means.index.values,
+                         'lat': means.lat.values,
+                         'lng': means.lng.values,
+                         'severity': np.floor(median_sev.values + 0.5),
+                         'temporary': temporary},
+                        columns=CLUSTER_COLS)
+
+# Splits the labels of one label type into groups that are too far apart to ever be clustered together, and returns
+# (components, tasks, task_components): the groups (arrays of row positions), the (lat, lng, user_codes, threshold)
+# clustering tasks for the groups with more than one label, and which group each task is for.
+def plan_label_type(labels, threshold, single_user):
+    lat = labels.lat.values
+    lng = labels.lng.values
+
+    # Uses the same-user penalty for multi-user clustering, which prevents the same user's attributes from being
+    # clustered together.
+    user_codes = None if single_user else labels.user_code.values
+
+    # Groups with a single label are trivially their own cluster, so they don't need a task.
+    components = split_into_components(lat, lng, threshold)
+    task_components = [i for (i, c) in enumerate(components) if len(c) > 1]
+    tasks = [(lat[components[i]], lng[components[i]], None if single_user else user_codes[components[i]], threshold)
+             for i in task_components]
+    return (components, tasks, task_components)
+
+# Assigns the labels of one label type to the clusters computed by the tasks from plan_label_type, and summarizes the
+# clusters.
+def finish_label_type(labels, curr_type, components, task_components, task_results):
+    component_clusters = [np.ones(1, dtype=np.int32)] * len(components)
+    for (i, (clusters, seconds)) in zip(task_components, task_results):
+        component_clusters[i] = clusters
+
+    cluster_ids = combine_component_clusters(len(labels), components, component_clusters)
+    return label_type_results(labels, curr_type, cluster_ids)
+
+# Returns the (clusters, labels) results of one label type, given the cluster of each label.
+def label_type_results(labels, curr_type, cluster_ids):
+    # Only the columns that are posted are kept for the labels, so the labels (a slice of all the labels) aren't copied.
+    labels_for_type = pd.DataFrame({'label_id': labels.label_id.values,
+                                    'label_type': labels.label_type.values,
+                                    'cluster': cluster_ids},
+                                   columns=LABEL_COLS)
+
+    cluster_df = summarize_clusters(labels, curr_type, cluster_ids)
+
+    return (cluster_df, labels_for_type)
+
+# For each label type, cluster based on haversine distance. The labels are first split into groups that are too far
+# apart to ever be clustered together, and each group is clustered on its own, in parallel if an executor is given.
+def cluster(labels, curr_type, thresholds, single_user, executor=None, engine='exact'):
+    (components, tasks, task_components) = plan_label_type(labels, thresholds[curr_type], single_user)
+    task_results = schedule_cluster_tasks(tasks, executor, engine)
+    return finish_label_type(labels, curr_type, components, task_components, task_results)
+
+
+
+# Thresholds for single and multi user clustering (numbers are in kilometers).
+SINGLE_USER_THRESHOLDS = {'CurbRamp': 0.002,
+                          'NoCurbRamp': 0.002,
+                          'SurfaceProblem': 0.0075,
+                          'Obstacle': 0.0075,
+                          'NoSidewalk': 0.0075,
+                          'Occlusion': 0.0075,
+                          'Other': 0.0075,
+                          'Problem': 0.0075}
+MULTI_USER_THRESHOLDS = {'CurbRamp': 0.0075,
+                         'NoCurbRamp': 0.0075,
+                         'SurfaceProblem': 0.01,
+                         'Obstacle': 0.01,
+                         'NoSidewalk': 0.01,
+                         'Occlusion': 0.01,
+                         'Other': 0.01,
+                         'Problem': 0.01}
+
+# Pick which label types should be included in clustering, and which should be included in the "Problem" type.
+LABEL_TYPES = ['CurbRamp', 'NoSidewalk', 'Problem', 'Occlusion', 'SurfaceProblem', 'Obstacle', 'Other', 'NoCurbRamp']
+SINGLE_USER_PROBLEM_TYPES = ['SurfaceProblem', 'Obstacle', 'NoCurbRamp']
+MULTI_USER_PROBLEM_TYPES = ['Problem']
+
+# Categories of the label_type column of compact labels, in the order the labels are sorted in. Each list of problem
+# types is contiguous, so that the labels clustered as 'Problem' are a contiguous range of rows.
+LABEL_TYPE_CATEGORIES = ['CurbRamp', 'NoSidewalk', 'Occlusion', 'Other', 'Problem', 'SurfaceProblem', 'Obstacle',
+                         'NoCurbRamp']
+
+# These are the columns required in the POST requests for the labels and clusters, respectively.
+LABEL_COLS = ['label_id', 'label_type', 'cluster']
+CLUSTER_COLS = ['label_type', 'cluster', 'lat', 'lng', 'severity', 'temporary']
+
+POST_HEADER = {'content-type': 'application/json; charset=utf-8'}
+DEFAULT_BASE_URL = 'http://localhost:9000'
+
+# Number of rows serialized at a time when streaming the results in the body of the POST request.
+POST_CHUNK_ROWS = 10000
+
+# Number of rows fetched at a time from the server-side cursor when reading labels straight from the database.
+DB_FETCH_ROWS = 20000
+
+# The same labels that the Play server returns from /userLabelsToCluster and /clusteredLabelsInRegion.
+USER_LABELS_QUERY = """SELECT audit_task.user_id, label.label_id, label_type.label_type, label_point.lat,
+    label_point.lng, label_severity.severity, COALESCE(label_temporariness.temporary, FALSE)
+    FROM sidewalk.audit_task
+    INNER JOIN sidewalk.label ON label.audit_task_id = audit_task.audit_task_id
+    INNER JOIN sidewalk.label_point ON label_point.label_id = label.label_id
+    INNER JOIN sidewalk.label_type ON label_type.label_type_id = label.label_type_id
+    LEFT JOIN sidewalk.label_severity ON label_severity.label_id = label.label_id
+    LEFT JOIN sidewalk.label_temporariness ON label_temporariness.label_id = label.label_id
+    WHERE audit_task.user_id = %s AND label.deleted = FALSE AND label.tutorial = FALSE"""
+REGION_LABELS_QUERY = """SELECT user_clustering_session.user_id, user_attribute.user_attribute_id,
+    label_type.label_type, user_attribute.lat, user_attribute.lng, user_attribute.severity, user_attribute.temporary,
+    user_attribute.region_id
+    FROM sidewalk.user_clustering_session
+    INNER JOIN sidewalk.user_attribute
+        ON user_attribute.user_clustering_session_id = user_clustering_session.user_clustering_session_id
+    INNER JOIN sidewalk.label_type ON label_type.label_type_id = user_attribute.label_type_id
+    WHERE user_attribute.region_id = ANY(%s)"""
+# The fingerprints that the Play server returns along with a user's labels: for each label type, the fingerprint that
+# all of the user's attributes of that type were posted with (if they have one, and it is the same for all of them).
+USER_FINGERPRINTS_QUERY = """SELECT label_type.label_type, MIN(user_attribute.labels_fingerprint)
+    FROM sidewalk.user_clustering_session
+    INNER JOIN sidewalk.user_attribute
+        ON user_attribute.user_clustering_session_id = user_clustering_session.user_clustering_session_id
+    INNER JOIN sidewalk.label_type ON label_type.label_type_id = user_attribute.label_type_id
+    WHERE user_clustering_session.user_id = %s
+    GROUP BY label_type.label_type
+    HAVING COUNT(user_attribute.labels_fingerprint) = COUNT(*)
+        AND COUNT(DISTINCT user_attribute.labels_fingerprint) = 1"""
+
+# Names and types of the columns returned by the queries above (only the region query has the region_id).
+LABEL_QUERY_COLUMNS = [('user_id', object), ('label_id', np.int64), ('label_type', object), ('lat', np.float64),
+                       ('lng', np.float64), ('severity', np.float64), ('temporary', bool), ('region_id', np.int64)]
+
+
+# A single clustering job: single-user clustering of one user's labels, or multi-user clustering of one region.
+class ClusteringJob(object):
+    def __init__(self, user_id=None, region_id=None):
+        self.user_id = user_id
+        self.region_id = region_id
+        self.single_user = user_id is not None
+
+    def get_url(self, key, base_url=DEFAULT_BASE_URL):
+        if self.single_user:
+            return base_url + '/userLabelsToCluster?key=' + key + '&userId=' + str(self.user_id)
+        else:
+            return base_url + '/clusteredLabelsInRegion?key=' + key + '&regionId=' + str(self.region_id)
+
+    def post_url(self, key, base_url=DEFAULT_BASE_URL):
+        if self.single_user:
+            return base_url + '/singleUserClusteringResults?key=' + key + '&userId=' + str(self.user_id)
+        else:
+            return base_url + '/multiUserClusteringResults?key=' + key + '&regionId=' + str(self.region_id)
+
+    def __str__(self):
+        return 'user_id ' + str(self.user_id) if self.single_user else 'region_id ' + str(self.region_id)
+
+# Parses a job from a line of the form "user_id <user_id>" or "region_id <region_id>". Returns None for blank lines.
+def parse_job(line):
+    parts = line.split()
+    if len(parts) == 0:
+        return None
+    elif len(parts) == 2 and parts[0] == 'user_id':
+        return ClusteringJob(user_id=parts[1].strip('\'\"'))
+    elif len(parts) == 2 and parts[0] == 'region_id':
+        return ClusteringJob(region_id=int(parts[1]))
+    else:
+        raise ValueError('Invalid job: ' + line.strip())
+
+# Returns the labels that are clustered as the given label type. For labels from compact_labels, which are sorted by
+# type, this is a slice of the rows rather than a copy of them.
+def select_label_type(label_data, label_type, single_user):
+    problem_types = SINGLE_USER_PROBLEM_TYPES if single_user else MULTI_USER_PROBLEM_TYPES
+    types = problem_types if label_type == 'Problem' else [label_type]
+    if not is_categorical_dtype(label_data.label_type):
+        return label_data[label_data.label_type.isin(types)]
+
+    # The problem types are next to each other in LABEL_TYPE_CATEGORIES, so the wanted codes are a contiguous range.
+    categories = label_data.label_type.cat.categories
+    codes = sorted(categories.get_loc(t) for t in types if t in categories)
+    if len(codes) == 0:
+        return label_data.iloc[0:0]
+    type_codes = label_data.label_type.cat.codes.values
+    return label_data.iloc[np.searchsorted(type_codes, codes[0], side='left'):
+                           np.searchsorted(type_codes, codes[-1], side='right')]
+
+# Handles a label type with just 1 (or 0) labels, which don't need clustering: each label is its own cluster.
+def copy_unclustered_label_type(type_data, label_type):
+    clusters_for_type = pd.DataFrame(columns=CLUSTER_COLS)
+    labels_for_type = pd.DataFrame(columns=LABEL_COLS)
+    if type_data.shape[0] == 1:
+        # Gives the single cluster a cluster_id of 1, and gives Problem type if needed.
+        labels_for_type = pd.DataFrame({'label_id': type_data.label_id.values, 'label_type': label_type, 'cluster': 1},
+                                       columns=LABEL_COLS)
+        clusters_for_type = summarize_clusters(type_data, label_type, np.ones(1, dtype=np.int32))
+    return (clusters_for_type, labels_for_type)
+
+# Converts labels as they come from the server (or the database) into the compact, columnar form used for clustering:
+# int32 label ids, float64 lat/lng, a categorical label type, int32 codes in place of the user ids, and nullable Int8
+# severity and temporariness. The labels are sorted by label type (keeping their order within each type), so that the
+# labels of each type are a contiguous range of rows.
+def compact_labels(label_data):
+    region_ids = label_data.region_id.values.astype(np.int32) if 'region_id' in label_data.columns else None
+    if len(label_data) == 0:
+        label_data = pd.DataFrame(columns=['label_id', 'label_type', 'lat', 'lng', 'severity', 'temporary', 'user_id'])
+    extra_types = sorted(set(label_data.label_type.values) - set(LABEL_TYPE_CATEGORIES))
+    label_type = pd.Categorical(label_data.label_type.values, categories=LABEL_TYPE_CATEGORIES + extra_types)
+    order = np.argsort(label_type.codes, kind='mergesort')
+    user_codes = pd.factorize(label_data.user_id.values)[0].astype(np.int32)
+
+    def to_float(col):
+        return pd.to_numeric(label_data[col], errors='coerce').values.astype(np.float64)[order]
+    compact = pd.DataFrame({'label_id': label_data.label_id.values.astype(np.int32)[order],
+                            'label_type': label_type.take(order),
+                            'lat': to_float('lat'),
+                            'lng': to_float('lng'),
+                            'severity': pd.Series(to_float('severity')).astype('Int8').values,
+                            'temporary': pd.Series(to_float('temporary')).astype('Int8').values,
+                            'user_code': user_codes[order]},
+                           columns=['label_id', 'label_type', 'lat', 'lng', 'severity', 'temporary', 'user_code'])
+    # City-wide clustering also needs to know which region each label came from.
+    if region_ids is not None:
+        compact['region_id'] = region_ids[order]
+    return compact
+
+# Removes labels with invalid locations, returning the remaining labels.
+def remove_invalid_labels(label_data, debug=False):
     if len(label_data) == 0:
-        response = requests.post(postURL, data=json.dumps({'thresholds': [], 'labels': [], 'clusters': []}), headers=POST_HEADER)
-        sys.exit()
+        return label_data
 
     # Remove weird entries with latitude and longitude values (on the order of 10^14).
     if sum(label_data.lng > 360) > 0:
-        if DEBUG: print 'There are %d invalid longitude vals, removing those entries.' % sum(label_data.lng > 360)
+        if debug: print 'There are %d invalid longitude vals, removing those entries.' % sum(label_data.lng > 360)
         label_data = label_data.drop(label_data[label_data.lng > 360].index)
     if sum(pd.isnull(label_data.lng)) > 0:
-        if DEBUG: print 'There are %d NaN longitude vals, removing those entries.' % sum(pd.isnull(label_data.lng))
+        if debug: print 'There are %d NaN longitude vals, removing those entries.' % sum(pd.isnull(label_data.lng))
         label_data = label_data.drop(label_data[pd.isnull(label_data.lng)].index)
 
-    # Check if there are 0 labels left after removing those with errors. If so, just send the post request and exit.
+    return label_data
+
+# Clusters the (valid) labels of each of the given label types. Returns the (label_output, cluster_output) DataFrames that
+# should be POSTed, or None if there were no labels to cluster. The groups of nearby labels from all label types are
+# clustered together, spread across the executor's worker processes. If `task_timings` is a list, a (label_type,
+# n_labels, seconds) tuple is appended to it for each group that was clustered.
+def cluster_labels(label_data, single_user, executor, label_types=LABEL_TYPES, debug=False, task_timings=None,
+                   engine='exact', linkage_cache=None):
+    thresholds = SINGLE_USER_THRESHOLDS if single_user else MULTI_USER_THRESHOLDS
+
+    # Check if there are 0 labels.
     if len(label_data) == 0:
-        response = requests.post(postURL, data=json.dumps({'thresholds': [], 'labels': [], 'clusters': []}), headers=POST_HEADER)
-        sys.exit()
+        return None
 
-    # Put lat-lng in a tuple so it plays nice w/ haversine function.
-    label_data['coords'] = label_data.apply(lambda x: (x.lat, x.lng), axis = 1)
-    label_data['id'] =  label_data.index.values
+    # If there are >1 labels of a type, we can do clustering, so plan the tasks for it. With a linkage cache (and the
+    # exact engine), label types are clustered by cutting their cached linkage trees instead.
+    use_cache = linkage_cache is not None and engine == 'exact'
+    type_data = [select_label_type(label_data, label_type, single_user) for label_type in label_types]
+    plans = [plan_label_type(type_data[i], thresholds[label_type], single_user)
+             if len(type_data[i]) > 1 and not use_cache else None
+             for (i, label_type) in enumerate(label_types)]
 
-    # Performs clustering on the data for a single label type; namely, the type at position i in the label_types array.
-    def cluster_label_type_at_index(i):
-        clusters_for_type_i = pd.DataFrame(columns=cluster_cols)
-        labels_for_type_i = pd.DataFrame(columns=label_cols)
+    # Runs the tasks of all label types at once, so the largest tasks overall get started first.
+    tasks = [task for plan in plans if plan is not None for task in plan[1]]
+    task_results = schedule_cluster_tasks(tasks, executor, engine)
+    if task_timings is not None:
+        task_types = [label_type for (label_type, plan) in zip(label_types, plans) if plan is not None for _ in plan[1]]
+        task_timings.extend((label_type, len(task[0]), seconds)
+                            for (label_type, task, (_, seconds)) in zip(task_types, tasks, task_results))
 
-        label_type = label_types[i]
-        if label_type == 'Problem':
-            type_data = label_data[label_data.label_type.isin(problem_types)]
+    clust_results_by_label_type = []
+    n_done = 0
+    for (i, label_type) in enumerate(label_types):
+        if use_cache and len(type_data[i]) > 1:
+            clust_results_by_label_type.append(cluster_from_linkage_trees(
+                type_data[i], label_type, thresholds[label_type], single_user, linkage_cache, executor))
+        elif plans[i] is None:
+            clust_results_by_label_type.append(copy_unclustered_label_type(type_data[i], label_type))
         else:
-            type_data = label_data[label_data.label_type == label_type]
-
-        # If there are >1 labels, we can do clustering. Otherwise just copy the 1 (or 0) labels.
-        if type_data.shape[0] > 1:
-            (clusters_for_type_i, labels_for_type_i) = cluster(type_data, label_type, thresholds, SINGLE_USER)
-        elif type_data.shape[0] == 1:
-            labels_for_type_i = type_data.copy()
-            labels_for_type_i.loc[:,'cluster'] = 1 # Gives the single cluster a cluster_id of 1.
-            labels_for_type_i.loc[:,'label_type'] = label_type # Gives Problem type if needed.
-            clusters_for_type_i = labels_for_type_i.filter(items=cluster_cols)
-
-        return (label_type, clusters_for_type_i, labels_for_type_i)
-
-    # Calls `func` len(`args`) times, with `workers` number of threads. Used to compute diff label type in parallel.
-    def multiprocessing(func, args, workers):
-        with ProcessPoolExecutor(max_workers=workers) as executor:
-            res = executor.map(func, args)
-        return list(res)
-
-    # Calls the clustering function via the multiprocessing function.
-    clust_results_by_label_type = multiprocessing(cluster_label_type_at_index, range(0, len(label_types)), N_PROCESSORS)
-
-    # Clustering results were done individually for each label type, so their cluster_ids start at 1 for each type. So
-    # now we offset the cluster ids for different label types so they are unique, and combine the lists.
-    label_output = pd.DataFrame(columns=label_cols)
-    cluster_output = pd.DataFrame(columns=cluster_cols)
-    clusterOffset = 0
-    for i in range(0, len(label_types)):
-        (label_type, clusters_for_type_i, labels_for_type_i) = clust_results_by_label_type[i]
-        if not label_output.empty:
-            clusterOffset = np.max(label_output.cluster)
-
-        clusters_for_type_i.cluster += clusterOffset
-        cluster_output = cluster_output.append(clusters_for_type_i)
-
-        labels_for_type_i.cluster += clusterOffset
-        label_output = label_output.append(labels_for_type_i.filter(items=label_cols))
-
-    if DEBUG:
+            (components, type_tasks, task_components) = plans[i]
+            type_results = task_results[n_done:n_done + len(type_tasks)]
+            n_done += len(type_tasks)
+            clust_results_by_label_type.append(
+                finish_label_type(type_data[i], label_type, components, task_components, type_results))
+
+    (label_output, cluster_output) = combine_label_type_results(clust_results_by_label_type)
+
+    if debug:
         print "LABEL_TYPE: N_LABELS -> N_CLUSTERS"
         print "----------------------------------"
         for label_type in label_types:
@@ -203,17 +588,923 @@ if __name__ == '__main__':
                   str(label_output[label_output.label_type == label_type].cluster.nunique()) + \
                   " -> " + str(cluster_output[cluster_output.label_type == label_type].cluster.nunique())
 
-    # Convert to JSON.
-    cluster_json = cluster_output.to_json(orient='records')
-    label_json = label_output.to_json(orient='records')
-    threshold_json = pd.DataFrame({'label_type': thresholds.keys(),
-                                   'threshold': thresholds.values()}).to_json(orient='records')
-    output_json = json.dumps({'thresholds': json.loads(threshold_json),
-                              'labels': json.loads(label_json),
-                              'clusters': json.loads(cluster_json)})
-    # print output_json
-    # print 'chars in json: ' + str(len(output_json))
-
-    # POST results.
-    response = requests.post(postURL, data=output_json, headers=POST_HEADER)
+    return (label_output, cluster_output)
+
+# Clustering results were done individually for each label type, so their cluster_ids start at 1 for each type. So we
+# offset the cluster ids for different label types by the number of clusters in the preceding types so they are unique,
+# and combine the results into single label and cluster DataFrames (concatenating each just once).
+def combine_label_type_results(clust_results_by_label_type):
+    cluster_frames = [clusters_for_type for (clusters_for_type, _) in clust_results_by_label_type]
+    label_frames = [labels_for_type.filter(items=LABEL_COLS) for (_, labels_for_type) in clust_results_by_label_type]
+
+    n_clusters = np.array([labels.cluster.max() if len(labels) > 0 else 0 for labels in label_frames], dtype=np.int64)
+    offsets = np.cumsum(n_clusters) - n_clusters
+
+    label_output = pd.concat([pd.DataFrame(columns=LABEL_COLS)] + label_frames, ignore_index=True)
+    label_output['cluster'] = label_output.cluster.values.astype(np.int64) + \
+                              np.repeat(offsets, [len(labels) for labels in label_frames])
+    cluster_output = pd.concat([pd.DataFrame(columns=CLUSTER_COLS)] + cluster_frames, ignore_index=True)
+    cluster_output['cluster'] = cluster_output.cluster.values.astype(np.int64) + \
+                                np.repeat(offsets, [len(clusters) for clusters in cluster_frames])
+
+    return (label_output, cluster_output)
+
+# Default size (in kilometers) of the square tiles that city-wide clustering splits the city into.
+DEFAULT_TILE_KM = 1.0
+
+# Clusters the labels of one tile of the city, for cluster_city. Takes a (positions, lat, lng, user_codes, groups,
+# in_core, thresholds, engine) tuple for the labels in the tile and its halo: their positions in the city's labels, the
+# label type group of each (an index into thresholds), and whether each is in the tile itself rather than the halo. A
+# group of nearby labels that is entirely inside the tile is complete (no label outside the halo can be within the
+# threshold of it), so it is clustered here. A group that reaches into the halo may continue past it, so if it has labels
+# in the tile, their positions are returned to be clustered in a second pass. Returns (positions, cluster_keys,
+# label_groups, deferred_positions), where cluster_keys are cluster numbers that are unique within the tile.
+def cluster_tile(args):
+    (positions, lat, lng, user_codes, groups, in_core, thresholds, engine) = args
+    (clustered, keys, deferred) = ([], [], [])
+    n_keys = 0
+    for group in np.unique(groups):
+        members = np.flatnonzero(groups == group)
+        threshold = thresholds[group]
+        for component in split_into_components(lat[members], lng[members], threshold):
+            rows = members[component]
+            core = in_core[rows]
+            if core.all():
+                if len(rows) == 1:
+                    clusters = np.ones(1, dtype=np.int32)
+                else:
+                    clusters = ENGINES[engine]((lat[rows], lng[rows], user_codes[rows], threshold))
+                clustered.append(rows)
+                keys.append(clusters + n_keys)
+                n_keys += np.max(clusters)
+            elif core.any():
+                deferred.append(rows)
+    if len(clustered) == 0:
+        return (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int8),
+                positions[np.concatenate(deferred)] if len(deferred) > 0 else np.empty(0, dtype=np.int64))
+    rows = np.concatenate(clustered)
+    return (positions[rows], np.concatenate(keys).astype(np.int64), groups[rows],
+            positions[np.concatenate(deferred)] if len(deferred) > 0 else np.empty(0, dtype=np.int64))
+
+# Splits the labels into square tiles of tile_km, each with a halo of halo_km around it, using an equirectangular
+# projection around the labels' mean latitude (close enough over a city for the generous halo that is used). Returns
+# a list of (positions, in_core) tuples, one per non-empty tile, largest first: the positions of the labels in the tile
+# or its halo (in increasing order), and which of them are in the tile itself.
+def plan_tiles(lat, lng, tile_km, halo_km):
+    y = AVG_EARTH_RADIUS * np.radians(lat)
+    x = AVG_EARTH_RADIUS * np.radians(lng) * np.cos(np.radians(np.mean(lat)))
+    def tile_index(z):
+        return np.floor(z / tile_km).astype(np.int64)
+    (row, col) = (tile_index(y), tile_index(x))
+    (row_lo, row_hi) = (tile_index(y - halo_km), tile_index(y + halo_km))
+    (col_lo, col_hi) = (tile_index(x - halo_km), tile_index(x + halo_km))
+
+    # Each label is in its own tile, and in the halo of at most 3 neighboring tiles (the halo is smaller than a tile).
+    n_cols = col_hi.max() - col_lo.min() + 1
+    def key(r, c):
+        return (r - row_lo.min()) * n_cols + (c - col_lo.min())
+    positions = np.arange(len(lat))
+    pairs = [(key(row_lo, col_lo), positions)]
+    for (r, c, new) in [(row_lo, col_hi, col_hi != col_lo), (row_hi, col_lo, row_hi != row_lo),
+                        (row_hi, col_hi, (row_hi != row_lo) & (col_hi != col_lo))]:
+        pairs.append((key(r, c)[new], positions[new]))
+    tile_keys = np.concatenate([k for (k, _) in pairs])
+    tile_positions = np.concatenate([p for (_, p) in pairs])
+    order = np.lexsort((tile_positions, tile_keys))
+    (tile_keys, tile_positions) = (tile_keys[order], tile_positions[order])
+    boundaries = np.flatnonzero(np.diff(tile_keys)) + 1
+
+    core_keys = key(row, col)
+    tiles = [(p, core_keys[p] == k[0]) for (p, k) in zip(np.split(tile_positions, boundaries),
+                                                        np.split(tile_keys, boundaries))]
+    return sorted(tiles, key=lambda tile: -len(tile[0]))
+
+# Runs multi-user clustering on the labels of a whole city at once. The city is split into tiles of tile_km (plus a halo)
+# that are clustered in parallel on the executor's worker processes. The groups of nearby labels that cross from one
+# tile to another are then clustered in a second pass, so every group is clustered exactly once, with all of its labels,
+# no matter which regions or tiles it spans. The result is the same as clustering all the labels together, and doesn't
+# depend on the order the tiles finish in. Returns (label_output, cluster_output) like cluster_labels, or None if there
+# are no labels.
+def cluster_city(label_data, executor=None, tile_km=DEFAULT_TILE_KM, engine='exact'):
+    thresholds = [MULTI_USER_THRESHOLDS[label_type] for label_type in LABEL_TYPES]
+    if tile_km <= 2 * max(thresholds):
+        raise ValueError('Tiles must be larger than %.3f km.' % (2 * max(thresholds)))
+    if len(label_data) == 0:
+        return None
+
+    # The multi-user label types don't overlap, so each label is in at most one group. Labels of other types are left out.
+    codes = label_data.label_type.cat.codes.values
+    categories = label_data.label_type.cat.categories
+    groups = np.full(len(label_data), -1, dtype=np.int8)
+    for (i, label_type) in enumerate(LABEL_TYPES):
+        types = MULTI_USER_PROBLEM_TYPES if label_type == 'Problem' else [label_type]
+        groups[np.in1d(codes, [categories.get_loc(t) for t in types if t in categories])] = i
+    included = np.flatnonzero(groups >= 0)
+    (lat, lng, user_codes) = (label_data.lat.values, label_data.lng.values, label_data.user_code.values)
+
+    # The halo is twice the largest threshold, which covers any distortion from the projection used to make the tiles.
+    tasks = []
+    for (tile_positions, in_core) in plan_tiles(lat[included], lng[included], tile_km, 2 * max(thresholds)):
+        p = included[tile_positions]
+        tasks.append((p, lat[p], lng[p], user_codes[p], groups[p], in_core, thresholds, engine))
+    if executor is None:
+        tile_results = [cluster_tile(task) for task in tasks]
+    else:
+        tile_results = [future.result() for future in [executor.submit(cluster_tile, task) for task in tasks]]
+
+    (positions, keys, label_groups) = ([], [], [])
+    n_keys = 0
+    for (tile_positions, tile_keys, tile_groups, _) in tile_results:
+        positions.append(tile_positions)
+        keys.append(tile_keys + n_keys)
+        label_groups.append(tile_groups)
+        n_keys += tile_keys.max() if len(tile_keys) > 0 else 0
+
+    # Second pass over the groups of labels that cross tile boundaries, which are complete once they are put together.
+    deferred = np.unique(np.concatenate([np.empty(0, dtype=np.int64)] + [d for (_, _, _, d) in tile_results]))
+    plans = []
+    for (i, label_type) in enumerate(LABEL_TYPES):
+        members = deferred[groups[deferred] == i]
+        if len(members) > 0:
+            plans.append((i, members, plan_label_type(label_data.iloc[members], thresholds[i], False)))
+    task_results = schedule_cluster_tasks([task for (_, _, plan) in plans for task in plan[1]], executor, engine)
+    n_done = 0
+    for (i, members, (components, type_tasks, task_components)) in plans:
+        component_clusters = [np.ones(1, dtype=np.int32)] * len(components)
+        for (c, (clusters, seconds)) in zip(task_components, task_results[n_done:n_done + len(type_tasks)]):
+            component_clusters[c] = clusters
+        n_done += len(type_tasks)
+        positions.append(members)
+        keys.append(combine_component_clusters(len(members), components, component_clusters).astype(np.int64) + n_keys)
+        label_groups.append(np.full(len(members), i, dtype=np.int8))
+        n_keys = keys[-1].max()
+
+    (positions, keys, label_groups) = (np.concatenate(positions), np.concatenate(keys), np.concatenate(label_groups))
+
+    # Numbers the clusters of each label type in the order of their first label, so the numbers don't depend on tiling.
+    clust_results_by_label_type = []
+    for (i, label_type) in enumerate(LABEL_TYPES):
+        selected = np.flatnonzero(label_groups == i)
+        order = selected[np.argsort(positions[selected])]
+        (type_positions, type_keys) = (positions[order], keys[order])
+        (_, first, inverse) = np.unique(type_keys, return_index=True, return_inverse=True)
+        rank = np.empty(len(first), dtype=np.int64)
+        rank[np.argsort(first)] = np.arange(1, len(first) + 1)
+        cluster_ids = rank[inverse]
+
+        type_labels = label_data.iloc[type_positions]
+        labels_for_type = pd.DataFrame({'label_id': type_labels.label_id.values,
+                                        'label_type': type_labels.label_type.values,
+                                        'cluster': cluster_ids},
+                                       columns=LABEL_COLS)
+        clusters_for_type = summarize_clusters(type_labels, label_type, cluster_ids) if len(type_labels) > 0 else \
+                            pd.DataFrame(columns=CLUSTER_COLS)
+        clust_results_by_label_type.append((clusters_for_type, labels_for_type))
+
+    return combine_label_type_results(clust_results_by_label_type)
+
+# Splits the results of cluster_city into results for each of the regions, as a dict from region_id to (label_output,
+# cluster_output), or None for a region with no clusters. Each cluster goes to the region of its label with the smallest
+# label_id, so a cluster that straddles a region boundary is posted just once.
+def split_results_by_region(label_data, results, region_ids):
+    if results is None:
+        return dict((region_id, None) for region_id in region_ids)
+    (label_output, cluster_output) = results
+    region_of_label = pd.Series(label_data.region_id.values, index=label_data.label_id.values)
+    first_label = label_output.groupby('cluster').label_id.min()
+    region_of_cluster = pd.Series(region_of_label.reindex(first_label.values).values, index=first_label.index)
+    label_regions = region_of_cluster.reindex(label_output.cluster.values).values
+    cluster_regions = region_of_cluster.reindex(cluster_output.cluster.values).values
+
+    region_results = {}
+    for region_id in region_ids:
+        (labels, clusters) = (label_regions == region_id, cluster_regions == region_id)
+        region_results[region_id] = (label_output[labels], cluster_output[clusters]) if clusters.any() else None
+    return region_results
+
+# Yields the JSON body of the POST request in pieces, serializing `chunk_rows` rows of the label and cluster DataFrames
+# at a time so that the whole body never has to be held in memory. `extra` holds any additional (small) fields.
+def generate_results_json(thresholds, label_output, cluster_output, extra=None, chunk_rows=POST_CHUNK_ROWS):
+    yield '{"thresholds": ' + json.dumps([{'label_type': t, 'threshold': thresholds[t]} for t in thresholds])
+    for (name, frame) in [('labels', label_output), ('clusters', cluster_output)]:
+        yield ', "' + name + '": ['
+        for start in range(0, len(frame), chunk_rows):
+            records = frame.iloc[start:start + chunk_rows].to_json(orient='records')
+            yield (', ' if start > 0 else '') + records[1:-1]
+        yield ']'
+    for field in sorted(extra or {}):
+        yield ', ' + json.dumps(field) + ': ' + json.dumps(extra[field])
+    yield '}'
+
+# Gzip-compresses the pieces yielded by `chunks` as they come.
+def gzip_chunks(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+# Talks to the clustering API of the server at base_url, reusing a pool of keep-alive connections (one per concurrent
+# job) across requests. Requests that fail with a connection error, a timeout, or a 5xx response are retried up to
+# `retries` times, waiting backoff, 2 * backoff, 4 * backoff, ... seconds in between. Responses may be gzipped, and the
+# results that are posted are gzipped too if `compress` is True.
+class ClusteringClient(object):
+    def __init__(self, key, base_url=DEFAULT_BASE_URL, compress=False, retries=3, backoff=0.5, timeout=600,
+                 pool_size=10):
+        self.key = key
+        self.base_url = base_url.rstrip('/')
+        self.compress = compress
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers['accept-encoding'] = 'gzip'
+        self.errors = (requests.exceptions.RequestException,)
+
+    def describe(self, job):
+        return job.get_url(self.key, self.base_url) + '\n' + job.post_url(self.key, self.base_url)
+
+    # Sends a request, retrying it if it fails in a way that might not happen again. The body is made by calling
+    # make_body() for each attempt, since a streamed body can only be sent once.
+    def send(self, method, url, make_body=None, headers=None):
+        for attempt in range(self.retries + 1):
+            try:
+                response = self.session.request(method, url, data=None if make_body is None else make_body(),
+                                                headers=headers, timeout=self.timeout)
+                if response.status_code < 500:
+                    response.raise_for_status()
+                    return response
+                error = requests.exceptions.HTTPError('%d response from server' % response.status_code,
+                                                      response=response)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                error = e
+            if attempt < self.retries:
+                print 'Retrying %s %s after error: %s' % (method, url.split('?')[0], error)
+                time.sleep(self.backoff * 2 ** attempt)
+        raise error
+
+    # GETs the labels to cluster for a job, in compact form.
+    def get_labels(self, job):
+        return self.get_labels_and_fingerprints(job)[0]
+
+    # GETs the labels to cluster for a job, in compact form, along with a dict mapping each label type to the
+    # fingerprint (see fingerprint_labels) of the labels that the user's attributes of that type were last made from.
+    # The server only has fingerprints for single-user jobs.
+    def get_labels_and_fingerprints(self, job):
+        data = self.get_data(job)
+        raw_labels = self.normalize_labels(job, data[0])
+        with instrumentation.phase('compact_labels', job=str(job), n_items=len(raw_labels)):
+            return (compact_labels(raw_labels), data[1] if len(data) > 1 else {})
+
+    # GETs the labels to cluster for a job, as a DataFrame with the columns the server returns.
+    def get_raw_labels(self, job):
+        return self.normalize_labels(job, self.get_data(job)[0])
+
+    def get_data(self, job):
+        with instrumentation.phase('http_get', job=str(job)):
+            data = self.send('GET', job.get_url(self.key, self.base_url)).json()
+        if isinstance(data, dict):
+            raise ValueError(data.get('error_msg', 'Unexpected response from server.'))
+        return data
+
+    def normalize_labels(self, job, labels):
+        with instrumentation.phase('json_normalize', job=str(job), n_items=len(labels)):
+            return json_normalize(labels)
+
+    # GETs the labels of all the given regions, up to n_concurrent regions at a time, in compact form with a region_id
+    # column.
+    def get_city_labels(self, region_ids, n_concurrent=1):
+        def get_region_labels(region_id):
+            labels = self.get_raw_labels(ClusteringJob(region_id=region_id))
+            labels['region_id'] = region_id
+            return labels
+        with ThreadPoolExecutor(max_workers=n_concurrent) as executor:
+            frames = list(executor.map(get_region_labels, region_ids))
+        return compact_labels(pd.concat([pd.DataFrame()] + frames, ignore_index=True))
+
+    # POSTs the results of clustering a job. If `results` is None (no labels to cluster), POSTs empty results. If
+    # `replace_label_types` is given, the results only cover those label types, and the server replaces the user's
+    # existing attributes of those types instead of adding to them. The server stores the `fingerprints` of the label
+    # types with their attributes. The body is streamed (with chunked transfer encoding).
+    def post_results(self, job, results, replace_label_types=None, fingerprints=None):
+        if results is None:
+            (thresholds, label_output, cluster_output) = ({}, pd.DataFrame(), pd.DataFrame())
+        else:
+            (label_output, cluster_output) = results
+            thresholds = SINGLE_USER_THRESHOLDS if job.single_user else MULTI_USER_THRESHOLDS
+        extra = {}
+        if replace_label_types is not None:
+            extra['replace_label_types'] = replace_label_types
+        if fingerprints is not None:
+            extra['fingerprints'] = fingerprints
+
+        headers = dict(POST_HEADER)
+        if self.compress:
+            headers['content-encoding'] = 'gzip'
+        # The body is serialized as it is sent, so the time spent serializing is measured separately.
+        with instrumentation.phase('http_post', job=str(job), n_items=len(label_output)) as record:
+            def make_body():
+                body = generate_results_json(thresholds, label_output, cluster_output, extra)
+                return instrumentation.timed_chunks(gzip_chunks(body) if self.compress else body, record, 'serialize')
+            return self.send('POST', job.post_url(self.key, self.base_url), make_body, headers)
+
+# Reads the labels to cluster from the database directly, using connect.py, instead of getting them from the Play server.
+# The results are still POSTed through the server (with `poster`, a ClusteringClient), so there is only one place that
+# writes them. Has the same interface as ClusteringClient. Labels are streamed from a server-side cursor into typed
+# arrays. Each concurrent job uses its own connection from the pool.
+class ClusteringDatabaseClient(object):
+    def __init__(self, poster, pool_size=10):
+        if psycopg2 is None:
+            raise ImportError("Reading labels from the database needs the psycopg2 package (pip install psycopg2).")
+        from connect import get_engine
+        self.engine = get_engine(pool_size=pool_size)
+        self.poster = poster
+        self.errors = (psycopg2.Error,) + poster.errors
+
+    def describe(self, job):
+        return 'database: ' + str(job) + '\n' + job.post_url(self.poster.key, self.poster.base_url)
+
+    # Reads the labels to cluster for a job, in compact form.
+    def get_labels(self, job):
+        if job.single_user:
+            return compact_labels(self.read_labels(USER_LABELS_QUERY, job.user_id))
+        else:
+            return compact_labels(self.read_labels(REGION_LABELS_QUERY, [job.region_id]))
+
+    # Reads the labels to cluster for a job, in compact form, along with the fingerprints that the server would return
+    # with them.
+    def get_labels_and_fingerprints(self, job):
+        if not job.single_user:
+            return (self.get_labels(job), {})
+        conn = self.engine.raw_connection()
+        try:
+            cur = conn.cursor()
+            cur.execute(USER_FINGERPRINTS_QUERY, (job.user_id,))
+            fingerprints = dict(cur.fetchall())
+            conn.commit()
+        finally:
+            conn.close()
+        return (self.get_labels(job), fingerprints)
+
+    # Reads the labels of all the given regions at once, in compact form with a region_id column.
+    def get_city_labels(self, region_ids, n_concurrent=1):
+        return compact_labels(self.read_labels(REGION_LABELS_QUERY, list(region_ids)))
+
+    # Runs one of the label queries with a server-side cursor, and returns the labels as a DataFrame with the same
+    # columns as the server returns (plus region_id for regions).
+    def read_labels(self, query, param):
+        conn = self.engine.raw_connection()
+        try:
+            cur = conn.cursor('labels_to_cluster')
+            cur.itersize = DB_FETCH_ROWS
+            cur.execute(query, (param,))
+            columns = [[] for _ in LABEL_QUERY_COLUMNS]
+            while True:
+                rows = cur.fetchmany(DB_FETCH_ROWS)
+                if len(rows) == 0:
+                    break
+                for (column, values) in zip(columns, zip(*rows)):
+                    column.append(values)
+            cur.close()
+            conn.commit()
+        finally:
+            conn.close()
+
+        n_columns = 8 if query == REGION_LABELS_QUERY else 7
+        return pd.DataFrame(OrderedDict((name, np.array([v for values in column for v in values], dtype=dtype))
+                                        for ((name, dtype), column) in zip(LABEL_QUERY_COLUMNS[:n_columns], columns)))
+
+    # POSTs the results of clustering a job through the server, like ClusteringClient.post_results.
+    def post_results(self, job, results, replace_label_types=None, fingerprints=None):
+        return self.poster.post_results(job, results, replace_label_types, fingerprints)
+
+# Adjusted Rand index between two clusterings of the same labels (1 means identical, ~0 means no better than chance).
+def adjusted_rand_index(clusters_a, clusters_b):
+    n = len(clusters_a)
+    if n < 2:
+        return 1.0
+    (_, a) = np.unique(clusters_a, return_inverse=True)
+    (_, b) = np.unique(clusters_b, return_inverse=True)
+    pair_counts = coo_matrix((np.ones(n), (a, b))).tocsr().data
+    pairs = lambda counts: np.sum(counts * (counts - 1.0) / 2)
+
+    index = pairs(pair_counts)
+    pairs_a = pairs(np.bincount(a).astype(np.float64))
+    pairs_b = pairs(np.bincount(b).astype(np.float64))
+    expected = pairs_a * pairs_b / (n * (n - 1.0) / 2)
+    max_index = (pairs_a + pairs_b) / 2
+    if max_index == expected:
+        return 1.0
+    return (index - expected) / (max_index - expected)
+
+# Clusters each label type with both the exact and the fast engine, returning a (label_type, n_labels, n_exact_clusters,
+# n_fast_clusters, adjusted rand index, exact seconds, fast seconds) tuple for each type with more than one label.
+def compare_engines(label_data, single_user, executor):
+    thresholds = SINGLE_USER_THRESHOLDS if single_user else MULTI_USER_THRESHOLDS
+    rows = []
+    for label_type in LABEL_TYPES:
+        type_data = select_label_type(label_data, label_type, single_user)
+        if len(type_data) < 2:
+            continue
+        start = time.time()
+        (exact_clusters, exact_labels) = cluster(type_data, label_type, thresholds, single_user, executor, 'exact')
+        exact_time = time.time() - start
+        start = time.time()
+        (fast_clusters, fast_labels) = cluster(type_data, label_type, thresholds, single_user, executor, 'fast')
+        fast_time = time.time() - start
+        rows.append((label_type, len(type_data), len(exact_clusters), len(fast_clusters),
+                     adjusted_rand_index(exact_labels.cluster.values, fast_labels.cluster.values), exact_time, fast_time))
+    return rows
+
+# Formats the rows returned by compare_engines as a table.
+def format_engine_report(job_name, rows):
+    lines = ['Exact vs. fast engine for %s:' % job_name,
+             '  LABEL_TYPE       N_LABELS  EXACT_CLUSTERS  FAST_CLUSTERS  DELTA      ARI  EXACT (s)  FAST (s)']
+    for (label_type, n_labels, n_exact, n_fast, ari, exact_time, fast_time) in rows:
+        lines.append('  %-15s  %8d  %14d  %13d  %+5d  %7.4f  %9.3f  %8.3f' %
+                     (label_type, n_labels, n_exact, n_fast, n_fast - n_exact, ari, exact_time, fast_time))
+    return '\n'.join(lines)
+
+# Returns a fingerprint of the labels of one label type (along with the threshold used to cluster them). If the
+# fingerprint hasn't changed since the last time they were clustered, clustering them again gives the same result.
+def fingerprint_labels(type_data, threshold):
+    sorted_data = type_data.sort_values('label_id')
+    fingerprint = hashlib.sha1(repr(threshold))
+    for col in ['label_id', 'lat', 'lng', 'severity', 'temporary']:
+        values = pd.to_numeric(sorted_data[col], errors='coerce').values.astype(np.float64)
+        fingerprint.update(np.ascontiguousarray(values).tobytes())
+    return fingerprint.hexdigest()
+
+# Computes the complete-linkage tree of one group of labels (see linkage_trees). Takes a (lat, lng, user_codes) tuple so
+# it can be run by a process pool.
+def linkage_component(args):
+    (lat, lng, user_codes) = args
+    return linkage(haversine_pdist(lat, lng, user_codes), method='complete')
+
+# Computes the complete-linkage trees of labels, split into groups that are at most `radius` apart. Cutting the trees at
+# any threshold up to the radius gives the same clusters as cluster_component does at that threshold, since complete
+# linkage never merges labels that are farther apart than the threshold it is cut at. Returns (order, sizes, links): the
+# positions of the labels, group after group, the size of each group, and the linkage matrices of the groups with more
+# than one label, one after the other (a group of n labels has n - 1 rows).
+def linkage_trees(lat, lng, user_codes, radius, executor=None):
+    components = split_into_components(lat, lng, radius)
+    tasks = [(lat[c], lng[c], None if user_codes is None else user_codes[c]) for c in components if len(c) > 1]
+    if executor is None:
+        links = [linkage_component(task) for task in tasks]
+    else:
+        links = list(executor.map(linkage_component, tasks))
+    return (np.concatenate(components), np.array([len(c) for c in components], dtype=np.int64),
+            np.concatenate([np.empty((0, 4))] + links))
+
+# Cuts the trees returned by linkage_trees at a threshold, and returns the cluster (numbered from 1) of each label.
+def linkage_tree_clusters(trees, threshold):
+    (order, sizes, links) = trees
+    starts = np.cumsum(sizes) - sizes
+    clusters = np.empty(len(order), dtype=np.int32)
+    singles = sizes == 1
+    clusters[order[starts[singles]]] = np.arange(1, singles.sum() + 1)
+    n_clusters = singles.sum()
+    link_start = 0
+    for (start, size) in zip(starts[~singles], sizes[~singles]):
+        group_clusters = fcluster(links[link_start:link_start + size - 1], t=threshold, criterion='distance')
+        clusters[order[start:start + size]] = group_clusters + n_clusters
+        n_clusters += group_clusters.max()
+        link_start += size - 1
+    return clusters
+
+# Cuts the trees returned by linkage_trees at a threshold, and returns the size of each of the resulting clusters.
+def cut_linkage_trees(trees, threshold):
+    return np.bincount(linkage_tree_clusters(trees, threshold))[1:]
+
+# Returns the key that the linkage trees of the labels of one label type are cached under. It only depends on the labels
+# (and whether they are clustered by user), not on their order, since the trees are computed on labels in label_id order.
+def linkage_key(type_data, single_user):
+    key = hashlib.sha1('single' if single_user else 'multi')
+    for col in ['label_id', 'lat', 'lng'] + ([] if single_user else ['user_code']):
+        key.update(np.ascontiguousarray(type_data[col].values.astype(np.float64)).tobytes())
+    return key.hexdigest()
+
+# Local cache (an SQLite file) of linkage trees, keyed by linkage_key and the radius the labels were split at. Trees for
+# a radius can be cut at any smaller threshold, so a lookup returns the trees with the smallest radius that is big
+# enough.
+class LinkageCache(object):
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS linkage_trees (
+                             labels_key TEXT NOT NULL,
+                             radius REAL NOT NULL,
+                             trees BLOB NOT NULL,
+                             PRIMARY KEY (labels_key, radius))""")
+        self.conn.commit()
+
+    # Returns the cached trees for the labels that can be cut at up to `radius`, or None.
+    def get(self, labels_key, radius):
+        with self.lock:
+            row = self.conn.execute('SELECT trees FROM linkage_trees WHERE labels_key = ? AND radius >= ? '
+                                    'ORDER BY radius LIMIT 1', (labels_key, radius)).fetchone()
+        if row is None:
+            return None
+        arrays = np.load(StringIO(zlib.decompress(str(row[0]))))
+        return (arrays['order'], arrays['sizes'], arrays['links'])
+
+    def put(self, labels_key, radius, trees):
+        buf = StringIO()
+        np.savez(buf, order=trees[0], sizes=trees[1], links=trees[2])
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO linkage_trees VALUES (?, ?, ?)',
+                              (labels_key, radius, sqlite3.Binary(zlib.compress(buf.getvalue()))))
+            self.conn.commit()
+
+# Returns (trees, cached): the linkage trees of the labels of one label type (in label_id order) that can be cut at up
+# to `radius`, from the cache if they are in it, or else computed and added to it.
+def cached_linkage_trees(cache, type_data, single_user, radius, executor=None):
+    labels_key = linkage_key(type_data, single_user)
+    trees = cache.get(labels_key, radius)
+    if trees is not None:
+        return (trees, True)
+    trees = linkage_trees(type_data.lat.values, type_data.lng.values,
+                          None if single_user else type_data.user_code.values, radius, executor)
+    cache.put(labels_key, radius, trees)
+    return (trees, False)
+
+# Clusters the labels of one label type by cutting their linkage trees at the threshold. This gives the same clusters
+# as cluster(), but when the labels haven't changed since they were clustered (or swept) with a threshold at least as
+# big, the trees come from the cache and only have to be cut again.
+def cluster_from_linkage_trees(labels, curr_type, threshold, single_user, cache, executor=None):
+    by_label_id = np.argsort(labels.label_id.values, kind='mergesort')
+    (trees, _) = cached_linkage_trees(cache, labels.iloc[by_label_id], single_user, threshold, executor)
+    cluster_ids = np.empty(len(labels), dtype=np.int32)
+    cluster_ids[by_label_id] = linkage_tree_clusters(trees, threshold)
+    return label_type_results(labels, curr_type, cluster_ids)
+
+# Cuts the linkage trees of each label type at each of the thresholds (and at the threshold in use), computing the trees
+# only if they aren't in the cache. Returns a (label_type, n_labels, threshold, cluster sizes, cached, linkage seconds)
+# tuple for each label type and threshold.
+def sweep_thresholds(label_data, single_user, thresholds, cache, executor=None):
+    current_thresholds = SINGLE_USER_THRESHOLDS if single_user else MULTI_USER_THRESHOLDS
+    rows = []
+    for label_type in LABEL_TYPES:
+        type_data = select_label_type(label_data, label_type, single_user)
+        if len(type_data) == 0:
+            continue
+        type_data = type_data.iloc[np.argsort(type_data.label_id.values, kind='mergesort')]
+        type_thresholds = sorted(set(thresholds) | set([current_thresholds[label_type]]))
+        radius = type_thresholds[-1]
+
+        start = time.time()
+        (trees, cached) = cached_linkage_trees(cache, type_data, single_user, radius, executor)
+        seconds = time.time() - start
+        for threshold in type_thresholds:
+            rows.append((label_type, len(type_data), threshold, cut_linkage_trees(trees, threshold), cached, seconds))
+    return rows
+
+# Formats the rows returned by sweep_thresholds as a table, marking the thresholds that are in use with a *.
+def format_sweep_report(job_name, rows, single_user):
+    current_thresholds = SINGLE_USER_THRESHOLDS if single_user else MULTI_USER_THRESHOLDS
+    lines = ['Threshold sweep for %s:' % job_name,
+             '  LABEL_TYPE       N_LABELS  THRESHOLD (km)  N_CLUSTERS  SINGLETONS  MEAN_SIZE  P90_SIZE  MAX_SIZE  LINKAGE']
+    for (label_type, n_labels, threshold, sizes, cached, seconds) in rows:
+        lines.append('  %-15s  %8d  %13.4f%s  %10d  %10d  %9.2f  %8d  %8d  %s' %
+                     (label_type, n_labels, threshold, '*' if threshold == current_thresholds[label_type] else ' ',
+                      len(sizes), (sizes == 1).sum(), sizes.mean(), np.percentile(sizes, 90, interpolation='higher'),
+                      sizes.max(), 'cached' if cached else '%.3fs' % seconds))
+    return '\n'.join(lines)
+
+# Runs clustering jobs using a shared pool of worker processes (`executor`). Single-user jobs POST the fingerprints of
+# the labels of each label type, which the server stores with the attributes; with `incremental`, they only recluster
+# and POST the label types whose labels no longer match the fingerprints the server returns with them.
+class ClusteringRunner(object):
+    def __init__(self, client, executor, incremental=False, task_report=False, engine='exact',
+                 engine_report=False, debug=False, thresholds_sweep=None, linkage_cache=None):
+        self.client = client
+        self.executor = executor
+        self.engine = engine
+        self.engine_report = engine_report
+        self.thresholds_sweep = thresholds_sweep
+        self.linkage_cache = linkage_cache
+        self.incremental = incremental
+        self.task_report = task_report
+        self.debug = debug
+
+    # Runs a clustering job from start to finish: GETs the labels, clusters them, and POSTs the results. Returns a dict
+    # with the job's outcome, the time spent in each phase (in seconds), and the number of labels and clusters.
+    def run_job(self, job):
+        timing = {'job': str(job), 'ok': False, 'n_labels': 0, 'n_clusters': 0,
+                  'fetch': 0.0, 'cluster': 0.0, 'post': 0.0, 'skipped_label_types': 0}
+        if self.debug:
+            print self.client.describe(job)
+
+        # Send GET request to get the labels to be clustered.
+        start = time.time()
+        try:
+            with instrumentation.phase('fetch', job=str(job)) as record:
+                (label_data, old_fingerprints) = self.client.get_labels_and_fingerprints(job)
+                record['n_items'] = len(label_data)
+        except Exception as e:
+            print "Failed to get labels needed to cluster for " + str(job) + ": " + str(e)
+            return timing
+        timing['fetch'] = time.time() - start
+        timing['n_labels'] = len(label_data)
+
+        start = time.time()
+        label_data = remove_invalid_labels(label_data, self.debug)
+
+        # In report mode, just compare the engines on these labels; nothing is posted.
+        if self.engine_report:
+            print format_engine_report(str(job), compare_engines(label_data, job.single_user, self.executor))
+            timing['cluster'] = time.time() - start
+            timing['ok'] = True
+            return timing
+
+        # In sweep mode, just report the clusters that each of the thresholds would give; nothing is posted.
+        if self.thresholds_sweep is not None:
+            rows = sweep_thresholds(label_data, job.single_user, self.thresholds_sweep, self.linkage_cache,
+                                    self.executor)
+            print format_sweep_report(str(job), rows, job.single_user)
+            timing['cluster'] = time.time() - start
+            timing['ok'] = True
+            return timing
+
+        # Figures out which label types need to be clustered. Label types whose labels changed since the last run
+        # (including ones that no longer have any labels) are replaced on the server, the rest are left as they are.
+        label_types = LABEL_TYPES
+        replace_label_types = None
+        fingerprints = None
+        if job.single_user:
+            fingerprints = {}
+            thresholds = SINGLE_USER_THRESHOLDS
+            for label_type in LABEL_TYPES:
+                type_data = select_label_type(label_data, label_type, job.single_user)
+                if len(type_data) > 0:
+                    fingerprints[label_type] = fingerprint_labels(type_data, thresholds[label_type])
+            if self.incremental:
+                label_types = [t for t in LABEL_TYPES if fingerprints.get(t) != old_fingerprints.get(t)]
+                replace_label_types = label_types
+                timing['skipped_label_types'] = len(LABEL_TYPES) - len(label_types)
+            fingerprints = dict((t, f) for (t, f) in fingerprints.items() if t in label_types)
+
+        task_timings = []
+        with instrumentation.phase('cluster', job=str(job), n_items=len(label_data)) as record:
+            results = cluster_labels(label_data, job.single_user, self.executor, label_types, self.debug,
+                                     task_timings, self.engine, self.linkage_cache)
+            record.update(n_tasks=len(task_timings), task_seconds=sum(seconds for (_, _, seconds) in task_timings))
+        timing['cluster'] = time.time() - start
+        timing['n_tasks'] = len(task_timings)
+        if self.task_report:
+            print format_task_report(str(job), task_timings)
+        timing['n_clusters'] = 0 if results is None else len(results[1])
+
+        # POST results, unless this is an incremental run and nothing changed.
+        start = time.time()
+        if replace_label_types != []:
+            try:
+                with instrumentation.phase('post', job=str(job), n_items=timing['n_clusters']):
+                    self.client.post_results(job, results, replace_label_types, fingerprints)
+            except self.client.errors as e:
+                print "Failed to post clustering results for " + str(job) + ": " + str(e)
+                return timing
+        timing['post'] = time.time() - start
+        timing['ok'] = True
+
+        return timing
+
+    # Runs the jobs, up to `n_concurrent` at a time. Calls `report(line)` with the timing of each job as it finishes,
+    # and returns the list of timings.
+    def run_jobs(self, jobs, n_concurrent, report):
+        timings = []
+        with ThreadPoolExecutor(max_workers=n_concurrent) as job_executor:
+            run_job = instrumentation.profiled(self.run_job)
+            futures = [job_executor.submit(run_job, job) for job in jobs]
+            for (i, future) in enumerate(as_completed(futures)):
+                timing = future.result()
+                timings.append(timing)
+                report('[%d/%d] %s' % (i + 1, len(jobs), format_timing(timing)))
+        return timings
+
+    # Runs multi-user clustering for all the given regions at once, with cluster_city, so clusters that cross region
+    # boundaries come out whole. The results are then POSTed one region at a time, up to `n_concurrent` at once. Calls
+    # `report(line)` with the timing of each region, and returns the list of timings. The first timing is the city's,
+    # with the time spent fetching and clustering the labels of all the regions (their labels and clusters are counted
+    # in the regions' timings, which only have the time spent posting).
+    def run_city(self, region_ids, n_concurrent, report, tile_km=DEFAULT_TILE_KM):
+        start = time.time()
+        try:
+            with instrumentation.phase('fetch', job='city', n_regions=len(region_ids)) as record:
+                label_data = self.client.get_city_labels(region_ids, n_concurrent)
+                record['n_items'] = len(label_data)
+        except Exception as e:
+            report("Failed to get labels needed to cluster for regions " + ', '.join(map(str, region_ids)) + ": " +
+                   str(e))
+            return [dict(job=str(ClusteringJob(region_id=r)), ok=False, n_labels=0, n_clusters=0, fetch=0.0,
+                         cluster=0.0, post=0.0, skipped_label_types=0) for r in region_ids]
+        fetch_seconds = time.time() - start
+
+        start = time.time()
+        with instrumentation.phase('cluster', job='city', n_items=len(label_data)):
+            label_data = remove_invalid_labels(label_data, self.debug)
+            results = cluster_city(label_data, self.executor, tile_km, self.engine)
+            region_results = split_results_by_region(label_data, results, region_ids)
+        cluster_seconds = time.time() - start
+        n_labels = label_data.groupby('region_id').size() if len(label_data) > 0 else pd.Series()
+        report('Clustered %d labels in %d regions into %d clusters in %.2fs (fetch %.2fs).' %
+               (len(label_data), len(region_ids), 0 if results is None else len(results[1]), cluster_seconds,
+                fetch_seconds))
+
+        def post_region(region_id):
+            job = ClusteringJob(region_id=region_id)
+            timing = {'job': str(job), 'ok': False, 'n_labels': int(n_labels.get(region_id, 0)),
+                      'n_clusters': 0 if region_results[region_id] is None else len(region_results[region_id][1]),
+                      'fetch': 0.0, 'cluster': 0.0, 'post': 0.0, 'skipped_label_types': 0}
+            start = time.time()
+            try:
+                with instrumentation.phase('post', job=str(job), n_items=timing['n_clusters']):
+                    self.client.post_results(job, region_results[region_id])
+            except self.client.errors as e:
+                print "Failed to post clustering results for " + str(job) + ": " + str(e)
+                return timing
+            timing['post'] = time.time() - start
+            timing['ok'] = True
+            return timing
+
+        timings = [{'job': 'city', 'ok': True, 'n_labels': 0, 'n_clusters': 0, 'fetch': fetch_seconds,
+                    'cluster': cluster_seconds, 'post': 0.0, 'skipped_label_types': 0}]
+        with ThreadPoolExecutor(max_workers=n_concurrent) as job_executor:
+            post_region = instrumentation.profiled(post_region)
+            futures = [job_executor.submit(post_region, region_id) for region_id in region_ids]
+            for (i, future) in enumerate(as_completed(futures)):
+                timing = future.result()
+                timings.append(timing)
+                report('[%d/%d] %s' % (i + 1, len(region_ids), format_timing(timing)))
+        return timings
+
+# Formats a report of how long the clustering tasks of a job took, per label type and for the slowest tasks.
+def format_task_report(job_name, task_timings, n_slowest=5):
+    lines = ['Clustering tasks for %s:' % job_name,
+             '  LABEL_TYPE       N_TASKS  N_LABELS  TOTAL (s)  MAX (s)']
+    for label_type in LABEL_TYPES:
+        type_timings = [(n, seconds) for (t, n, seconds) in task_timings if t == label_type]
+        if len(type_timings) > 0:
+            lines.append('  %-15s  %7d  %8d  %9.3f  %7.3f' % (label_type, len(type_timings),
+                                                          sum(n for (n, _) in type_timings),
+                                                          sum(seconds for (_, seconds) in type_timings),
+                                                          max(seconds for (_, seconds) in type_timings)))
+    for (label_type, n, seconds) in sorted(task_timings, key=lambda x: -x[2])[:n_slowest]:
+        lines.append('  slow task: %s group of %d labels took %.3fs' % (label_type, n, seconds))
+    return '\n'.join(lines)
+
+# Formats the timing info returned by ClusteringRunner.run_job as a single line.
+def format_timing(timing):
+    line = '%s: %s in %.2fs (fetch %.2fs, cluster %.2fs, post %.2fs), %d labels -> %d clusters' % \
+           (timing['job'], 'done' if timing['ok'] else 'FAILED', timing['fetch'] + timing['cluster'] + timing['post'],
+            timing['fetch'], timing['cluster'], timing['post'], timing['n_labels'], timing['n_clusters'])
+    if timing['skipped_label_types'] > 0:
+        line += ', %d unchanged label types skipped' % timing['skipped_label_types']
+    return line
+
+# Handles a connection to the clustering daemon. The client sends one job per line (and closes its side of the
+# connection or sends a blank line when done), and gets back one line with the outcome of each job as it finishes.
+# Sending "shutdown" stops the daemon once the current jobs are done.
+class ClusteringJobHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        jobs = []
+        for line in iter(self.rfile.readline, ''):
+            if line.strip() == 'shutdown':
+                # shutdown() waits for serve_forever() to return, so it has to be called from another thread.
+                threading.Thread(target=self.server.shutdown).start()
+                break
+            job = parse_job(line)
+            if job is None:
+                break
+            jobs.append(job)
+
+        lock = threading.Lock()
+        def report(line):
+            with lock:
+                self.wfile.write(line + '\n')
+                self.wfile.flush()
+        self.server.runner.run_jobs(jobs, self.server.n_concurrent, report)
+
+# Local TCP server that runs clustering jobs sent to it using one warm pool of worker processes.
+class ClusteringDaemon(SocketServer.ThreadingTCPServer):
+    allow_reuse_address = True
+
+    def __init__(self, port, runner, n_concurrent):
+        SocketServer.ThreadingTCPServer.__init__(self, ('127.0.0.1', port), ClusteringJobHandler)
+        self.runner = runner
+        self.n_concurrent = n_concurrent
+
+if __name__ == '__main__':
+
+    # Read in arguments from command line.
+    parser = argparse.ArgumentParser(description='Gets a set of labels, posts the labels grouped into clusters.')
+    parser.add_argument('--key', type=str,
+                        help='Key string that is used to authenticate when using API.')
+    parser.add_argument('--user_id', type=str, action='append', default=[],
+                        help='User id of a single user who\'s labels should be clustered. Can be given multiple times.')
+    parser.add_argument('--region_id', type=int, action='append', default=[],
+                        help='Region id of a region who\'s user-clustered should be clustered. Can be given multiple times.')
+    parser.add_argument('--stdin', action='store_true',
+                        help='Also read jobs from stdin, one per line: "user_id <user_id>" or "region_id <region_id>".')
+    parser.add_argument('--listen', type=int, metavar='PORT',
+                        help='Run as a daemon, reading jobs (same format as --stdin) from connections on localhost:PORT.')
+    parser.add_argument('--concurrent_jobs', type=int, default=4,
+                        help='Max number of jobs to run at the same time.')
+    parser.add_argument('--city', action='store_true',
+                        help='Cluster all the region jobs together as one city, so clusters that cross region '
+                             'boundaries come out whole, then post the results of each region.')
+    parser.add_argument('--tile_km', type=float, default=DEFAULT_TILE_KM,
+                        help='Size in kilometers of the tiles the city is split into for --city.')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Only recluster (and post) the label types of each user whose labels changed since they '
+                             'were last clustered (going by the fingerprints the server stores with the attributes). '
+                             'The server replaces just those label types.')
+    parser.add_argument('--workers', type=int, default=cpu_count(),
+                        help='Number of worker processes used for clustering (defaults to the number of CPUs).')
+    parser.add_argument('--engine', choices=sorted(ENGINES.keys()), default='exact',
+                        help='exact: complete linkage. fast: approximation of complete linkage for groups of more than '
+                             '%d nearby labels.' % FAST_ENGINE_MIN_SIZE)
+    parser.add_argument('--engine_report', action='store_true',
+                        help='Instead of posting results, compare the exact and fast engines on each job\'s labels.')
+    parser.add_argument('--thresholds_sweep', type=str, default=None, metavar='THRESHOLDS',
+                        help='Instead of posting results, report the clusters each job would get with each of these '
+                             'comma-separated thresholds (in km), from linkage trees cached in --linkage_cache (if given).')
+    parser.add_argument('--linkage_cache', type=str, default=None,
+                        help='SQLite file to keep the linkage trees of the labels in. Jobs then cut the cached trees '
+                             'instead of clustering again when their labels haven\'t changed since a run (or sweep) '
+                             'with thresholds at least as big. Only used with the exact engine.')
+    parser.add_argument('--task_report', action='store_true',
+                        help='Print how long the clustering tasks of each job took.')
+    parser.add_argument('--gzip', action='store_true',
+                        help='Gzip-compress the results that are posted (the server must accept gzip request bodies).')
+    parser.add_argument('--source', choices=['api', 'db'], default='api',
+                        help='api: get labels from and post results to the server at --base_url. db: read labels from '
+                             'the database directly (connecting with ~/.pgpass via connect.py); results are still '
+                             'posted to the server at --base_url.')
+    parser.add_argument('--base_url', type=str, default=DEFAULT_BASE_URL,
+                        help='Base URL of the server to get labels from and post results to.')
+    parser.add_argument('--retries', type=int, default=3,
+                        help='Number of times to retry a request that failed with a connection error, timeout or 5xx.')
+    parser.add_argument('--timeout', type=float, default=600,
+                        help='Seconds to wait for the server to respond to a request.')
+    parser.add_argument('--debug', action='store_true',
+                        help='Debug mode adds print statements')
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+    instrumentation.configure(args, 'label_clustering')
+    KEY = args.key
+    DEBUG = args.debug
+
+    # Determine which clustering jobs should be run from command line args.
+    jobs = [ClusteringJob(user_id=user_id.strip('\'\"')) for user_id in args.user_id] + \
+           [ClusteringJob(region_id=region_id) for region_id in args.region_id]
+    if args.stdin:
+        jobs += [job for job in map(parse_job, sys.stdin) if job is not None]
+
+    def report(line):
+        sys.stdout.write(line + '\n')
+        sys.stdout.flush()
+
+    linkage_cache = LinkageCache(args.linkage_cache) if args.linkage_cache is not None else None
+    thresholds_sweep = None
+    if args.thresholds_sweep is not None:
+        thresholds_sweep = [float(threshold) for threshold in args.thresholds_sweep.split(',')]
+        if linkage_cache is None:
+            linkage_cache = LinkageCache(':memory:')
+
+    # All jobs share one pool of worker processes, so we only pay for starting them up once.
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        client = ClusteringClient(KEY, args.base_url, args.gzip, args.retries, timeout=args.timeout,
+                                  pool_size=args.concurrent_jobs)
+        if args.source == 'db':
+            client = ClusteringDatabaseClient(client, pool_size=args.concurrent_jobs)
+        runner = ClusteringRunner(client, executor, args.incremental, args.task_report, args.engine,
+                                  args.engine_report, DEBUG, thresholds_sweep, linkage_cache)
+        if args.listen:
+            report('Listening for clustering jobs on localhost:%d' % args.listen)
+            daemon = ClusteringDaemon(args.listen, runner, args.concurrent_jobs)
+            daemon.serve_forever()
+            daemon.server_close()
+        else:
+            start = time.time()
+            if args.city:
+                # Region jobs are clustered together as a city; user jobs are run as usual.
+                region_ids = [job.region_id for job in jobs if not job.single_user]
+                timings = runner.run_jobs([job for job in jobs if job.single_user], args.concurrent_jobs, report)
+                if len(region_ids) > 0:
+                    timings += runner.run_city(region_ids, args.concurrent_jobs, report, args.tile_km)
+            else:
+                timings = runner.run_jobs(jobs, args.concurrent_jobs, report)
+            if len(jobs) > 1:
+                report('Finished %d jobs (%d failed) in %.2fs (fetch %.2fs, cluster %.2fs, post %.2fs in total), '
+                       '%d labels -> %d clusters.' %
+                       (len(jobs), sum(not t['ok'] for t in timings), time.time() - start,
+                        sum(t['fetch'] for t in timings), sum(t['cluster'] for t in timings),
+                        sum(t['post'] for t in timings), sum(t['n_labels'] for t in timings),
+                        sum(t['n_clusters'] for t in timings)))
+    instrumentation.close()
     sys.exit()
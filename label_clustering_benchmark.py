@@ -0,0 +1,183 @@
+import numpy as np
+import pandas as pd
+import argparse
+import time
+import json
+import csv
+import os
+import resource
+from collections import OrderedDict
+from multiprocessing import Process, Queue
+from label_clustering import remove_invalid_labels, select_label_type, cluster, cluster_labels, compact_labels, \
+    LABEL_TYPES, MULTI_USER_THRESHOLDS, SINGLE_USER_THRESHOLDS, SINGLE_USER_PROBLEM_TYPES
+
+# Runs the clustering pipeline on synthetic cities (see SCENARIOS), records wall time, peak memory and cluster counts for
+# each, and optionally saves them as a baseline (JSON or CSV) or compares them against one. The comparisons of the
+# current code against the code it replaced are in label_clustering_comparisons.py.
+#
+# Usage: python label_clustering_benchmark.py [--scenarios NAME ...] [--scale 1.0] [--engine exact]
+#                                             [--save baseline.json] [--compare baseline.json]
+
+# Share of each label type among the labels of a synthetic city, roughly the mix seen on the live site.
+DEFAULT_TYPE_MIX = OrderedDict([('CurbRamp', 0.35), ('NoCurbRamp', 0.1), ('Obstacle', 0.1), ('SurfaceProblem', 0.15),
+                                ('NoSidewalk', 0.15), ('Occlusion', 0.05), ('Other', 0.1)])
+
+# Generates a synthetic city of n labels shaped like the labels returned by the /userLabelsToCluster (single_user) or
+# /clusteredLabelsInRegion endpoints. Labels are placed by n_users users around "true" locations spread over a square
+# of side area_km, with labels_per_location labels per location on average (the density). Each label's type is drawn
+# from type_mix, its severity and temporary fields are null with probability null_fraction, and malformed_fraction of
+# the labels get a longitude > 360 or NaN, like the ones label_clustering.remove_invalid_labels drops.
+def generate_city(n, n_users=20, labels_per_location=4.0, area_km=5.0, type_mix=DEFAULT_TYPE_MIX, null_fraction=0.3,
+                  malformed_fraction=0.0, single_user=False, seed=0):
+    rng = np.random.RandomState(seed)
+    n_locations = max(1, int(n / labels_per_location))
+    lat_span = area_km / 111.0
+    lng_span = area_km / (111.0 * np.cos(np.radians(38.9)))
+    centers = np.column_stack([rng.uniform(38.9, 38.9 + lat_span, n_locations),
+                               rng.uniform(-77.0, -77.0 + lng_span, n_locations)])
+    lat_lng = centers[rng.randint(0, n_locations, n)] + rng.normal(0, 0.00002, (n, 2)) # ~2m of noise.
+
+    types = np.array(type_mix.keys())
+    label_types = types[rng.choice(len(types), n, p=np.array(type_mix.values()) / np.sum(type_mix.values()))]
+    if not single_user:
+        label_types[np.in1d(label_types, SINGLE_USER_PROBLEM_TYPES)] = 'Problem'
+
+    severity = pd.Series(rng.randint(1, 6, n), dtype=object)
+    severity[rng.rand(n) < null_fraction] = None
+    temporary = pd.Series(rng.rand(n) < 0.1, dtype=object)
+    temporary[rng.rand(n) < null_fraction] = None
+
+    malformed = np.flatnonzero(rng.rand(n) < malformed_fraction)
+    lat_lng[malformed[::2], 1] = 1e14
+    lat_lng[malformed[1::2], 1] = np.nan
+
+    return pd.DataFrame({'label_id': np.arange(1, n + 1),
+                         'label_type': label_types,
+                         'lat': lat_lng[:, 0],
+                         'lng': lat_lng[:, 1],
+                         'severity': severity,
+                         'temporary': temporary,
+                         'user_id': ['user-' + str(u) for u in rng.randint(0, n_users, n)]})
+
+# The synthetic cities the benchmark runs: name -> arguments to generate_city. Sizes are multiplied by --scale.
+SCENARIOS = OrderedDict([
+    ('single-user', dict(n=2000, n_users=1, labels_per_location=1.2, single_user=True)),
+    ('single-user-dense', dict(n=5000, n_users=1, labels_per_location=3.0, area_km=1.0, single_user=True)),
+    ('region-small', dict(n=5000, n_users=10)),
+    ('region-many-users', dict(n=20000, n_users=500, labels_per_location=6.0)),
+    ('region-dense', dict(n=20000, n_users=50, labels_per_location=10.0, area_km=2.0)),
+    ('region-curb-ramps', dict(n=20000, n_users=50, type_mix=OrderedDict([('CurbRamp', 0.9), ('Other', 0.1)]))),
+    ('region-null-fields', dict(n=10000, n_users=50, null_fraction=0.9)),
+    ('region-malformed', dict(n=10000, n_users=50, malformed_fraction=0.05)),
+    ('city', dict(n=100000, n_users=1000, area_km=15.0)),
+])
+
+# Runs one scenario in this process: generates the city, times cluster() on each label type, then the whole per-type
+# pipeline (remove_invalid_labels and cluster_labels, as run_job does), and puts a dict of the measurements on the queue.
+def measure_scenario(name, params, engine, queue):
+    labels = compact_labels(generate_city(**params))
+    single_user = params.get('single_user', False)
+    thresholds = SINGLE_USER_THRESHOLDS if single_user else MULTI_USER_THRESHOLDS
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    valid_labels = remove_invalid_labels(labels)
+    cluster_time = 0.0
+    for label_type in LABEL_TYPES:
+        type_data = select_label_type(valid_labels, label_type, single_user)
+        if len(type_data) > 1:
+            (seconds, _) = timed(lambda: cluster(type_data, label_type, thresholds, single_user, engine=engine))
+            cluster_time += seconds
+
+    (pipeline_time, result) = timed(lambda: cluster_labels(remove_invalid_labels(labels), single_user, None,
+                                                           engine=engine))
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    queue.put(OrderedDict([('scenario', name),
+                           ('engine', engine),
+                           ('n_labels', len(labels)),
+                           ('n_valid_labels', len(valid_labels)),
+                           ('n_clusters', 0 if result is None else len(result[1])),
+                           ('cluster_seconds', round(cluster_time, 4)),
+                           ('pipeline_seconds', round(pipeline_time, 4)),
+                           ('peak_mb', round((rss_after - rss_before) / 1024.0, 1))]))
+
+# Runs each scenario in a fresh process so that the peak memory of each is independent of the others. The sizes of the
+# scenarios are multiplied by scale. Returns the measurements as a list of dicts.
+def run_suite(names, scale, engine):
+    records = []
+    for name in names:
+        params = dict(SCENARIOS[name], n=max(2, int(SCENARIOS[name]['n'] * scale)))
+        queue = Queue()
+        process = Process(target=measure_scenario, args=(name, params, engine, queue))
+        process.start()
+        records.append(queue.get())
+        process.join()
+        print '%-20s  %8d  %8d  %10d  %11.3f  %12.3f  %9.1f' % \
+              (name, records[-1]['n_labels'], records[-1]['n_valid_labels'], records[-1]['n_clusters'],
+               records[-1]['cluster_seconds'], records[-1]['pipeline_seconds'], records[-1]['peak_mb'])
+    return records
+
+# Saves suite measurements as JSON or CSV, depending on the extension of the path.
+def save_baseline(path, records):
+    if os.path.splitext(path)[1].lower() == '.csv':
+        with open(path, 'wb') as f:
+            writer = csv.DictWriter(f, fieldnames=records[0].keys())
+            writer.writeheader()
+            writer.writerows(records)
+    else:
+        with open(path, 'w') as f:
+            json.dump(records, f, indent=2)
+
+# Loads suite measurements saved by save_baseline, as a dict from scenario name to measurements.
+def load_baseline(path):
+    with open(path, 'rb') as f:
+        if os.path.splitext(path)[1].lower() == '.csv':
+            records = list(csv.DictReader(f))
+        else:
+            records = json.load(f)
+    return {r['scenario']: r for r in records}
+
+# Prints how the suite measurements compare to a baseline: time and memory ratios, and changes in cluster counts.
+def compare_to_baseline(records, baseline):
+    print 'SCENARIO              PIPELINE (s)  BASELINE (s)  SPEEDUP  PEAK (MB)  BASELINE (MB)  CLUSTERS  BASELINE'
+    print '-----------------------------------------------------------------------------------------------------'
+    for record in records:
+        if record['scenario'] not in baseline:
+            print '%-20s  (not in baseline)' % record['scenario']
+            continue
+        base = baseline[record['scenario']]
+        base_time = float(base['pipeline_seconds'])
+        print '%-20s  %12.3f  %12.3f  %6.2fx  %9.1f  %13.1f  %8d  %8d%s' % \
+              (record['scenario'], record['pipeline_seconds'], base_time,
+               base_time / max(record['pipeline_seconds'], 1e-9), record['peak_mb'], float(base['peak_mb']),
+               record['n_clusters'], int(base['n_clusters']),
+               '' if int(base['n_clusters']) == record['n_clusters'] else '  CHANGED')
+
+# Returns (seconds, result) for a single call of func().
+def timed(func):
+    start = time.time()
+    result = func()
+    return time.time() - start, result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Runs the clustering pipeline on synthetic city scenarios.')
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS.keys(), default=SCENARIOS.keys(),
+                        help='Scenarios to run (default: all).')
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='Multiplies the number of labels of each scenario.')
+    parser.add_argument('--engine', choices=['exact', 'fast'], default='exact',
+                        help='Clustering engine to use.')
+    parser.add_argument('--save', default=None,
+                        help='Save the measurements to this JSON or CSV file, to be used as a baseline.')
+    parser.add_argument('--compare', default=None,
+                        help='Compare the measurements against a baseline saved with --save.')
+    args = parser.parse_args()
+
+    print 'SCENARIO              N_LABELS   N_VALID  N_CLUSTERS  CLUSTER (s)  PIPELINE (s)  PEAK (MB)'
+    print '-----------------------------------------------------------------------------------------'
+    records = run_suite(args.scenarios, args.scale, args.engine)
+    if args.save is not None:
+        save_baseline(args.save, records)
+    if args.compare is not None:
+        print
+        compare_to_baseline(records, load_baseline(args.compare))
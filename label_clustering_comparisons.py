@@ -0,0 +1,228 @@
+import numpy as np
+import pandas as pd
+import argparse
+import json
+import resource
+import cPickle
+from collections import OrderedDict
+from multiprocessing import Process, Queue
+from haversine import haversine
+from scipy.cluster.hierarchy import linkage, fcluster
+from scipy.spatial.distance import pdist
+from pandas.io.json import json_normalize
+from label_clustering import haversine_pdist, custom_dist, split_into_components, cluster_component, \
+    combine_label_type_results, generate_results_json, select_label_type, compact_labels, LABEL_TYPES, LABEL_COLS, \
+    CLUSTER_COLS, MULTI_USER_THRESHOLDS
+from label_clustering_benchmark import generate_city, timed
+
+# Compares parts of label_clustering.py against the code they replaced, on synthetic labels of each of the given sizes
+# (see COMPARISONS):
+#   distances: the vectorized haversine_pdist against the original pdist + Python lambda path, checking that both give
+#              the same distances and the same clusters.
+#   partition: clustering each group of nearby labels separately (as label_clustering.cluster() does) against one
+#              linkage over all the labels.
+#   assembly:  the old and new ways of combining the per-label-type results and serializing the POST body.
+#   memory:    the memory used by labels as parsed from JSON against the compact form from compact_labels.
+# The benchmark of the clustering pipeline as a whole is in label_clustering_benchmark.py.
+#
+# Usage: python label_clustering_comparisons.py [--comparisons NAME ...] [--sizes 1000 5000 20000] [--threshold 0.0075]
+#                                               [--skip-reference-above N]
+
+# Generates n synthetic labels scattered around n / 4 "true" locations in a ~5km x 5km area, placed by n_users users.
+def generate_labels(n, n_users=20, seed=0):
+    rng = np.random.RandomState(seed)
+    centers = np.column_stack([rng.uniform(38.88, 38.93, max(1, n // 4)), rng.uniform(-77.05, -76.99, max(1, n // 4))])
+    picks = rng.randint(0, len(centers), n)
+    lat_lng = centers[picks] + rng.normal(0, 0.00002, (n, 2)) # ~2m of noise.
+    return pd.DataFrame({'lat': lat_lng[:, 0],
+                         'lng': lat_lng[:, 1],
+                         'user_id': ['user-' + str(u) for u in rng.randint(0, n_users, n)]})
+
+# Condensed distance matrix computed the way label_clustering.py used to, with a Python call per pair of labels.
+def reference_pdist(labels, single_user):
+    if single_user:
+        return pdist(np.array(labels[['lat', 'lng']].values), lambda x, y: haversine(x, y))
+    else:
+        return pdist(np.array(labels[['lat', 'lng', 'user_id']].values), custom_dist)
+
+# Computes the distance matrix of n labels with haversine_pdist and with reference_pdist, in each mode. Prints the time
+# taken by each, the largest difference between their distances, and whether they give the same clusters.
+def compare_distances(n, args):
+    labels = generate_labels(n)
+    for single_user in [True, False]:
+        user_ids = None if single_user else labels.user_id.values
+        vec_time, vec_dists = timed(lambda: haversine_pdist(labels.lat.values, labels.lng.values, user_ids))
+        mode = 'single-user' if single_user else 'multi-user'
+
+        if args.skip_reference_above is not None and n > args.skip_reference_above:
+            print '%8d  %-12s  %10s  %14.3f  %7s  %17s  %13s' % (n, mode, 'skipped', vec_time, '-', '-', '-')
+            continue
+
+        ref_time, ref_dists = timed(lambda: reference_pdist(labels, single_user))
+        max_diff = np.max(np.abs(ref_dists - vec_dists))
+        ref_clusters = fcluster(linkage(ref_dists, method='complete'), t=args.threshold, criterion='distance')
+        vec_clusters = fcluster(linkage(vec_dists, method='complete'), t=args.threshold, criterion='distance')
+        same_clusters = np.array_equal(ref_clusters, vec_clusters)
+        print '%8d  %-12s  %10.3f  %14.3f  %6.1fx  %17.3g  %13s' % \
+              (n, mode, ref_time, vec_time, ref_time / vec_time, max_diff, same_clusters)
+
+# Checks whether two arrays of cluster ids put the labels into the same clusters, regardless of how they are numbered.
+def same_partition(a, b):
+    pairs = pd.DataFrame({'a': a, 'b': b}).drop_duplicates()
+    return len(pairs) == len(np.unique(a)) == len(np.unique(b))
+
+# Clusters the labels after splitting them into groups of nearby labels, and with a single linkage over all of them.
+# Prints the time taken by each, the size of the full distance matrix, the largest group, and whether the clusters match.
+def compare_partitioned(labels, threshold, single_user):
+    lat = labels.lat.values
+    lng = labels.lng.values
+    user_ids = None if single_user else labels.user_id.values
+    n = len(labels)
+
+    def partitioned():
+        components = split_into_components(lat, lng, threshold)
+        cluster_ids = np.empty(n, dtype=np.int64)
+        offset = 0
+        for c in components:
+            clusters = cluster_component((lat[c], lng[c], None if single_user else user_ids[c], threshold))
+            cluster_ids[c] = clusters + offset
+            offset += np.max(clusters)
+        return (cluster_ids, max(len(c) for c in components))
+
+    part_time, (part_clusters, largest) = timed(partitioned)
+    full_time, full_clusters = timed(lambda: cluster_component((lat, lng, user_ids, threshold)))
+    print '%8d  %-12s  %10.3f  %14.3f  %10.1f  %13d  %13s' % \
+          (n, 'single-user' if single_user else 'multi-user', full_time, part_time,
+           n * (n - 1) / 2 * 8 / 1e6, largest, same_partition(part_clusters, full_clusters))
+
+# Runs compare_partitioned on n labels in each mode.
+def compare_partitions(n, args):
+    labels = generate_labels(n)
+    for single_user in [True, False]:
+        compare_partitioned(labels, args.threshold, single_user)
+
+# Makes per-label-type clustering results for n labels, shaped like the (clusters, labels) pairs that
+# label_clustering.label_type_results returns for each label type and combine_label_type_results takes.
+def generate_label_type_results(n, seed=0):
+    labels = generate_labels(n, seed=seed)
+    rng = np.random.RandomState(seed)
+    labels['label_id'] = np.arange(1, n + 1)
+    labels['severity'] = np.where(rng.rand(n) < 0.3, np.nan, rng.randint(1, 6, n))
+    labels['temporary'] = rng.rand(n) < 0.1
+    labels['id'] = labels.index.values
+
+    results = []
+    for (i, type_data) in enumerate(np.array_split(labels, len(LABEL_TYPES))):
+        type_data = type_data.copy()
+        type_data['label_type'] = LABEL_TYPES[i]
+        type_data['cluster'] = np.arange(len(type_data)) // 2 + 1 # Two labels per cluster.
+        clusters = type_data.groupby('cluster').first().reset_index().filter(items=CLUSTER_COLS)
+        results.append((clusters, type_data))
+    return results
+
+# The way label_clustering.py used to combine the results of each label type and build the body of the POST request.
+def old_assembly(results):
+    label_output = pd.DataFrame(columns=LABEL_COLS)
+    cluster_output = pd.DataFrame(columns=CLUSTER_COLS)
+    clusterOffset = 0
+    for (clusters_for_type_i, labels_for_type_i) in results:
+        if not label_output.empty:
+            clusterOffset = np.max(label_output.cluster)
+        clusters_for_type_i.cluster += clusterOffset
+        cluster_output = cluster_output.append(clusters_for_type_i)
+        labels_for_type_i.cluster += clusterOffset
+        label_output = label_output.append(labels_for_type_i.filter(items=LABEL_COLS))
+
+    thresholds = MULTI_USER_THRESHOLDS
+    cluster_json = cluster_output.to_json(orient='records')
+    label_json = label_output.to_json(orient='records')
+    threshold_json = pd.DataFrame({'label_type': thresholds.keys(),
+                                   'threshold': thresholds.values()}).to_json(orient='records')
+    output_json = json.dumps({'thresholds': json.loads(threshold_json),
+                              'labels': json.loads(label_json),
+                              'clusters': json.loads(cluster_json)})
+    return len(output_json)
+
+# Combines the results and streams the body of the POST request (to nowhere), the way label_clustering.py does now.
+def new_assembly(results):
+    (label_output, cluster_output) = combine_label_type_results(results)
+    return sum(len(chunk) for chunk in generate_results_json(MULTI_USER_THRESHOLDS, label_output, cluster_output))
+
+# Runs one of the assembly functions on n labels in a fresh process, and puts (seconds, extra peak RSS in MB, body size
+# in MB) on the queue. The extra peak RSS is the peak RSS of the process minus its RSS before the assembly started.
+def measure_assembly(assembly, n, queue):
+    results = generate_label_type_results(n)
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    (seconds, body_size) = timed(lambda: assembly(results))
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    queue.put((seconds, (rss_after - rss_before) / 1024.0, body_size / 1e6))
+
+# Runs measure_assembly in a child process so the peak RSS of each measurement is independent of the others.
+def compare_assembly(n):
+    measurements = []
+    for assembly in [old_assembly, new_assembly]:
+        queue = Queue()
+        process = Process(target=measure_assembly, args=(assembly, n, queue))
+        process.start()
+        measurements.append(queue.get())
+        process.join()
+    ((old_time, old_rss, old_size), (new_time, new_rss, new_size)) = measurements
+    print '%8d  %10.2f  %10.2f  %14.1f  %14.1f  %9.1f  %9.1f' % \
+          (n, old_time, new_time, old_rss, new_rss, old_size, new_size)
+
+# Compares labels as they used to be kept (parsed from the server's JSON by json_normalize, plus an id column) with the
+# compact form from compact_labels, for a region of n labels: bytes per label in memory and when pickled (as they would
+# be to send them to a worker process), and the MB copied to make the subsets of labels for each label type.
+def compare_label_memory(n):
+    city = generate_city(n, n_users=max(1, n // 40))
+    old = json_normalize(json.loads(city.to_json(orient='records')))
+    old['id'] = old.index.values
+    new = compact_labels(old.drop('id', axis=1))
+
+    sizes = []
+    for labels in [old, new]:
+        type_data = [select_label_type(labels, label_type, False) for label_type in LABEL_TYPES]
+        copied = sum(data.memory_usage(deep=True).sum() for data in type_data
+                     if len(data) > 0 and not np.shares_memory(data.lat.values, labels.lat.values))
+        sizes.append((labels.memory_usage(deep=True).sum() / float(n),
+                      len(cPickle.dumps(labels, cPickle.HIGHEST_PROTOCOL)) / float(n), copied / 1e6))
+    ((old_mem, old_pickle, old_copied), (new_mem, new_pickle, new_copied)) = sizes
+    print '%8d  %9.1f  %9.1f  %4.1fx  %10.1f  %10.1f  %4.1fx  %11.2f  %11.2f' % \
+          (n, old_mem, new_mem, old_mem / new_mem, old_pickle, new_pickle, old_pickle / new_pickle, old_copied,
+           new_copied)
+
+# The comparisons this script can run: name -> (header of its table, function that prints the rows for n labels).
+COMPARISONS = OrderedDict([
+    ('distances', ('N_LABELS  MODE          LAMBDA (s)  VECTORIZED (s)  SPEEDUP  MAX ABS DIFF (km)  SAME CLUSTERS',
+                   compare_distances)),
+    ('partition', ('N_LABELS  MODE          FULL (s)    PARTITIONED (s)  FULL (MB)  LARGEST GROUP  SAME CLUSTERS',
+                   compare_partitions)),
+    ('assembly', ('N_LABELS  OLD (s)     NEW (s)     OLD PEAK (MB)   NEW PEAK (MB)   OLD BODY   NEW BODY',
+                  lambda n, args: compare_assembly(n))),
+    ('memory', ('N_LABELS  OLD B/LBL  NEW B/LBL  RATIO  OLD PICKLE  NEW PICKLE  RATIO  OLD COPY MB  NEW COPY MB',
+                lambda n, args: compare_label_memory(n))),
+])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compares parts of the clustering code against the code they '
+                                                 'replaced.')
+    parser.add_argument('--comparisons', nargs='+', choices=COMPARISONS.keys(), default=COMPARISONS.keys(),
+                        help='Comparisons to run (default: all).')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 5000, 20000],
+                        help='Numbers of labels to compare on.')
+    parser.add_argument('--threshold', type=float, default=0.0075,
+                        help='Clustering threshold in kilometers used to compare the resulting clusters.')
+    parser.add_argument('--skip-reference-above', type=int, default=None,
+                        help='Skip the (slow) lambda path of the distances comparison for sizes above this number of '
+                             'labels.')
+    args = parser.parse_args()
+
+    for (i, name) in enumerate(args.comparisons):
+        (header, compare) = COMPARISONS[name]
+        if i > 0:
+            print
+        print header
+        print '-' * len(header)
+        for n in args.sizes:
+            compare(n, args)
@@ -0,0 +1,159 @@
+import csv
+import threading
+import unittest
+from datetime import datetime
+from StringIO import StringIO
+
+import botocore.exceptions
+
+import hit_approve_assignment
+
+# Tests of the review pipeline in hit_approve_assignment.py, against a fake MTurk client. Nothing is sent to MTurk and
+# no database is needed.
+#
+#   python -m unittest test_hit_approve_assignment
+
+# The amt_assignment rows, as index_assignments gets them from the database. hit-4 is reviewable but not ours.
+AMT_ASSIGNMENT_ROWS = [
+    {'hit_id': 'hit-1', 'assignment_id': 'asg-1', 'turker_id': 'alice', 'confirmation_code': 'code-1'},
+    {'hit_id': 'hit-1', 'assignment_id': 'asg-2', 'turker_id': 'bob', 'confirmation_code': 'code-2'},
+    {'hit_id': 'hit-1', 'assignment_id': 'asg-3', 'turker_id': 'carol', 'confirmation_code': 'code-3'},
+    {'hit_id': 'hit-2', 'assignment_id': 'asg-4', 'turker_id': 'dave', 'confirmation_code': 'code-4'},
+    {'hit_id': 'hit-2', 'assignment_id': 'asg-5', 'turker_id': 'erin', 'confirmation_code': 'code-5'},
+    {'hit_id': 'hit-3', 'assignment_id': 'asg-6', 'turker_id': 'frank', 'confirmation_code': 'code-6'},
+]
+
+
+def make_assignment(hit_id, assignment_id, worker_id, code):
+    return {'HITId': hit_id, 'AssignmentId': assignment_id, 'WorkerId': worker_id, 'AssignmentStatus': 'Submitted',
+            'Answer': '<Answer><FreeText>' + code + '</FreeText></Answer>',
+            'AcceptTime': datetime(2018, 1, 1, 12, 0), 'SubmitTime': datetime(2018, 1, 1, 12, 30)}
+
+
+def client_error(code, operation):
+    return botocore.exceptions.ClientError({'Error': {'Code': code, 'Message': code}}, operation)
+
+
+# Stands in for the MTurk client. Lists results a page of `page_size` at a time (whatever MaxResults says), so that
+# the results have to be joined through NextToken. Listing the assignments of a HIT in `fail_listing` raises a
+# ServiceFault. Approving an assignment in `approved` (approved already, e.g. by an earlier attempt whose response was
+# lost) raises a RequestError, like MTurk does.
+class FakeMTurk(object):
+    def __init__(self, hits, assignments, page_size=2, fail_listing=(), approved=()):
+        self.hits = hits
+        self.assignments = assignments
+        self.page_size = page_size
+        self.fail_listing = set(fail_listing)
+        self.approved = set(approved)
+        self.approve_calls = []
+        self.lock = threading.Lock()
+
+    def page(self, items, key, MaxResults, NextToken=None):
+        start = int(NextToken or 0)
+        page = {key: items[start:start + self.page_size], 'NumResults': len(items[start:start + self.page_size])}
+        if start + self.page_size < len(items):
+            page['NextToken'] = str(start + self.page_size)
+        return page
+
+    def list_reviewable_hits(self, **kwargs):
+        return self.page([{'HITId': hit_id} for hit_id in self.hits], 'HITs', **kwargs)
+
+    def list_assignments_for_hit(self, HITId, AssignmentStatuses, **kwargs):
+        if HITId in self.fail_listing:
+            raise client_error('ServiceFault', 'ListAssignmentsForHIT')
+        return self.page([a for a in self.assignments if a['HITId'] == HITId], 'Assignments', **kwargs)
+
+    def approve_assignment(self, AssignmentId):
+        with self.lock:
+            self.approve_calls.append(AssignmentId)
+            if AssignmentId in self.approved:
+                raise client_error('RequestError', 'ApproveAssignment')
+            self.approved.add(AssignmentId)
+        return {}
+
+    def get_assignment(self, AssignmentId):
+        status = 'Approved' if AssignmentId in self.approved else 'Submitted'
+        return {'Assignment': {'AssignmentId': AssignmentId, 'AssignmentStatus': status}}
+
+
+class ReviewHitsTest(unittest.TestCase):
+    def setUp(self):
+        # hit-1 has three assignments, so they take two pages. carol submitted the wrong code, and dave's assignment is
+        # in the amt_assignment table under another turker.
+        self.assignments = [make_assignment('hit-1', 'asg-1', 'alice', 'code-1'),
+                            make_assignment('hit-1', 'asg-2', 'bob', 'code-2'),
+                            make_assignment('hit-1', 'asg-3', 'carol', 'wrong-code'),
+                            make_assignment('hit-2', 'asg-4', 'mallory', 'code-4'),
+                            make_assignment('hit-2', 'asg-5', 'erin', 'code-5'),
+                            make_assignment('hit-3', 'asg-6', 'frank', 'code-6'),
+                            make_assignment('hit-4', 'asg-7', 'grace', 'code-7')]
+        (self.existing_hits, self.existing_assignments) = \
+            hit_approve_assignment.index_assignments(AMT_ASSIGNMENT_ROWS)
+
+    def review(self, mturk, concurrency=4):
+        output = StringIO()
+        counts = hit_approve_assignment.review_hits(mturk, self.existing_hits, self.existing_assignments, output,
+                                                    concurrency)
+        rows = list(csv.reader(StringIO(output.getvalue())))
+        return (counts, rows)
+
+    def test_approves_assignments_with_the_right_code(self):
+        mturk = FakeMTurk(['hit-1', 'hit-2', 'hit-3', 'hit-4'], self.assignments)
+        (counts, rows) = self.review(mturk)
+        # asg-1 and asg-2 come from different pages of hit-1, and hit-3 from the second page of reviewable HITs.
+        self.assertEqual(sorted(mturk.approve_calls), ['asg-1', 'asg-2', 'asg-5', 'asg-6'])
+        self.assertEqual(counts, {'approved': 4, 'not_approved': 2, 'failed': 0})
+
+    def test_skips_hits_that_are_not_ours(self):
+        mturk = FakeMTurk(['hit-4'], self.assignments)
+        (counts, rows) = self.review(mturk)
+        self.assertEqual(mturk.approve_calls, [])
+        self.assertEqual(counts, {'approved': 0, 'not_approved': 0, 'failed': 0})
+        self.assertEqual(rows, [hit_approve_assignment.CSV_COLS])
+
+    def test_does_not_approve_wrong_confirmation_code(self):
+        mturk = FakeMTurk(['hit-1'], self.assignments)
+        (counts, rows) = self.review(mturk)
+        self.assertNotIn('asg-3', mturk.approve_calls)
+        self.assertNotIn('asg-3', [row[1] for row in rows])
+        self.assertEqual(counts['not_approved'], 1)
+
+    def test_counts_already_approved_assignment_as_approved(self):
+        mturk = FakeMTurk(['hit-1'], self.assignments, approved=['asg-2'])
+        (counts, rows) = self.review(mturk)
+        self.assertIn('asg-2', mturk.approve_calls)
+        self.assertEqual(counts, {'approved': 2, 'not_approved': 1, 'failed': 0})
+        self.assertEqual(sorted(row[1] for row in rows[1:]), ['asg-1', 'asg-2'])
+
+    def test_request_error_on_unapproved_assignment_fails(self):
+        mturk = FakeMTurk(['hit-1'], self.assignments)
+        def approve_assignment(AssignmentId):
+            raise client_error('RequestError', 'ApproveAssignment')
+        mturk.approve_assignment = approve_assignment
+        (counts, rows) = self.review(mturk)
+        self.assertEqual(counts, {'approved': 0, 'not_approved': 1, 'failed': 2})
+        self.assertEqual(rows, [hit_approve_assignment.CSV_COLS])
+
+    def test_counts_failed_listing(self):
+        mturk = FakeMTurk(['hit-1', 'hit-2', 'hit-3'], self.assignments, fail_listing=['hit-2'])
+        (counts, rows) = self.review(mturk)
+        self.assertEqual(sorted(mturk.approve_calls), ['asg-1', 'asg-2', 'asg-6'])
+        self.assertEqual(counts, {'approved': 3, 'not_approved': 1, 'failed': 1})
+
+    def test_writes_a_csv_row_for_each_approval(self):
+        mturk = FakeMTurk(['hit-1', 'hit-2', 'hit-3'], self.assignments)
+        (counts, rows) = self.review(mturk, concurrency=1)
+        self.assertEqual(rows[0], hit_approve_assignment.CSV_COLS)
+        self.assertEqual(sorted(rows[1:]), [
+            ['hit-1', 'asg-1', 'alice', 'Submitted', '<Answer><FreeText>code-1</FreeText></Answer>',
+             '2018-01-01 12:00:00', '2018-01-01 12:30:00'],
+            ['hit-1', 'asg-2', 'bob', 'Submitted', '<Answer><FreeText>code-2</FreeText></Answer>',
+             '2018-01-01 12:00:00', '2018-01-01 12:30:00'],
+            ['hit-2', 'asg-5', 'erin', 'Submitted', '<Answer><FreeText>code-5</FreeText></Answer>',
+             '2018-01-01 12:00:00', '2018-01-01 12:30:00'],
+            ['hit-3', 'asg-6', 'frank', 'Submitted', '<Answer><FreeText>code-6</FreeText></Answer>',
+             '2018-01-01 12:00:00', '2018-01-01 12:30:00']])
+
+
+if __name__ == '__main__':
+    unittest.main()
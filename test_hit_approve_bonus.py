@@ -0,0 +1,196 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import psycopg2
+
+import hit_approve_bonus
+
+# Tests of hit_approve_bonus.py against a real PostgreSQL server (the query it runs uses DISTINCT ON and LATERAL, so
+# SQLite can't stand in for it). Set BONUS_TEST_DSN to a libpq connection string for a server where the user can create
+# databases, e.g. "host=localhost user=postgres"; the tests create a scratch database there and drop it when they are
+# done. Without it the tests are skipped.
+#
+#   BONUS_TEST_DSN="host=localhost user=postgres" python -m unittest test_hit_approve_bonus
+
+TEST_DSN = os.environ.get('BONUS_TEST_DSN')
+TEST_DB = 'sidewalk_bonus_test_%d' % os.getpid()
+
+# Just the tables and columns that the script reads and writes.
+SCHEMA = """
+CREATE SCHEMA sidewalk;
+SET search_path = sidewalk;
+CREATE TABLE sidewalk_user (user_id TEXT PRIMARY KEY, username TEXT NOT NULL);
+CREATE TABLE user_role (user_id TEXT NOT NULL, role_id INT NOT NULL);
+CREATE TABLE amt_assignment (amt_assignment_id SERIAL PRIMARY KEY, turker_id TEXT NOT NULL, hit_id TEXT NOT NULL,
+                             assignment_id TEXT NOT NULL);
+CREATE TABLE mission (mission_id INT PRIMARY KEY, region_id INT NOT NULL, label TEXT NOT NULL,
+                      deleted BOOLEAN NOT NULL DEFAULT FALSE, distance DOUBLE PRECISION,
+                      distance_ft DOUBLE PRECISION, distance_mi DOUBLE PRECISION);
+CREATE TABLE mission_user (mission_user_id INT PRIMARY KEY, mission_id INT NOT NULL, user_id TEXT NOT NULL,
+                           paid BOOLEAN NOT NULL DEFAULT FALSE);
+"""
+
+# Two turkers (role 2) and a registered user. alice has two assignments, so the query gives two rows per mission of
+# hers. Missions 1 and 5 are the turkers' first missions, which are never paid. Mission 3 is alice's first in region 2,
+# so it is paid its full distance, and mission 4 adds no distance to mission 3, so it gets no bonus.
+DATA = """
+INSERT INTO sidewalk_user VALUES ('u-alice', 'alice'), ('u-bob', 'bob'), ('u-carol', 'carol');
+INSERT INTO user_role VALUES ('u-alice', 2), ('u-bob', 2), ('u-carol', 1);
+INSERT INTO amt_assignment (turker_id, hit_id, assignment_id) VALUES
+    ('alice', 'hit-1', 'asg-a1'), ('alice', 'hit-2', 'asg-a2'), ('bob', 'hit-1', 'asg-b1'), ('carol', 'hit-1', 'asg-c1');
+INSERT INTO mission VALUES
+    (100, 1, 'onboarding', FALSE, 0, 0, 0),
+    (101, 1, 'audit', FALSE, 160.9, 528, 0.1),
+    (102, 1, 'audit', FALSE, 804.7, 2640, 0.5),
+    (103, 1, 'audit', FALSE, 965.6, 3168, 0.6),
+    (201, 2, 'audit', FALSE, 482.8, 1584, 0.3),
+    (202, 2, 'audit', FALSE, 482.8, 1584, 0.3);
+INSERT INTO mission_user VALUES
+    (10, 100, 'u-alice', FALSE),
+    (1, 101, 'u-alice', FALSE),
+    (2, 102, 'u-alice', FALSE),
+    (3, 201, 'u-alice', FALSE),
+    (4, 202, 'u-alice', FALSE),
+    (5, 101, 'u-bob', FALSE),
+    (6, 103, 'u-bob', FALSE),
+    (7, 102, 'u-carol', FALSE);
+"""
+
+PAY_PER_MILE = 10.0
+
+
+# Stands in for the MTurk client. Records the bonuses sent, and fails on the missions in `fail_on`.
+class FakeMTurk(object):
+    def __init__(self, fail_on=()):
+        self.fail_on = set(fail_on)
+        self.sent = []
+
+    def send_bonus(self, WorkerId, BonusAmount, AssignmentId, Reason, UniqueRequestToken):
+        mission_user_id = int(UniqueRequestToken[len(WorkerId + AssignmentId):])
+        if mission_user_id in self.fail_on:
+            raise RuntimeError('Service unavailable')
+        self.sent.append((mission_user_id, WorkerId, AssignmentId, BonusAmount))
+        return {}
+
+
+@unittest.skipUnless(TEST_DSN, 'BONUS_TEST_DSN is not set')
+class HitApproveBonusTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        admin = psycopg2.connect(TEST_DSN)
+        admin.autocommit = True
+        admin.cursor().execute('CREATE DATABASE ' + TEST_DB)
+        admin.close()
+
+    @classmethod
+    def tearDownClass(cls):
+        admin = psycopg2.connect(TEST_DSN)
+        admin.autocommit = True
+        admin.cursor().execute('DROP DATABASE IF EXISTS ' + TEST_DB)
+        admin.close()
+
+    def setUp(self):
+        self.conn = psycopg2.connect(TEST_DSN + ' dbname=' + TEST_DB, options='-c search_path=sidewalk')
+        cur = self.conn.cursor()
+        cur.execute('DROP SCHEMA IF EXISTS sidewalk CASCADE')
+        cur.execute(SCHEMA + DATA)
+        self.conn.commit()
+        self.tmpdir = tempfile.mkdtemp()
+        self.watermark_file = os.path.join(self.tmpdir, 'watermark.txt')
+
+    def tearDown(self):
+        self.conn.close()
+        shutil.rmtree(self.tmpdir)
+
+    def run_script(self, argv, mturk=None):
+        args = hit_approve_bonus.parse_args(['--pay_per_mile', str(PAY_PER_MILE),
+                                             '--watermark_file', self.watermark_file] + argv)
+        def connect_mturk(check_balance=False):
+            if mturk is None:
+                self.fail('Connected to MTurk in a dry run')
+            return mturk
+        return hit_approve_bonus.run(args, self.conn, connect_mturk)
+
+    def paid_ids(self):
+        cur = self.conn.cursor()
+        cur.execute('SELECT mission_user_id FROM mission_user WHERE paid ORDER BY mission_user_id')
+        ids = [row[0] for row in cur.fetchall()]
+        self.conn.commit()
+        return ids
+
+    def test_one_bonus_per_mission(self):
+        mturk = FakeMTurk()
+        (bonuses, _) = self.run_script(['--send_bonuses'], mturk)
+        self.assertEqual(list(bonuses['mission_user_id']), [2, 3, 4, 6])
+        self.assertEqual([sent[0] for sent in mturk.sent], [2, 3, 6])
+        # A mission is paid on the user's first assignment.
+        self.assertEqual([sent[2] for sent in mturk.sent], ['asg-a1', 'asg-a1', 'asg-b1'])
+
+    def test_first_missions_are_not_paid(self):
+        (bonuses, _) = self.run_script([])
+        bonus = dict(zip(bonuses['mission_user_id'], bonuses['bonus']))
+        self.assertNotIn(1, bonus)
+        self.assertNotIn(5, bonus)
+        self.assertNotIn(10, bonus)
+        self.assertAlmostEqual(bonus[2], 0.4 * PAY_PER_MILE)
+        # The first mission in another region is paid its full distance.
+        self.assertAlmostEqual(bonus[3], 0.3 * PAY_PER_MILE)
+        self.assertAlmostEqual(bonus[4], 0.0)
+        self.assertAlmostEqual(bonus[6], 0.5 * PAY_PER_MILE)
+
+    def test_dry_run_by_default(self):
+        (bonuses, paid_ids) = self.run_script([])
+        self.assertEqual(len(bonuses), 4)
+        self.assertEqual(paid_ids, [])
+        self.assertEqual(self.paid_ids(), [])
+        self.assertFalse(os.path.exists(self.watermark_file))
+
+    def test_marks_sent_and_zero_bonus_missions_paid(self):
+        (_, paid_ids) = self.run_script(['--send_bonuses'], FakeMTurk())
+        self.assertEqual(sorted(paid_ids), [2, 3, 4, 6])
+        self.assertEqual(self.paid_ids(), [2, 3, 4, 6])
+
+        # Nothing is left to pay on the next run.
+        mturk = FakeMTurk()
+        (bonuses, _) = self.run_script(['--send_bonuses'], mturk)
+        self.assertTrue(bonuses is None or len(bonuses) == 0)
+        self.assertEqual(mturk.sent, [])
+
+    def test_does_not_mark_missions_whose_bonus_failed_paid(self):
+        mturk = FakeMTurk(fail_on=[3])
+        (_, paid_ids) = self.run_script(['--send_bonuses'], mturk)
+        # Sending stops at the failed bonus, so only mission 2 was sent; mission 4 gets no bonus, so it is marked anyway.
+        self.assertEqual([sent[0] for sent in mturk.sent], [2])
+        self.assertEqual(self.paid_ids(), [2, 4])
+
+        # The next run pays the rest.
+        mturk = FakeMTurk()
+        self.run_script(['--send_bonuses'], mturk)
+        self.assertEqual([sent[0] for sent in mturk.sent], [3, 6])
+        self.assertEqual(self.paid_ids(), [2, 3, 4, 6])
+
+    def test_pays_missions_that_could_not_be_paid_yet(self):
+        # dave's MTurk assignment only shows up after the first run, which pays alice's mission 11 after his missions.
+        cur = self.conn.cursor()
+        cur.execute("""INSERT INTO sidewalk_user VALUES ('u-dave', 'dave');
+            INSERT INTO user_role VALUES ('u-dave', 2);
+            INSERT INTO mission_user VALUES (8, 101, 'u-dave', FALSE), (9, 103, 'u-dave', FALSE),
+                (11, 103, 'u-alice', FALSE);""")
+        self.conn.commit()
+        mturk = FakeMTurk()
+        self.run_script(['--send_bonuses'], mturk)
+        self.assertEqual([sent[0] for sent in mturk.sent], [2, 3, 6, 11])
+        self.assertEqual(hit_approve_bonus.read_watermark(self.watermark_file), 7)
+
+        cur.execute("INSERT INTO amt_assignment (turker_id, hit_id, assignment_id) VALUES ('dave', 'hit-3', 'asg-d1')")
+        self.conn.commit()
+        mturk = FakeMTurk()
+        self.run_script(['--send_bonuses'], mturk)
+        self.assertEqual([sent[0] for sent in mturk.sent], [9])
+        self.assertEqual(self.paid_ids(), [2, 3, 4, 6, 9, 11])
+
+
+if __name__ == '__main__':
+    unittest.main()